@@ -1,31 +1,49 @@
 
 
 from builtins import str
-from .models import ClaimsLog, Records, AuthorInfo, ChangeLog
+from .models import ClaimsLog, ClaimState, Records, AuthorInfo, ChangeLog, Outbox, KeyValue
 from adsputils import get_date, ADSCelery, u2asc
+from adsmsg import OrcidClaims
 from ADSOrcid import names
-from ADSOrcid.exceptions import IgnorableException
+from ADSOrcid.buffers import OutputCoalescer, StatusBatch
+from ADSOrcid.breakers import CircuitBreakers
+from ADSOrcid.caching import MemoCache, memoize
+from ADSOrcid.exceptions import CircuitOpenException, IgnorableException, StaleRecordException
+from ADSOrcid.http_client import RetryingSession, policies_from_config
 from celery import Celery
+from celery.exceptions import SoftTimeLimitExceeded
 from contextlib import contextmanager
 from dateutil.tz import tzutc
-from sqlalchemy import and_
+from kombu import BrokerConnection
+from sqlalchemy import and_, func
 from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
-import cachetools
+import collections
 import datetime
+import hashlib
 import json
 import os
 import random
+import requests
+import threading
 import time
 import traceback
+import uuid
 
 # global objects; we could make them belong to the app object but it doesn't seem necessary
 # unless two apps with a different endpint/config live along; TODO: move if necessary
-cache = cachetools.TTLCache(maxsize=1024, ttl=3600, timer=time.time, missing=None, getsizeof=None)
-orcid_cache = cachetools.TTLCache(maxsize=1024, ttl=3600, timer=time.time, missing=None, getsizeof=None)
-ads_cache = cachetools.TTLCache(maxsize=1024, ttl=3600, timer=time.time, missing=None, getsizeof=None)
-bibcode_cache = cachetools.TTLCache(maxsize=2048, ttl=3600, timer=time.time, missing=None, getsizeof=None)
+# (they are shared by all threads/greenlets of the worker, see caching.MemoCache)
+cache = MemoCache('author', maxsize=1024, ttl=3600)
+orcid_cache = MemoCache('orcid_profile', maxsize=1024, ttl=3600)
+ads_cache = MemoCache('ads_profile', maxsize=1024, ttl=3600)
+bibcode_cache = MemoCache('metadata', maxsize=2048, ttl=3600)
+
+# counters of what the worker (process) did; they are logged periodically
+stats = collections.Counter()
+stats_lock = threading.Lock()
 
 ALLOWED_STATUS = set(['claimed', 'updated', 'removed', 'unchanged', 'forced', '#full-import'])
 
@@ -39,8 +57,247 @@ def clear_caches():
     bibcode_cache.clear()
 
 
+def cache_stats():
+    """Returns the counters of the module caches (flat dict)."""
+    out = {}
+    for c in (cache, orcid_cache, ads_cache, bibcode_cache):
+        for k, v in c.stats().items():
+            out['cache.{0}.{1}'.format(c.name, k)] = v
+    return out
+
+
+def content_hash(value):
+    """Returns a stable (sha1) digest of a JSON serializable value;
+    used to reference content (e.g. author lists) instead of shipping
+    it around inside of the messages."""
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def dump_works(orcid_present):
+    """Converts the resolved works (see ADSOrcidCelery.resolve_works)
+    into a json serializable dict."""
+    return dict([(k, (v[0], v[1].isoformat(), v[2], v[3], v[4]))
+                 for k, v in orcid_present.items()])
+
+
+def load_works(data):
+    """Inverse of dump_works."""
+    return dict([(k, (v[0], get_date(v[1]), v[2], v[3], v[4]))
+                 for k, v in data.items()])
+
+
+def jump_hash(key, num_buckets):
+    """Jump consistent hash (Lamping, Veach: arXiv:1406.2294); maps the
+    key (string) to one of the buckets. When the number of buckets
+    changes, only 1/n of the keys move to a different bucket.
+
+    :return: int, 0 <= bucket < num_buckets
+    """
+    k = int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16], 16)
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        k = (k * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((k >> 33) + 1)))
+    return b
+
+
+def output_payload(authors, claims):
+    """Returns the part of a record that is forwarded to the master
+    pipeline (it is used to compute the hash of the output)."""
+    claims = claims or {}
+    return {'authors': list(authors or []),
+            'verified': list(claims.get('verified', []) or []),
+            'unverified': list(claims.get('unverified', []) or [])}
+
+
 class ADSOrcidCelery(ADSCelery):
 
+    _output_buffer = None
+    _status_batch = None
+    _breakers = None
+    _stats_logged = 0
+    _lock = threading.RLock()
+
+    @property
+    def client(self):
+        """HTTP client (requests.Session) of the current thread (or
+        greenlet); requests sessions are not thread-safe, but all of them
+        share the connection pools (adapters) of the app. The failed
+        requests are retried (see http_client.RetryingSession)."""
+        local = self._clients
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = self._copy_client(self._client)
+            local.client = client
+        return client
+
+
+    @client.setter
+    def client(self, value):
+        # the session is used (and configured) by the thread that sets it,
+        # the other threads get a copy
+        if isinstance(value, requests.Session) and not isinstance(value, RetryingSession):
+            value = self._copy_client(value)
+        self._client = value
+        self._clients = threading.local()
+        self._clients.client = value
+
+
+    def _copy_client(self, session):
+        """Returns a new RetryingSession with the headers and the
+        adapters of the session."""
+        client = RetryingSession(policies_from_config(self._config), stats=stats, logger=self.logger,
+                                 breakers=self.breakers)
+        client.headers.update(session.headers)
+        for prefix, adapter in session.adapters.items():
+            client.mount(prefix, adapter)
+        return client
+
+
+    @property
+    def breakers(self):
+        """Circuit breakers (shared by all the workers through the db)
+        of the remote services, see breakers.CircuitBreakers"""
+        with self._lock:
+            if self._breakers is None:
+                self._breakers = CircuitBreakers(self, self._config, stats=stats, logger=self.logger)
+            return self._breakers
+
+
+    @property
+    def output_buffer(self):
+        """Buffer (one per worker process) that coalesces the
+        outgoing results by bibcode."""
+        with self._lock:
+            if self._output_buffer is None:
+                self._output_buffer = OutputCoalescer(self.forward_message,
+                                        window=self._config.get('OUTPUT_COALESCE_WINDOW', 0),
+                                        maxsize=self._config.get('OUTPUT_COALESCE_MAXSIZE', 1000),
+                                        stats=stats,
+                                        logger=self.logger)
+            return self._output_buffer
+
+
+    @property
+    def status_batch(self):
+        """Batch (one per worker process) of the status updates
+        that are waiting to be sent to the orcid microservice."""
+        with self._lock:
+            if self._status_batch is None:
+                self._status_batch = self.create_status_batch(self._config.get('STATUS_BATCH_WINDOW', 0))
+            return self._status_batch
+
+
+    def create_status_batch(self, window=0):
+        """Creates a batch of status updates (see: buffers.StatusBatch)"""
+        return StatusBatch(self.update_bib_status,
+                           window=window,
+                           maxsize=self._config.get('STATUS_BATCH_MAXSIZE', 100),
+                           retries=self._config.get('STATUS_BATCH_RETRIES', 2),
+                           retry_delay=self._config.get('STATUS_BATCH_RETRY_DELAY', 0.5),
+                           stats=stats,
+                           logger=self.logger)
+
+
+    def update_bib_status(self, orcidid, status, bibcodes):
+        """Updates the status of the claims inside the orcid microservice.
+
+        :param: orcidid - string
+        :param: status - string, e.g. 'verified', 'rejected', 'not in ADS'
+        :param: bibcodes - list of identifiers (of one or many works)
+        :return: http response
+        """
+        return self.client.post(self._config.get('API_ORCID_UPDATE_BIB_STATUS') % orcidid,
+                                json={'bibcodes': bibcodes, 'status': status},
+                                headers={'Authorization': 'Bearer {0}'.format(self._config.get('API_TOKEN'))})
+
+
+    def incr_stat(self, name, value=1):
+        """Increments one of the counters (and logs them once in a while)."""
+        with stats_lock:
+            stats[name] += value
+        self.log_stats()
+
+
+    def set_stat(self, name, value):
+        """Sets the value of a gauge (e.g. a lag in secs), it is logged
+        together with the counters."""
+        with stats_lock:
+            stats[name] = value
+        self.log_stats()
+
+
+    def log_stats(self, force=False):
+        """Logs the counters of this process; at most once every
+        STATS_LOG_INTERVAL seconds (unless forced)."""
+        now = time.time()
+        if force or now - self._stats_logged > self._config.get('STATS_LOG_INTERVAL', 300):
+            self._stats_logged = now
+            if stats and self.logger:
+                with stats_lock:
+                    out = dict(stats)
+                out.update(cache_stats())
+                self.logger.info('Stats: {0}'.format(json.dumps(out, sort_keys=True)))
+
+
+    @contextmanager
+    def new_session_scope(self):
+        """Like session_scope(), but with a session of its own (not the
+        one of the current thread); it can be used while the thread is
+        inside of another session_scope() - e.g. by the http client."""
+        session = self._session_factory()
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+    def get_last_import(self, orcidid):
+        """Returns the date (datetime) when the last full import of the
+        profile started, or None if it was never imported."""
+        with self.session_scope() as session:
+            r = session.query(ClaimsLog.created).filter(
+                and_(ClaimsLog.status == '#full-import', ClaimsLog.orcidid == orcidid)
+                ).order_by(ClaimsLog.id.desc()).first()
+            return r and get_date(r.created) or None
+
+
+    def load_import_cursor(self, orcidid, version):
+        """Returns the progress of an interrupted import of the profile,
+        (index of the next work, orcid_present so far); (0, {}) if there
+        is none or it was made for another version of the profile.
+
+        :param: version - datetime, last-modified-date of the profile
+        """
+        with self.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key='import-cursor:{0}'.format(orcidid)).first()
+            cursor = kv and kv.value and json.loads(kv.value) or None
+        if not cursor or cursor.get('version') != version.isoformat():
+            return 0, {}
+        return cursor['index'], load_works(cursor['present'])
+
+
+    def save_import_cursor(self, orcidid, version, index, orcid_present):
+        """Saves the progress of the import (see get_claims)."""
+        with self.session_scope() as session:
+            session.merge(KeyValue(key='import-cursor:{0}'.format(orcidid),
+                                   value=json.dumps({'version': version.isoformat(), 'index': index,
+                                                     'present': dump_works(orcid_present)})))
+            session.commit()
+
+
+    def delete_import_cursor(self, orcidid):
+        """Removes the progress of the import (it was completed)."""
+        with self.session_scope() as session:
+            session.query(KeyValue).filter_by(key='import-cursor:{0}'.format(orcidid)) \
+                .delete(synchronize_session=False)
+            session.commit()
+
 
     def insert_claims(self, claims):
         """
@@ -52,18 +309,105 @@ class ADSOrcidCelery(ADSCelery):
                 to the database
         """
         res = []
-        with self.session_scope() as session:
-            for c in claims:
-                if isinstance(c, ClaimsLog):
-                    claim = c
+        rows = []
+        updates = []
+        for c in claims:
+            if isinstance(c, ClaimsLog):
+                claim = c
+            else:
+                claim = self.create_claim(**c)
+            if claim:
+                row = self._claim_row(claim)
+                res.append(row)
+                if claim.id is None:
+                    rows.append(row)
                 else:
-                    claim = self.create_claim(**c)
-                if claim:
-                    session.add(claim)
-                    res.append(claim)
+                    # an existing claim (create_claim with force_new=False)
+                    row['id'] = claim.id
+                    updates.append(row)
+
+        with self.session_scope() as session:
+            self._bulk_insert_claims(session, rows)
+            if updates:
+                session.bulk_update_mappings(ClaimsLog, updates)
+            self._update_claim_state(session, res)
             session.commit()
-            res = [x.toJSON() for x in res]
-        return res
+        return [self._claim_json(x) for x in res]
+
+    def _claim_row(self, claim):
+        """Turns the (transient) ClaimsLog into a dict for the bulk insert."""
+        return {'bibcode': claim.bibcode, 'orcidid': claim.orcidid,
+                'provenance': claim.provenance, 'status': claim.status,
+                'created': claim.created or get_date()}
+
+    def _claim_json(self, row):
+        """Same as ClaimsLog.toJSON, but from the inserted row."""
+        return {'id': row['id'], 'orcidid': row['orcidid'],
+                'bibcode': row['bibcode'], 'status': row['status'],
+                'provenance': str(row['provenance']),
+                'created': row['created'] and get_date(row['created']).isoformat() or None}
+
+    def _bulk_insert_claims(self, session, rows):
+        """Inserts the claims without creating the ORM instances; on
+        postgres by multi-row INSERT ... RETURNING id, elsewhere by
+        bulk_insert_mappings. The ids are set into the rows.
+
+        :param: rows - list of dicts (see _claim_row)
+        """
+        if not rows:
+            return
+        table = ClaimsLog.__table__
+        columns = [c.name for c in table.columns if c.name != 'id']
+        batch_size = self._config.get('CLAIMS_INSERT_BATCH_SIZE', 1000)
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            if session.get_bind().dialect.name == 'postgresql':
+                values = [dict([(k, r[k]) for k in columns]) for r in batch]
+                ids = session.execute(table.insert().values(values).returning(table.c.id)).fetchall()
+                # postgres returns the rows of a multi-row insert in the order of the values
+                for r, (id,) in zip(batch, ids):
+                    r['id'] = id
+            else:
+                mappings = [dict([(k, r[k]) for k in columns]) for r in batch]
+                session.bulk_insert_mappings(ClaimsLog, mappings, return_defaults=True)
+                for r, m in zip(batch, mappings):
+                    r['id'] = m['id']
+
+    def _update_claim_state(self, session, rows):
+        """Applies the new claims to the claim_state table (in the session
+        of the insert, the caller commits): #full-import forgets the
+        previous state of the author, otherwise the latest claim of the
+        bibcode wins (upsert).
+
+        :param: rows - list of dicts (see _claim_row), in the order of the insert
+        """
+        latest = collections.OrderedDict()  # orcidid -> {bibcode: row}
+        reset = set()
+        for r in rows:
+            if r['status'] == '#full-import':
+                reset.add(r['orcidid'])
+                latest[r['orcidid']] = {}
+            elif r['bibcode']:
+                latest.setdefault(r['orcidid'], {})[r['bibcode']] = r
+
+        postgres = session.get_bind().dialect.name == 'postgresql'
+        for orcidid, claims in latest.items():
+            q = session.query(ClaimState).filter(ClaimState.orcidid == orcidid)
+            if orcidid in reset:
+                q.delete(synchronize_session=False)
+            elif claims and not postgres:
+                q.filter(ClaimState.bibcode.in_(list(claims.keys()))).delete(synchronize_session=False)
+            if not claims:
+                continue
+            values = [{'orcidid': orcidid, 'bibcode': r['bibcode'], 'status': r['status'],
+                       'created': r['created']} for r in claims.values()]
+            if postgres:
+                stmt = postgresql.insert(ClaimState.__table__).values(values)
+                session.execute(stmt.on_conflict_do_update(
+                    index_elements=['orcidid', 'bibcode'],
+                    set_={'status': stmt.excluded.status, 'created': stmt.excluded.created}))
+            else:
+                session.bulk_insert_mappings(ClaimState, values)
 
     def create_claim(self,
                  bibcode=None,
@@ -144,7 +488,16 @@ class ADSOrcidCelery(ADSCelery):
                           status=status or default_status,
                           created=date and get_date(date) or get_date())
 
+        def flush(session, rows):
+            self._bulk_insert_claims(session, rows)
+            self._update_claim_state(session, rows)
+            session.commit()
+            if collector is not None:
+                collector.extend([self._claim_json(r) for r in rows])
+            del rows[:]
+
         i = 0
+        rows = []
         with open(input_file, 'r') as fi:
             with self.session_scope() as session:
                 for line in fi:
@@ -154,15 +507,12 @@ class ADSOrcidCelery(ADSCelery):
                         continue
                     parts = l.split('\t')
                     try:
-                        rec = rec_builder(*parts)
-                        session.add(rec)
-                        if collector is not None:
-                            collector.append(rec.toJSON())
+                        rows.append(self._claim_row(rec_builder(*parts)))
                     except Exception as e:
                         self.logger.error('Error importing line %s (%s) - %s' % (i, l, e))
-                    if i % 1000 == 0:
-                        session.commit()
-                session.commit()
+                    if len(rows) >= 1000:
+                        flush(session, rows)
+                flush(session, rows)
 
 
     def _get_ads_orcid_profile(self, orcidid, api_token, api_url):
@@ -192,7 +542,7 @@ class ADSOrcidCelery(ADSCelery):
 
 
     def get_claims(self, orcidid, api_token, api_url, force=False,
-                      orcid_identifiers_order=None):
+                      orcid_identifiers_order=None, resume=False, profile=None):
         """
         Fetch a fresh profile from the orcid-service and compare
         it against the state of the storage (diff). Return the docs
@@ -213,6 +563,13 @@ class ADSOrcidCelery(ADSCelery):
             - dict, helps to sort claims by their identifies.
                 (e.g. to say that bibcodes have higher priority than
                 dois)
+        :param: resume
+            - bool, when True the progress (works resolved so far) is
+                saved every IMPORT_CHUNK_SIZE works and when the task
+                runs out of time; the next call continues from there
+                (the caller deletes the cursor when the import is done)
+        :param: profile
+            - the result of get_profile_works (if already fetched)
         :return:
             - updated: dict of bibcodes that were updated
                 - keys are lowercased bibcodes
@@ -222,172 +579,326 @@ class ADSOrcidCelery(ADSCelery):
                 - values are (bibcode, timestamp)
         """
 
+        if profile is None:
+            profile = self.get_profile_works(orcidid, api_token, api_url, force=force)
+        if profile is None:
+            return {}, {}, {} #TODO: remove all existing claims?
+        works, version, updt = profile
 
+        orcid_present = self.resolve_works(orcidid, works, version, orcid_identifiers_order,
+                                           resume_version=resume and updt or None)
+        updated, removed = self.get_known_claims(orcidid)
+        return orcid_present, updated, removed
 
 
+    def get_profile_works(self, orcidid, api_token, api_url, force=False):
+        """
+        Fetches the profile (see get_claims) and returns its works.
+
+        :return: (works, version, updt) - list of works (as they come
+            in the profile), version of the orcid API (1 or 2) and the
+            last-modified-date of the profile (datetime); or None if
+            there is nothing to import (the profile is missing, or it
+            didn't change since the last import and force is False)
+        """
+
         # make sure the author is there (even if without documents)
         author = self.retrieve_orcid(orcidid) # @UnusedVariable
         data = self._get_ads_orcid_profile(orcidid, api_token, api_url)
 
         if data is None:
-            return {}, {}, {} #TODO: remove all existing claims?
+            return None
 
         profile = data.get('profile', {})
         if not profile:
-            return {}, {}, {} #TODO: remove all existing claims?
-
+            return None
 
-        with self.session_scope() as session:
+        # version needs to be verified as previous ORCID API versions returned different structure; these may be
+        # caught if we force update without a user-triggered refresh
+        version = self._check_profile_version(profile)
+        if version == 2:
+            works = profile['activities-summary']['works']['group']
+        elif version == 1:
+            works = profile['orcid-profile']['orcid-activities']['orcid-works']['orcid-work']
+        else:
+            self.logger.warning('Nothing to do for: '
+                '{0} ({1})'.format(orcidid,
+                                   traceback.format_exc()))
+            return None
 
-            # version needs to be verified as previous ORCID API versions returned different structure; these may be
-            # caught if we force update without a user-triggered refresh
-            version = self._check_profile_version(profile)
+        # check we haven't seen this very profile already
+        try:
             if version == 2:
-                works = profile['activities-summary']['works']['group']
-            elif version == 1:
-                works = profile['orcid-profile']['orcid-activities']['orcid-works']['orcid-work']
+                updt = str(profile['history']['last-modified-date']['value'])
             else:
-                self.logger.warning('Nothing to do for: '
-                    '{0} ({1})'.format(orcidid,
-                                       traceback.format_exc()))
-                return {}, {}, {}
+                updt = str(profile['orcid-profile']['orcid-history']['last-modified-date']['value'])
+            updt = float('%s.%s' % (updt[0:10], updt[10:]))
+            updt = datetime.datetime.fromtimestamp(updt, tzutc())
+            updt = get_date(updt.isoformat())
+        except KeyError:
+            updt = get_date()
+
+        # find the most recent #full-import record
+        last_update = self.get_last_import(orcidid)
+        if last_update is not None and last_update == updt:
+            if force:
+                self.logger.info("Profile {0} unchanged, but forced update in effect.".format(orcidid))
+            else:
+                self.logger.info("Skipping {0} (profile unchanged)".format(orcidid))
+                return None
+
+        return works or [], version, updt
+
 
-            # check we haven't seen this very profile already
+    def resolve_works(self, orcidid, works, version, orcid_identifiers_order=None,
+                      resume_version=None):
+        """
+        Finds the records (bibcodes) of the works of the profile.
+
+        :param: works - list of works (see get_profile_works)
+        :param: version - int, version of the orcid API
+        :param: orcid_identifiers_order - dict, see get_claims
+        :param: resume_version - datetime (last-modified-date of the profile),
+            if set, the progress is saved and resumed (see get_claims)
+        :return: orcid_present - dict, keys are lowercased bibcodes and
+            values are (bibcode, timestamp, provenance, identifiers, authors)
+        """
+        # now get info about each record #TODO: enhance the matching (and refactor)
+        # we'll try to match identifiers against our own API; if a document is found
+        # it will be added to the `orcid_present` with corresponding timestamp (cdate)
+        orcid_present = {}
+        start = 0
+        if resume_version:
+            start, orcid_present = self.load_import_cursor(orcidid, resume_version)
+            if start:
+                self.logger.info('Resuming import of {0} from work {1}/{2}'.format(orcidid, start, len(works)))
+        chunk_size = self._config.get('IMPORT_CHUNK_SIZE', 50)
+        not_in_ads = self.create_status_batch()
+        for i, w in enumerate(works):
+            if i < start:
+                continue
+            if resume_version and i > start and (i - start) % chunk_size == 0:
+                not_in_ads.flush()
+                self.save_import_cursor(orcidid, resume_version, i, orcid_present)
+            bibc = None
             try:
                 if version == 2:
-                    updt = str(profile['history']['last-modified-date']['value'])
+                    ids = w['external-ids']['external-id']
                 else:
-                    updt = str(profile['orcid-profile']['orcid-history']['last-modified-date']['value'])
-                updt = float('%s.%s' % (updt[0:10], updt[10:]))
-                updt = datetime.datetime.fromtimestamp(updt, tzutc())
-                updt = get_date(updt.isoformat())
-            except KeyError:
-                updt = get_date()
-
-            # find the most recent #full-import record
-            last_update = session.query(ClaimsLog).filter(
-                and_(ClaimsLog.status == '#full-import', ClaimsLog.orcidid == orcidid)
-                ).order_by(ClaimsLog.id.desc()).first()
+                    ids = w['work-external-identifiers']['work-external-identifier']
+                seek_ids = []
 
-            if last_update is None:
-                q = session.query(ClaimsLog).filter_by(orcidid=orcidid).order_by(ClaimsLog.id.asc())
-            else:
-                if get_date(last_update.created) == updt:
-                    if force:
-                        self.logger.info("Profile {0} unchanged, but forced update in effect.".format(orcidid))
-                    else:
-                        self.logger.info("Skipping {0} (profile unchanged)".format(orcidid))
-                        return {}, {}, {}
-                q = session.query(ClaimsLog).filter(
-                    and_(ClaimsLog.orcidid == orcidid, ClaimsLog.id > last_update.id)) \
-                    .order_by(ClaimsLog.id.asc())
-
-
-            # now get info about each record #TODO: enhance the matching (and refactor)
-            # we'll try to match identifiers against our own API; if a document is found
-            # it will be added to the `orcid_present` with corresponding timestamp (cdate)
-            orcid_present = {}
-            for w in works:
-                bibc = None
-                try:
+                # painstakingly check ids (start from a bibcode) if we can find it
+                # we'll send it through (but start from bibcodes, then dois, arxiv...)
+                fmap = orcid_identifiers_order
+                for x in ids:
                     if version == 2:
-                        ids = w['external-ids']['external-id']
+                        xtype = x.get('external-id-type', None)
+                        if xtype:
+                            seek_ids.append((fmap.get(xtype.lower().strip(), fmap.get('*', -1)),
+                                             x['external-id-value']))
                     else:
-                        ids = w['work-external-identifiers']['work-external-identifier']
-                    seek_ids = []
-
-                    # painstakingly check ids (start from a bibcode) if we can find it
-                    # we'll send it through (but start from bibcodes, then dois, arxiv...)
-                    fmap = orcid_identifiers_order
-                    for x in ids:
-                        if version == 2:
-                            xtype = x.get('external-id-type', None)
-                            if xtype:
-                                seek_ids.append((fmap.get(xtype.lower().strip(), fmap.get('*', -1)),
-                                                 x['external-id-value']))
-                        else:
-                            xtype = x.get('work-external-identifier-type', None)
-                            if xtype:
-                                seek_ids.append((fmap.get(xtype.lower().strip(), fmap.get('*', -1)),
-                                                 x['work-external-identifier-id']['value']))
-
-                    if len(seek_ids) == 0:
-                        continue
+                        xtype = x.get('work-external-identifier-type', None)
+                        if xtype:
+                            seek_ids.append((fmap.get(xtype.lower().strip(), fmap.get('*', -1)),
+                                             x['work-external-identifier-id']['value']))
 
-                    seek_ids = sorted(seek_ids, key=lambda x: x[0], reverse=True)
-                    fvalues = []
-                    for _priority, fvalue in seek_ids:
-                        fvalues.append(fvalue)
-                        try:
-                            time.sleep(1.0/random.randint(5, 10)) # be nice to the api
-                            metadata = self.retrieve_metadata(fvalue, search_identifiers=True)
-                            if metadata and metadata.get('bibcode', None):
-                                bibc = metadata.get('bibcode')
-                                author_list = metadata.get('author', [])
-                                self.logger.info('Match found {0} -> {1}'.format(fvalue, bibc))
-                                break
-                        except Exception as e:
-                            self.logger.warning('Exception while searching for matching bibcode for: {}'.format(fvalue))
-                            if getattr(e, "message", ""):
-                                self.logger.warning(e.message)
-
-
-                    if bibc:
-                        # would you believe that orcid doesn't return floats?
-                        ts = str(w['last-modified-date']['value'])
-                        ts = float('%s.%s' % (ts[0:10], ts[10:]))
-                        ts = datetime.datetime.fromtimestamp(ts, tzutc())
-                        try:
-                            provenance = w['source']['source-name']['value']
-                        except KeyError:
-                            provenance = 'orcid-profile'
-                        orcid_present[bibc.lower().strip()] = (bibc.strip(), get_date(ts.isoformat()), provenance, fvalues, author_list)
-                    else:
-                        r = self.client.post(self._config.get('API_ORCID_UPDATE_BIB_STATUS') % orcidid,
-                                          json={'bibcodes': fvalues, 'status': 'not in ADS'},
-                                          headers={'Authorization': 'Bearer {0}'.format(self._config.get('API_TOKEN'))})
-                        if r.status_code != 200:
-                            self.logger.warning('IDs {ids} for {orcidid} not updated to: not in ADS'
-                                                .format(ids=json.dumps(fvalues), orcidid=orcidid))
-                        elif len(r.json()) != 1:
-                            self.logger.warning('Number of updated bibcodes ({0}) does not match input ({1}) for {2}'.
-                                                format(r.text, fvalues, orcidid))
-                        self.logger.warning('Found no bibcode for: {orcidid}, IDs: {ids}'.format(ids=json.dumps(fvalues), orcidid=orcidid))
-
-                except KeyError as e:
-                    self.logger.warning('Error processing a record: '
-                        '{0} ({1})'.format(w,
-                                           traceback.format_exc()))
-                    continue
-                except TypeError as e:
-                    self.logger.warning('Error processing a record: '
-                        '{0} ({1})'.format(w,
-                                           traceback.format_exc()))
+                if len(seek_ids) == 0:
                     continue
 
+                seek_ids = sorted(seek_ids, key=lambda x: x[0], reverse=True)
+                fvalues = []
+                for _priority, fvalue in seek_ids:
+                    fvalues.append(fvalue)
+                    try:
+                        time.sleep(1.0/random.randint(5, 10)) # be nice to the api
+                        metadata = self.retrieve_metadata(fvalue, search_identifiers=True)
+                        if metadata and metadata.get('bibcode', None):
+                            bibc = metadata.get('bibcode')
+                            author_list = metadata.get('author', [])
+                            self.logger.info('Match found {0} -> {1}'.format(fvalue, bibc))
+                            break
+                    except (SoftTimeLimitExceeded, CircuitOpenException):
+                        if resume_version:
+                            not_in_ads.flush()
+                            self.save_import_cursor(orcidid, resume_version, i, orcid_present)
+                        raise
+                    except Exception as e:
+                        self.logger.warning('Exception while searching for matching bibcode for: {}'.format(fvalue))
+                        if getattr(e, "message", ""):
+                            self.logger.warning(e.message)
 
-            # find all records we have processed at some point
-            updated = {}
-            removed = {}
 
-            for cl in q.all():
-                if not cl.bibcode:
-                    continue
+                if bibc:
+                    # would you believe that orcid doesn't return floats?
+                    ts = str(w['last-modified-date']['value'])
+                    ts = float('%s.%s' % (ts[0:10], ts[10:]))
+                    ts = datetime.datetime.fromtimestamp(ts, tzutc())
+                    try:
+                        provenance = w['source']['source-name']['value']
+                    except KeyError:
+                        provenance = 'orcid-profile'
+                    orcid_present[bibc.lower().strip()] = (bibc.strip(), get_date(ts.isoformat()), provenance, fvalues, author_list)
+                else:
+                    not_in_ads.add(orcidid, fvalues, 'not in ADS')
+                    self.logger.warning('Found no bibcode for: {orcidid}, IDs: {ids}'.format(ids=json.dumps(fvalues), orcidid=orcidid))
+
+            except KeyError as e:
+                self.logger.warning('Error processing a record: '
+                    '{0} ({1})'.format(w,
+                                       traceback.format_exc()))
+                continue
+            except TypeError as e:
+                self.logger.warning('Error processing a record: '
+                    '{0} ({1})'.format(w,
+                                       traceback.format_exc()))
+                continue
+
+        # tell the orcid microservice about the works we don't have (in one go)
+        not_in_ads.flush()
+        return orcid_present
+
+
+    def get_known_claims(self, orcidid):
+        """
+        Returns the claims of the author that we recorded since the
+        last full import (our side of the diff, see get_claims); they
+        are read from the claim_state table.
+
+        :return: (updated, removed) - dicts, keys are lowercased bibcodes
+            and values are (bibcode, timestamp)
+        """
+        updated = {}
+        removed = {}
+        with self.session_scope() as session:
+            rows = session.query(ClaimState.bibcode, ClaimState.status, ClaimState.created) \
+                .filter(ClaimState.orcidid == orcidid).all()
+            if not rows:
+                # nothing recorded in the state (e.g. claims written by hand)
+                return self._replay_claims(session, orcidid)
+            for cl in sorted(rows, key=lambda x: x.created):
                 bibc = cl.bibcode.lower()
                 if cl.status == 'removed':
                     removed[bibc] = (cl.bibcode, get_date(cl.created))
-                    if bibc in updated:
-                        del updated[bibc]
-                else: #elif cl.status in ('claimed', 'updated', 'forced', 'unchanged'):
+                    updated.pop(bibc, None)
+                else:
                     updated[bibc] = (cl.bibcode, get_date(cl.created))
-                    if bibc in removed:
-                        del removed[bibc]
+                    removed.pop(bibc, None)
+        return updated, removed
+
+    def _replay_claims(self, session, orcidid):
+        """Computes get_known_claims from the claims log."""
+        # find the most recent #full-import record
+        last_update = session.query(ClaimsLog).filter(
+            and_(ClaimsLog.status == '#full-import', ClaimsLog.orcidid == orcidid)
+            ).order_by(ClaimsLog.id.desc()).first()
+
+        if last_update is None:
+            q = session.query(ClaimsLog).filter_by(orcidid=orcidid).order_by(ClaimsLog.id.asc())
+        else:
+            q = session.query(ClaimsLog).filter(
+                and_(ClaimsLog.orcidid == orcidid, ClaimsLog.id > last_update.id)) \
+                .order_by(ClaimsLog.id.asc())
+
+        # find all records we have processed at some point
+        updated = {}
+        removed = {}
+
+        for cl in q.yield_per(1000):
+            if not cl.bibcode:
+                continue
+            bibc = cl.bibcode.lower()
+            if cl.status == 'removed':
+                removed[bibc] = (cl.bibcode, get_date(cl.created))
+                if bibc in updated:
+                    del updated[bibc]
+            else: #elif cl.status in ('claimed', 'updated', 'forced', 'unchanged'):
+                updated[bibc] = (cl.bibcode, get_date(cl.created))
+                if bibc in removed:
+                    del removed[bibc]
+
+        return updated, removed
+
+
+
+    def compact_claims(self, retention=None, batch_size=None, archive=None, limit=None):
+        """
+        Removes the claims that no longer matter: 'unchanged' and 'forced'
+        rows (every import writes one for every work of the profile)
+        that precede a #full-import of the author older than the retention
+        window. The diff (get_known_claims) only looks at the claims after
+        the last #full-import, so it is not affected; the #full-import rows
+        and the claimed/updated/removed history are kept.
+
+        The authors are processed one by one (in the order of orcidids),
+        the rows are deleted in small batches, each in its own transaction;
+        the progress is saved (KeyValue 'compact.cursor') so an interrupted
+        run continues where it stopped.
+
+        :param: retention - int, days (default: CLAIMS_RETENTION_DAYS)
+        :param: batch_size - int, max number of rows deleted at once
+        :param: archive - file-like object; the removed rows are written
+            there first, in the format of import_recs (tab delimited)
+        :param: limit - int, max number of authors to process (in this run)
+        :return: (number of authors, number of removed rows)
+        """
+        if retention is None:
+            retention = self._config.get('CLAIMS_RETENTION_DAYS', 90)
+        batch_size = batch_size or self._config.get('CLAIMS_COMPACT_BATCH_SIZE', 1000)
+        cutoff = get_date() - datetime.timedelta(days=retention)
+        cursor_key = 'compact.cursor'
 
-            return orcid_present, updated, removed
+        with self.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key=cursor_key).first()
+            cursor = kv and kv.value or ''
+            # the newest #full-import (older than the window) of every author
+            q = session.query(ClaimsLog.orcidid, func.max(ClaimsLog.id)).filter(
+                and_(ClaimsLog.status == '#full-import', ClaimsLog.created < cutoff,
+                     ClaimsLog.orcidid > cursor)) \
+                .group_by(ClaimsLog.orcidid).order_by(ClaimsLog.orcidid.asc())
+            if limit:
+                q = q.limit(limit)
+            horizons = q.all()
+
+        num_authors = num_rows = 0
+        for orcidid, horizon in horizons:
+            while True:
+                with self.session_scope() as session:
+                    rows = session.query(ClaimsLog).filter(
+                        and_(ClaimsLog.orcidid == orcidid,
+                             ClaimsLog.status.in_(['unchanged', 'forced']),
+                             ClaimsLog.id < horizon)) \
+                        .order_by(ClaimsLog.id.asc()).limit(batch_size).all()
+                    if archive is not None:
+                        for r in rows:
+                            archive.write('\t'.join([r.bibcode or '', r.orcidid, r.provenance or '', r.status,
+                                                     get_date(r.created).isoformat()]) + '\n')
+                        archive.flush()
+                    if rows:
+                        session.query(ClaimsLog).filter(ClaimsLog.id.in_([r.id for r in rows])) \
+                            .delete(synchronize_session=False)
+                    session.commit()
+                num_rows += len(rows)
+                if len(rows) < batch_size:
+                    break
+            num_authors += 1
+            with self.session_scope() as session:
+                session.merge(KeyValue(key=cursor_key, value=orcidid))
+                session.commit()
+            if num_authors % 1000 == 0:
+                self.logger.info('Compacted claims of {0} authors, {1} rows removed'.format(num_authors, num_rows))
 
+        # finished (not just a limited run), the next one starts from the beginning
+        if not limit or len(horizons) < limit:
+            with self.session_scope() as session:
+                session.query(KeyValue).filter_by(key=cursor_key).delete(synchronize_session=False)
+                session.commit()
+
+        self.logger.info('Compacted claims of {0} authors, {1} rows removed'.format(num_authors, num_rows))
+        return num_authors, num_rows
 
 
-    @cachetools.cached(cache)
+    @memoize(cache)
     def retrieve_orcid(self, orcid):
         """
         Finds (or creates and returns) model of ORCID
@@ -408,7 +919,7 @@ class ADSOrcidCelery(ADSCelery):
 
             return session.query(AuthorInfo).filter_by(orcidid=orcid).first().toJSON()
 
-    @cachetools.cached(orcid_cache)
+    @memoize(orcid_cache)
     def get_public_orcid_profile(self, orcidid):
         r = self.client.get(self._config.get('API_ORCID_PROFILE_ENDPOINT') % orcidid,
                      headers={'Accept': 'application/json'})
@@ -417,7 +928,7 @@ class ADSOrcidCelery(ADSCelery):
         else:
             return r.json()
 
-    @cachetools.cached(ads_cache)
+    @memoize(ads_cache)
     def get_ads_orcid_profile(self, orcidid):
         r = self.client.get(self._config.get('API_ORCID_EXPORT_PROFILE') % orcidid,
                      headers={'Accept': 'application/json', 'Authorization': 'Bearer %s' % self._config.get('API_TOKEN')})
@@ -629,7 +1140,7 @@ class ADSOrcidCelery(ADSCelery):
         return author_data
 
 
-    @cachetools.cached(bibcode_cache)
+    @memoize(bibcode_cache)
     def retrieve_metadata(self, bibcode, search_identifiers=False):
         """
         From the API retrieve the set of metadata we want to know about the record.
@@ -668,24 +1179,280 @@ class ADSOrcidCelery(ADSCelery):
 
     def retrieve_record(self, bibcode, authors):
         """
-        Gets a record from the database (creates one if necessary)
+        Gets a record from the database (creates one if necessary);
+        the 'version' of the record is included (see record_claims).
+        If the stored author list was replaced, 'authors_changed' is
+        True (the record has to be forwarded even if the claims stay
+        the same)
         """
         with self.session_scope() as session:
             r = session.query(Records).filter_by(bibcode=bibcode).first()
             if r is None:
-                r = Records(bibcode=bibcode)
+                r = Records(bibcode=bibcode, version=0)
                 session.add(r)
             out = r.toJSON()
+            out['version'] = r.version or 0
+            out['authors_changed'] = False
 
             if out.get('authors') != authors:
                 r.authors = json.dumps(authors)
                 out['authors'] = authors
+                if r.id is not None:
+                    # the positions of the claims might have changed
+                    r.version = out['version'] = out['version'] + 1
+                    out['authors_changed'] = True
 
             session.commit()
             return out
 
 
-    def record_claims(self, bibcode, claims, authors=None):
+    def forward_message(self, msg, force=False):
+        """
+        Sends the results out to the master pipeline. We keep a hash of
+        the last forwarded content (in Records.output_hash) and we skip
+        sending the same content again.
+
+        :param: msg - adsmsg.OrcidClaims or a dict (with 'bibcode',
+            'authors' and 'claims')
+        :param: force - bool, forward even if the content is the same
+        :return: the result of the forwarding or None (if skipped)
+        """
+        bibcode, payload = self._get_output(msg)
+        h = content_hash(payload)
+
+        with self.session_scope() as session:
+            r = session.query(Records).filter_by(bibcode=bibcode).first()
+            if r is not None and r.output_hash == h and not force:
+                self.incr_stat('output.unchanged')
+                self.logger.debug('Skipping {0} (the same content was already forwarded)'.format(bibcode))
+                out = None
+            else:
+                out = ADSCelery.forward_message(self, msg)
+            if r is not None:
+                r.output_hash = h
+                self._mark_sent(session, bibcode, payload_hash=h)
+                session.commit()
+            return out
+
+
+    def forward_messages(self, msgs, force=False):
+        """
+        Forwards many results at once; all messages are published through
+        one connection (and channel) and the broker confirms them. Records
+        whose content was already forwarded are skipped (unless forced).
+
+        :param: msgs - list of adsmsg.OrcidClaims (or dicts, see forward_message)
+        :param: force - bool, forward even if the content is the same
+        :return: number of forwarded messages
+        """
+        if not self.forwarding_connection or not self._forward_message:
+            raise NotImplementedError('Sorry, your app is not properly configured.')
+
+        start = time.time()
+        items = collections.OrderedDict()
+        for msg in msgs:
+            bibcode, payload = self._get_output(msg)
+            items[bibcode] = (content_hash(payload), msg) # the last one wins
+
+        sent_hashes = {}
+        with self.session_scope() as session:
+            bibcodes = list(items.keys())
+            for i in range(0, len(bibcodes), 500):
+                for r in session.query(Records.bibcode, Records.output_hash) \
+                        .filter(Records.bibcode.in_(bibcodes[i:i+500])).all():
+                    sent_hashes[r.bibcode] = r.output_hash
+
+        to_send = [(bibcode, h, msg) for bibcode, (h, msg) in items.items()
+                   if force or sent_hashes.get(bibcode, None) != h]
+        self.incr_stat('output.unchanged', len(items) - len(to_send))
+
+        if to_send:
+            conn = BrokerConnection(self._config['OUTPUT_CELERY_BROKER'],
+                                    transport_options={'confirm_publish': True})
+            with conn:
+                producer = self.amqp.Producer(conn, auto_declare=False)
+                for _, _, msg in to_send:
+                    self._forward_message.apply_async((msg,), producer=producer)
+
+            with self.session_scope() as session:
+                for bibcode, h, _ in to_send:
+                    session.query(Records).filter_by(bibcode=bibcode) \
+                        .update({'output_hash': h}, synchronize_session=False)
+                    self._mark_sent(session, bibcode, payload_hash=h)
+                session.commit()
+
+        elapsed = time.time() - start
+        self.incr_stat('output.forwarded', len(to_send))
+        self.logger.info('Forwarded {0} messages (skipped {1}) in {2:.2f}s ({3:.1f} msgs/sec)'.format(
+            len(to_send), len(items) - len(to_send), elapsed, len(to_send) / max(elapsed, 0.001)))
+        return len(to_send)
+
+
+    def _get_output(self, msg):
+        """Returns bibcode and the content (see: output_payload) of a message"""
+        if isinstance(msg, dict):
+            return msg.get('bibcode'), output_payload(msg.get('authors'), msg.get('claims'))
+        return msg.bibcode, output_payload(msg.authors, {'verified': msg.verified,
+                                                         'unverified': msg.unverified})
+
+
+    def _mark_sent(self, session, bibcode, payload_hash=None, max_id=None):
+        """Marks the outbox entries of a record as sent; either all entries
+        up to (and including) max_id or all entries up to the last one
+        that has the given content."""
+        if payload_hash:
+            q = session.query(Outbox.id).filter(and_(Outbox.bibcode == bibcode,
+                                                     Outbox.payload_hash == payload_hash,
+                                                     Outbox.sent == None)) \
+                                        .order_by(Outbox.id.desc()).first()
+            if q is None:
+                return 0
+            max_id = q.id
+        now = get_date()
+        n = session.query(Outbox).filter(and_(Outbox.bibcode == bibcode,
+                                              Outbox.id <= max_id,
+                                              Outbox.sent == None)) \
+                                 .update({'sent': now}, synchronize_session=False)
+        session.query(Records).filter_by(bibcode=bibcode).update({'processed': now}, synchronize_session=False)
+        return n
+
+
+    def drain_outbox(self, batch_size=None, older_than=None, limit=None):
+        """
+        Forwards records that are waiting in the outbox (i.e. they were
+        updated but their new state was never sent out). Every record
+        is sent only once (in its latest state), no matter how many
+        times it was updated.
+
+        :param: batch_size - int, number of outbox entries read at once
+        :param: older_than - int, secs; entries younger than that are left
+            alone (they are likely still travelling through the queues)
+        :param: limit - int, max number of records to forward
+        :return: number of forwarded records
+        """
+        batch_size = batch_size or self._config.get('OUTBOX_BATCH_SIZE', 1000)
+        if older_than is None:
+            older_than = self._config.get('OUTBOX_RELAY_DELAY', 300)
+        cutoff = get_date() - datetime.timedelta(seconds=older_than)
+        num_sent = 0
+        last_id = 0
+
+        while limit is None or num_sent < limit:
+            with self.session_scope() as session:
+                rows = session.query(Outbox.id, Outbox.bibcode).filter(
+                            and_(Outbox.sent == None, Outbox.id > last_id, Outbox.created <= cutoff)) \
+                            .order_by(Outbox.id.asc()).limit(batch_size).all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                max_ids = {}
+                for row in rows:
+                    max_ids[row.bibcode] = row.id
+                recs = [r.toJSON() for r in session.query(Records).filter(
+                            Records.bibcode.in_(list(max_ids.keys()))).all()]
+
+            num_sent += self.forward_messages([OrcidClaims(authors=rec.get('authors'),
+                                                           bibcode=rec['bibcode'],
+                                                           verified=rec.get('claims', {}).get('verified', []),
+                                                           unverified=rec.get('claims', {}).get('unverified', []))
+                                               for rec in recs])
+
+            with self.session_scope() as session:
+                for bibcode, max_id in max_ids.items():
+                    self._mark_sent(session, bibcode, max_id=max_id)
+                session.commit()
+            self.logger.info('Outbox: forwarded {0} records (up to id={1})'.format(num_sent, last_id))
+
+        self.prune_outbox(batch_size=batch_size)
+        return num_sent
+
+
+    def prune_outbox(self, retention=None, batch_size=None):
+        """
+        Deletes the outbox entries that were sent more than `retention`
+        secs ago (OUTBOX_RETENTION); in batches, each in its own
+        transaction.
+
+        :return: number of deleted entries
+        """
+        if retention is None:
+            retention = self._config.get('OUTBOX_RETENTION', 86400)
+        batch_size = batch_size or self._config.get('OUTBOX_BATCH_SIZE', 1000)
+        cutoff = get_date() - datetime.timedelta(seconds=retention)
+        num_deleted = 0
+        while True:
+            with self.session_scope() as session:
+                ids = [r.id for r in session.query(Outbox.id).filter(
+                            and_(Outbox.sent != None, Outbox.sent <= cutoff))
+                            .order_by(Outbox.id.asc()).limit(batch_size).all()]
+                if ids:
+                    session.query(Outbox).filter(Outbox.id.in_(ids)).delete(synchronize_session=False)
+                    session.commit()
+            num_deleted += len(ids)
+            if len(ids) < batch_size:
+                break
+        if num_deleted:
+            self.logger.info('Outbox: deleted {0} sent entries'.format(num_deleted))
+        return num_deleted
+
+
+    def store_record_authors(self, authors):
+        """
+        Saves author lists of (many) records in one go; creates the
+        records if necessary. The claims can then reference the
+        author list by its hash instead of carrying it around.
+
+        :param: authors - dict, keys are bibcodes and values
+            are lists of authors
+        :return: dict, keys are bibcodes and values are hashes
+            of the author lists (see: content_hash)
+        """
+        out = {}
+        bibcodes = list(authors.keys())
+        with self.session_scope() as session:
+            for i in range(0, len(bibcodes), 500):
+                chunk = bibcodes[i:i+500]
+                existing = {}
+                for r in session.query(Records).filter(Records.bibcode.in_(chunk)).all():
+                    existing[r.bibcode] = r
+                for bibcode in chunk:
+                    serialized = json.dumps(authors[bibcode])
+                    r = existing.get(bibcode, None)
+                    if r is None:
+                        r = Records(bibcode=bibcode, authors=serialized)
+                        session.add(r)
+                    elif r.authors != serialized:
+                        r.authors = serialized
+                        # a changed record (see record_claims, optimistic locking)
+                        r.version = (r.version or 0) + 1
+                    out[bibcode] = content_hash(authors[bibcode])
+            session.commit()
+        return out
+
+
+    def resolve_authors(self, bibcode, authors_hash):
+        """
+        Finds the author list that a claim references (by its hash); the
+        list is taken from our own storage and only if it was modified
+        in the meantime, we'll ask the API for the current version.
+
+        :param: bibcode - string
+        :param: authors_hash - string, see content_hash
+        :return: list of authors
+        """
+        with self.session_scope() as session:
+            r = session.query(Records.authors).filter_by(bibcode=bibcode).first()
+            if r is not None and r.authors:
+                authors = json.loads(r.authors)
+                if content_hash(authors) == authors_hash:
+                    return authors
+
+        self.logger.info('Author list of {0} does not match the claim, fetching it from the API'.format(bibcode))
+        metadata = self.retrieve_metadata(bibcode)
+        return metadata.get('author', [])
+
+
+    def record_claims(self, bibcode, claims, authors=None, version=None):
         """
         Stores results of the processing in the database.
 
@@ -693,8 +1460,13 @@ class ADSOrcidCelery(ADSCelery):
         :type: string
         :param: claims
         :type: dict
+        :param: version - version of the record (see Records.toJSON) the
+            claims were computed from; if somebody updated the record
+            since, StaleRecordException is raised (and nothing is written)
+        :type: int
         """
         
+        payload = output_payload(authors, claims)
         claims = json.dumps(claims)
         if authors:
             authors = json.dumps(authors)
@@ -711,14 +1483,149 @@ class ADSOrcidCelery(ADSCelery):
                             )
                 session.add(r)
             else:
-                r.updated = get_date()
-                r.claims = claims
+                expected = r.version if version is None else version
+                values = {'claims': claims, 'updated': get_date(), 'version': (expected or 0) + 1}
                 if authors:
-                    r.authors = authors
-                session.merge(r)
+                    values['authors'] = authors
+                # nobody may have updated the record since it was read
+                if not session.query(Records) \
+                        .filter(and_(Records.id == r.id, Records.version == expected)) \
+                        .update(values, synchronize_session=False):
+                    session.rollback()
+                    self.incr_stat('records.conflict')
+                    raise StaleRecordException('Record {0} was updated meanwhile (expected version {1})'
+                                               .format(bibcode, expected))
+
+            # written in the same transaction, so that the update can't get lost
+            if not authors:
+                payload['authors'] = r.authors and json.loads(r.authors) or []
+            self.add_to_outbox(session, bibcode, payload['authors'], payload)
             session.commit()
 
 
+    def add_to_outbox(self, session, bibcode, authors, claims):
+        """Notes (inside of the current transaction) that the record
+        was updated and its new state has to be forwarded.
+
+        :param: session - the session that updates the record
+        :param: bibcode - string
+        :param: authors - list of authors
+        :param: claims - dict, with 'verified' and 'unverified'
+        """
+        session.add(Outbox(bibcode=bibcode,
+                           payload_hash=content_hash(output_payload(authors, claims))))
+
+
+    def acquire_lease(self, name, ttl, force=False):
+        """
+        Takes the lease (stored in the KeyValue table), so that only
+        one worker does the job at a time. If the lease is held by
+        somebody else, a forced request marks it for an 'upgrade'
+        (the holder will then do the forced version of the job).
+
+        :param: name - string, e.g. 'import:<orcidid>'
+        :param: ttl - int, secs after which the lease expires (if the
+            holder dies without releasing it)
+        :param: force - bool, the job is forced
+        :return: token (string) or None if the lease is held by
+            somebody else
+        """
+        key = 'lease:{0}'.format(name)
+        for _ in range(3):
+            with self.session_scope() as session:
+                kv = session.query(KeyValue).filter_by(key=key).first()
+                current = kv.value if kv is not None else None
+                lease = current and json.loads(current) or None
+
+                if lease and get_date(lease['expires']) > get_date():
+                    if force and not lease.get('force') and not lease.get('upgrade'):
+                        lease['upgrade'] = True
+                        if not self.compare_and_swap(session, key, current, json.dumps(lease)):
+                            continue
+                    return None
+
+                token = uuid.uuid4().hex
+                value = json.dumps({'token': token, 'force': force,
+                                    'expires': (get_date() + datetime.timedelta(seconds=ttl)).isoformat()})
+                if self.compare_and_swap(session, key, current, value):
+                    return token
+        return None
+
+
+    def renew_lease(self, name, token, ttl):
+        """Extends the lease (if it is still ours); the lease doesn't
+        have to be valid anymore, as long as nobody else took it.
+
+        :return: True if the lease was renewed
+        """
+        key = 'lease:{0}'.format(name)
+        with self.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key=key).first()
+            lease = kv and kv.value and json.loads(kv.value) or None
+            if not lease or lease.get('token') != token:
+                return False
+            current = kv.value
+            lease['expires'] = (get_date() + datetime.timedelta(seconds=ttl)).isoformat()
+            return self.compare_and_swap(session, key, current, json.dumps(lease))
+
+
+    def check_lease(self, name, token):
+        """Returns the state of the lease (dict) if still held by the
+        token, otherwise None"""
+        with self.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key='lease:{0}'.format(name)).first()
+            lease = kv and kv.value and json.loads(kv.value) or None
+            if lease and lease.get('token') == token:
+                return lease
+        return None
+
+
+    def release_lease(self, name, token):
+        """
+        Gives up the lease (if it is still held by the token).
+
+        :return: the last state of the lease (dict), e.g. {'upgrade': True}
+            means that a forced request arrived meanwhile; None if
+            the lease wasn't ours (anymore)
+        """
+        key = 'lease:{0}'.format(name)
+        for _ in range(3):
+            with self.session_scope() as session:
+                kv = session.query(KeyValue).filter_by(key=key).first()
+                lease = kv and kv.value and json.loads(kv.value) or None
+                if not lease or lease.get('token') != token:
+                    return None
+                if session.query(KeyValue) \
+                        .filter(and_(KeyValue.key == key, KeyValue.value == kv.value)) \
+                        .delete(synchronize_session=False):
+                    session.commit()
+                    return lease
+        return None
+
+
+    def compare_and_swap(self, session, key, old, new):
+        """Compare-and-swap of the value in the KeyValue table; it is
+        only written if nobody changed it since we read it (old=None
+        means that the key did not exist).
+
+        :return: True if the value was written
+        """
+        if old is None:
+            try:
+                session.add(KeyValue(key=key, value=new))
+                session.commit()
+                return True
+            except IntegrityError:
+                session.rollback()
+                return False
+
+        updated = session.query(KeyValue) \
+            .filter(and_(KeyValue.key == key, KeyValue.value == old)) \
+            .update({'value': new}, synchronize_session=False)
+        session.commit()
+        return updated == 1
+
+
     def mark_processed(self, bibcode):
         """Updates the date on which the record has been processed (i.e.
         something has consumed it
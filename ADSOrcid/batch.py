@@ -0,0 +1,206 @@
+"""
+In-process version of the pipeline for the bulk backfills (run.py
+--local-batch): the profiles are imported by a pool of threads (http
+bound), the claims are matched by a pool of processes (cpu/db bound)
+and the changed records are written to the db and to the outbox, from
+where they are forwarded in bulk. No messages go through the broker.
+
+The stages are connected by bounded queues, so that a fast stage
+doesn't pile up work in the memory. The progress is checkpointed
+(the profiles are processed in the sorted order; the checkpoint is
+the last orcidid up to which everything is done), an interrupted
+run continues from there.
+"""
+
+import concurrent.futures
+import json
+import queue
+import threading
+
+from ADSOrcid import tasks
+from ADSOrcid.models import KeyValue
+
+
+def _init_process():
+    # the forked workers must not share the db connections with the parent
+    if tasks.app._engine is not None:
+        tasks.app._engine.dispose()
+
+
+def _match(claim):
+    """Runs in the process pool."""
+    tasks.match_claim(claim, local=True)
+
+
+class LocalPipeline(object):
+
+    def __init__(self, app, io_workers=8, match_workers=4, queue_size=1000,
+                 checkpoint='local-batch', logger=None):
+        """
+        :param: app - ADSOrcidCelery
+        :param: io_workers - int, threads that import the profiles
+        :param: match_workers - int, processes that match the claims (0: the
+            claims are matched by the main thread)
+        :param: queue_size - int, max number of claims waiting for (or in) matching
+        :param: checkpoint - string, key of the checkpoint (in the KeyValue table)
+        :param: logger
+        """
+        self.app = app
+        self.io_workers = io_workers
+        self.match_workers = match_workers
+        self.queue_size = queue_size
+        self.checkpoint = checkpoint
+        self.logger = logger or app.logger
+        self._lock = threading.RLock()
+
+    def run(self, orcidids, force=True, forward=True):
+        """
+        Imports the profiles (and matches their claims).
+
+        :param: orcidids - iterable of orcid ids
+        :param: force - bool, forced import (see task_index_orcid_profile)
+        :param: forward - bool, forward the changed records when done
+        :return: dict of counters ('profiles', 'claims', 'failed', 'forwarded', ...)
+        """
+        state = self.load_checkpoint()
+        self.last = state['last']
+        orcidids = set(orcidids)
+        # the profiles after the checkpoint, and those that failed the last time
+        self.todo = sorted(o for o in orcidids
+                           if not self.last or o > self.last or o in state['failed'])
+        self.failed = []
+        self.counts = {'profiles': 0, 'claims': 0, 'failed': 0, 'skipped': 0, 'forwarded': 0}
+        self._pending = {}  # orcidid -> number of unfinished parts (the import + its claims)
+        self._finished = set()
+        self._next = 0  # index (into todo) of the first unfinished profile
+        self._feeding = True
+        self._claims = queue.Queue(maxsize=self.queue_size)
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self.logger.info('Local batch: {0} profiles (after checkpoint {1})'.format(len(self.todo), state['last']))
+
+        match_pool = None
+        if self.match_workers:
+            # start the processes before any thread is running
+            match_pool = concurrent.futures.ProcessPoolExecutor(self.match_workers, initializer=_init_process)
+            match_pool.submit(int).result()
+        io_pool = concurrent.futures.ThreadPoolExecutor(self.io_workers)
+        feeder = threading.Thread(target=self._feed, args=(io_pool, force))
+        feeder.daemon = True
+        feeder.start()
+
+        try:
+            while True:
+                try:
+                    orcidid, claim = self._claims.get(timeout=0.1)
+                except queue.Empty:
+                    with self._lock:
+                        if not self._feeding and not self._pending:
+                            break
+                    continue
+                self._slots.acquire()
+                if match_pool is None:
+                    f = concurrent.futures.Future()
+                    try:
+                        _match(claim)
+                        f.set_result(None)
+                    except Exception as e:
+                        f.set_exception(e)
+                else:
+                    f = match_pool.submit(_match, claim)
+                f.add_done_callback(lambda f, orcidid=orcidid: self._claim_done(orcidid, f))
+        finally:
+            feeder.join()
+            io_pool.shutdown()
+            if match_pool is not None:
+                match_pool.shutdown()
+            self.save_checkpoint()
+
+        if forward:
+            self.counts['forwarded'] = self.app.drain_outbox(older_than=0)
+        self.logger.info('Local batch done: {0}'.format(json.dumps(self.counts, sort_keys=True)))
+        return self.counts
+
+    def _feed(self, io_pool, force):
+        """Submits the profiles to the io pool (at most 2 per thread wait there)."""
+        slots = threading.BoundedSemaphore(self.io_workers * 2)
+        try:
+            for orcidid in self.todo:
+                slots.acquire()
+                with self._lock:
+                    self._pending[orcidid] = 1
+                f = io_pool.submit(self._import, orcidid, force)
+                f.add_done_callback(lambda f: slots.release())
+        finally:
+            with self._lock:
+                self._feeding = False
+
+    def _import(self, orcidid, force):
+        """Runs in the io pool."""
+        def submit(claim):
+            with self._lock:
+                self._pending[orcidid] += 1
+                self.counts['claims'] += 1
+            self._claims.put((orcidid, claim))  # blocks while the matching is behind
+
+        ok = True
+        try:
+            if not tasks.import_profile({'orcidid': orcidid, 'force': force}, submit):
+                with self._lock:
+                    self.counts['skipped'] += 1
+        except Exception as e:
+            self.logger.exception('Import of {0} failed: {1}'.format(orcidid, e))
+            ok = False
+        self._part_done(orcidid, ok)
+
+    def _claim_done(self, orcidid, future):
+        self._slots.release()
+        ok = future.exception() is None
+        if not ok:
+            self.logger.error('Claim of {0} failed: {1}'.format(orcidid, future.exception()))
+        self._part_done(orcidid, ok)
+
+    def _part_done(self, orcidid, ok):
+        with self._lock:
+            if not ok and orcidid not in self.failed:
+                self.failed.append(orcidid)
+                self.counts['failed'] += 1
+            self._pending[orcidid] -= 1
+            if self._pending[orcidid]:
+                return
+            del self._pending[orcidid]
+            self._finished.add(orcidid)
+            self.counts['profiles'] += 1
+            moved = False
+            while self._next < len(self.todo) and self.todo[self._next] in self._finished:
+                self._finished.discard(self.todo[self._next])
+                self._next += 1
+                moved = True
+            if moved and self._next % 100 == 0:
+                self.save_checkpoint()
+
+    def load_checkpoint(self):
+        """:return: {'last': orcidid or None, 'failed': [orcidids]}"""
+        with self.app.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key=self.checkpoint).first()
+            if kv is None or not kv.value:
+                return {'last': None, 'failed': []}
+            return json.loads(kv.value)
+
+    def save_checkpoint(self):
+        """Saves the last orcidid up to which all profiles are done (and
+        the profiles that failed, they have to be re-run)."""
+        with self._lock:
+            if self._next == 0 and not self.failed:
+                return
+            if self._next:
+                self.last = max(self.last or '', self.todo[self._next - 1])
+            value = json.dumps({'last': self.last, 'failed': self.failed})
+            with self.app.new_session_scope() as session:
+                session.merge(KeyValue(key=self.checkpoint, value=value))
+                session.commit()
+
+    def reset(self):
+        """Removes the checkpoint (the next run starts from the beginning)."""
+        with self.app.session_scope() as session:
+            session.query(KeyValue).filter_by(key=self.checkpoint).delete(synchronize_session=False)
+            session.commit()
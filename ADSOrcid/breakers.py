@@ -0,0 +1,141 @@
+"""
+Circuit breakers of the remote services (solr, orcid, the orcid
+microservice); the state is kept in the db (KeyValue table, under
+'breaker:<name>') so all workers see it.
+
+    closed -- `failures` consecutive failures --> open
+    open -- after `reset_timeout` secs, one request is let through --> half-open
+    half-open -- success --> closed; failure --> open
+"""
+
+import datetime
+import json
+import threading
+import time
+
+from adsputils import get_date
+
+from ADSOrcid.exceptions import CircuitOpenException
+from ADSOrcid.models import KeyValue
+
+
+DEFAULT_BREAKER = {'failures': 5, 'reset_timeout': 60, 'refresh': 5}
+
+
+class CircuitBreakers(object):
+    """Breakers of the endpoints; the http client asks them before every
+    request (check) and reports the outcome (record)."""
+
+    def __init__(self, app, config, stats=None, logger=None):
+        """
+        :param: app - provides new_session_scope() and compare_and_swap()
+        :param: config - dict, the breakers are configured by CIRCUIT_BREAKERS,
+            e.g. {'solr': {'endpoints': ['API_SOLR_QUERY_ENDPOINT'], 'failures': 5}}
+        :param: stats - Counter (the rejected requests are counted there)
+        :param: logger
+        """
+        self.app = app
+        self.stats = stats
+        self.logger = logger
+        self._lock = threading.RLock()
+        self._cache = {}  # name -> (time of reading, state)
+        self.breakers = {}
+        self.prefixes = []
+        for name, opts in (config.get('CIRCUIT_BREAKERS', {}) or {}).items():
+            b = dict(DEFAULT_BREAKER)
+            b.update(opts)
+            self.breakers[name] = b
+            for key in b.get('endpoints', []):
+                if config.get(key):
+                    self.prefixes.append((config[key].split('%')[0], name))
+        self.prefixes.sort(key=lambda x: len(x[0]), reverse=True)
+
+    def get_name(self, url):
+        """Returns the name of the breaker that guards the url (or None)."""
+        for prefix, name in self.prefixes:
+            if url.startswith(prefix):
+                return name
+        return None
+
+    def get_state(self, name, fresh=False):
+        """Returns the state of the breaker (dict with 'state', 'failures'
+        and 'until'); it is re-read from the db every `refresh` secs."""
+        with self._lock:
+            read, state = self._cache.get(name, (0, None))
+            if fresh or time.time() - read > self.breakers[name]['refresh']:
+                state = self._load(name)[1]
+                self._cache[name] = (time.time(), state)
+            return state
+
+    def check(self, url):
+        """Raises CircuitOpenException when the breaker of the url is open."""
+        name = self.get_name(url)
+        if name is None:
+            return
+        state = self.get_state(name)
+        if state['state'] == 'closed':
+            return
+        until = get_date(state['until'])
+        if until > get_date() or not self._probe(name):
+            if self.stats is not None:
+                self.stats['breaker.{0}.rejected'.format(name)] += 1
+            retry_in = max((until - get_date()).total_seconds(), 1)
+            raise CircuitOpenException(name, retry_in)
+
+    def record(self, url, ok):
+        """Notes the outcome of the request (after all the retries)."""
+        name = self.get_name(url)
+        if name is None:
+            return
+        state = self.get_state(name)
+        if ok and state['state'] == 'closed' and not state['failures']:
+            return  # the usual case, nothing to write
+        for _ in range(3):
+            current, state = self._load(name)
+            new = dict(state)
+            if ok:
+                new.update({'state': 'closed', 'failures': 0, 'until': None})
+            else:
+                new['failures'] = state['failures'] + 1
+                if state['state'] == 'half-open' or new['failures'] >= self.breakers[name]['failures']:
+                    new['state'] = 'open'
+                    new['until'] = self._until(name)
+            if new == state or self._save(name, current, new):
+                if new['state'] != state['state'] and self.logger:
+                    self.logger.warning('Circuit breaker {0}: {1} -> {2}'.format(name, state['state'], new['state']))
+                with self._lock:
+                    self._cache[name] = (time.time(), new)
+                return
+
+    def states(self):
+        """Returns the (fresh) states of all the breakers, {name: state}."""
+        return dict([(name, self.get_state(name, fresh=True)) for name in self.breakers])
+
+    def _probe(self, name):
+        """The breaker is open but its time is up; only one request (of all
+        the workers) gets through to test the service (half-open)."""
+        current, state = self._load(name)
+        if state['state'] == 'closed':
+            return True
+        if state['until'] and get_date(state['until']) > get_date():
+            return False
+        new = dict(state, state='half-open', until=self._until(name))
+        if self._save(name, current, new):
+            with self._lock:
+                self._cache[name] = (time.time(), new)
+            return True
+        return False
+
+    def _until(self, name):
+        return (get_date() + datetime.timedelta(seconds=self.breakers[name]['reset_timeout'])).isoformat()
+
+    def _load(self, name):
+        with self.app.new_session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key='breaker:{0}'.format(name)).first()
+            current = kv.value if kv is not None else None
+        state = current and json.loads(current) or {'state': 'closed', 'failures': 0, 'until': None}
+        return current, state
+
+    def _save(self, name, current, new):
+        with self.app.new_session_scope() as session:
+            return self.app.compare_and_swap(session, 'breaker:{0}'.format(name), current, json.dumps(new))
@@ -0,0 +1,240 @@
+"""
+Buffers that hold messages inside of a worker for a short
+while and send them out in bulk (or only their latest version).
+"""
+
+import collections
+import threading
+import time
+
+
+def _get_bibcode(msg):
+    if isinstance(msg, dict):
+        return msg.get('bibcode')
+    return msg.bibcode
+
+
+class _TimedBuffer(object):
+    """Common parts of the buffers: the lock, the pending items and
+    the timer that flushes them after `window` seconds."""
+
+    def __init__(self, window=10, maxsize=1000, stats=None, logger=None):
+        self.window = window
+        self.maxsize = maxsize
+        self.stats = stats if stats is not None else collections.Counter()
+        self.logger = logger
+        self._lock = threading.RLock()
+        self._pending = collections.OrderedDict()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self, force=False):
+        raise NotImplementedError()
+
+    def _timer_fired(self):
+        with self._lock:
+            if self._timer is threading.current_thread():
+                self._timer = None
+
+    def _schedule(self, delay=None):
+        """Makes sure a timer will flush the buffer when the oldest
+        item expires."""
+        with self._lock:
+            if not self.window or not self._pending or \
+                    (self._timer is not None and self._timer.is_alive()):
+                return
+            if delay is None:
+                first_seen = next(iter(self._pending.values()))[0]
+                delay = max(first_seen + self.window - time.time(), 0.1)
+            self._timer = threading.Timer(delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+
+class OutputCoalescer(_TimedBuffer):
+    """Collects the results (OrcidClaims) by bibcode and forwards only
+    the latest state of every record, once it has been waiting for
+    `window` seconds. When many claims for the same paper get verified
+    in a short succession (e.g. all co-authors are reindexed), the
+    master pipeline receives one update instead of hundreds.
+
+    The buffer lives in the worker's memory: call flush(force=True)
+    before the process exits (see the signals in tasks.py).
+    """
+
+    def __init__(self, forward, window=10, maxsize=1000, stats=None, logger=None):
+        """
+        :param: forward - callable, receives a message that should be sent out
+        :param: window - int, number of seconds the messages are held in the
+            buffer; if 0, messages are forwarded immediately
+        :param: maxsize - int, maximum number of records in the buffer; when
+            reached, everything is forwarded
+        :param: stats - collections.Counter, where the counters are kept
+        """
+        _TimedBuffer.__init__(self, window=window, maxsize=maxsize, stats=stats, logger=logger)
+        self.forward = forward
+
+    def add(self, msg, force=False):
+        """Puts the message into the buffer; an older message for the
+        same bibcode (if present) will be discarded.
+
+        :param: force - bool, the message will be forwarded with force=True
+            (if any of the coalesced messages was forced)
+        """
+        self.stats['output.received'] += 1
+        if not self.window or self.window <= 0:
+            self._forward(msg, force)
+            self.stats['output.forwarded'] += 1
+            return
+
+        bibcode = _get_bibcode(msg)
+        with self._lock:
+            if bibcode in self._pending:
+                first_seen, _, forced = self._pending[bibcode]
+                force = force or forced
+                self.stats['output.coalesced'] += 1
+            else:
+                first_seen = time.time()
+            self._pending[bibcode] = (first_seen, msg, force)
+            full = len(self._pending) >= self.maxsize
+
+        if full:
+            self.flush(force=True)
+        else:
+            self._schedule()
+
+    def flush(self, force=False):
+        """Forwards messages that waited long enough (or all of them
+        if force=True).
+
+        :return: number of forwarded messages
+        """
+        self._timer_fired()
+        now = time.time()
+        forwarded = 0
+        failed = False
+        with self._lock:
+            for bibcode, (first_seen, msg, forced) in list(self._pending.items()):
+                if not force and now - first_seen < self.window:
+                    break # the rest is younger
+                try:
+                    self._forward(msg, forced)
+                except Exception as e:
+                    # keep it (and everything after it) for the next try
+                    if self.logger:
+                        self.logger.error('Error forwarding {0}: {1}'.format(bibcode, e))
+                    failed = True
+                    break
+                del self._pending[bibcode]
+                forwarded += 1
+            self.stats['output.forwarded'] += forwarded
+
+        if forwarded and self.logger:
+            self.logger.info('Output buffer: forwarded={0} coalesced={1} pending={2}'.format(
+                self.stats['output.forwarded'], self.stats['output.coalesced'], len(self._pending)))
+        self._schedule(failed and self.window or None)
+        return forwarded
+
+    def _forward(self, msg, force):
+        if force:
+            self.forward(msg, force=True)
+        else:
+            self.forward(msg)
+
+
+class StatusBatch(_TimedBuffer):
+    """Groups the status updates (of claims inside the orcid microservice)
+    by orcidid and status; every group is then sent in one request instead
+    of one request per work.
+
+    With window=0, nothing happens automatically: the owner calls flush()
+    (e.g. at the end of a profile).
+    """
+
+    def __init__(self, send, window=0, maxsize=100, retries=2, retry_delay=0.5,
+                 stats=None, logger=None):
+        """
+        :param: send - callable(orcidid, status, ids), returns the http response
+        :param: window - int, number of seconds the updates wait before they are
+            sent (0 means until flush() is called)
+        :param: maxsize - int, max number of works waiting in the batch
+        :param: retries - int, how many times a failed request is repeated
+        :param: retry_delay - float, secs to wait before the first retry (it
+            doubles with every next attempt)
+        """
+        _TimedBuffer.__init__(self, window=window, maxsize=maxsize, stats=stats, logger=logger)
+        self.send = send
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._size = 0
+
+    def add(self, orcidid, ids, status):
+        """Adds the identifiers (of one work) to the batch.
+
+        :param: orcidid - string
+        :param: ids - list of identifiers of the work (bibcodes, dois...)
+        :param: status - string, e.g. 'verified', 'rejected', 'not in ADS'
+        """
+        with self._lock:
+            group = self._pending.setdefault((orcidid, status), (time.time(), []))
+            group[1].append(list(ids))
+            self._size += 1
+            full = self._size >= self.maxsize
+
+        if full:
+            self.flush()
+        else:
+            self._schedule()
+
+    def flush(self, force=True):
+        """Sends all groups (one request each).
+
+        :return: number of works whose status was updated
+        """
+        self._timer_fired()
+        with self._lock:
+            groups = list(self._pending.items())
+            self._pending.clear()
+            self._size = 0
+
+        updated = 0
+        for (orcidid, status), (_, works) in groups:
+            ids = []
+            for w in works:
+                for x in w:
+                    if x not in ids:
+                        ids.append(x)
+
+            r = self._send(orcidid, status, ids)
+            self.stats['status.requests'] += 1
+            if r is None or r.status_code != 200:
+                self.stats['status.failed'] += len(works)
+                if self.logger:
+                    self.logger.warning('IDs {ids} for {orcidid} not updated to: {status}'
+                                        .format(ids=ids, orcidid=orcidid, status=status))
+                continue
+
+            updated += len(works)
+            self.stats['status.updated'] += len(works)
+            if len(r.json()) != len(works) and self.logger:
+                self.logger.warning('Number of updated bibcodes ({0}) does not match input ({1}) for {2}'
+                                    .format(r.text, ids, orcidid))
+        return updated
+
+    def _send(self, orcidid, status, ids):
+        r = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                r = self.send(orcidid, status, ids)
+            except Exception as e:
+                if self.logger:
+                    self.logger.warning('Error updating status of {0}: {1}'.format(orcidid, e))
+                r = None
+                continue
+            if r.status_code == 200 or (r.status_code < 500 and r.status_code != 429):
+                break
+        return r
@@ -0,0 +1,149 @@
+"""
+Memoization caches shared by all threads (greenlets) of a worker.
+"""
+
+import functools
+import threading
+import time
+
+import cachetools
+from cachetools.keys import hashkey
+
+
+class _TTLCache(cachetools.TTLCache):
+    """TTLCache that counts the items it had to drop."""
+
+    def __init__(self, maxsize, ttl, timer=time.time):
+        cachetools.TTLCache.__init__(self, maxsize, ttl, timer=timer)
+        self.evictions = 0
+        self.expirations = 0
+
+    def popitem(self):
+        item = cachetools.TTLCache.popitem(self)
+        self.evictions += 1
+        return item
+
+    def expire(self, time=None):
+        size = cachetools.Cache.__len__(self)
+        cachetools.TTLCache.expire(self, time)
+        self.expirations += size - cachetools.Cache.__len__(self)
+
+
+class MemoCache(object):
+    """Thread-safe TTL cache with stampede protection: when many threads
+    ask for the same missing key, only one of them computes the value,
+    the others wait for it.
+
+    The size and ttl are read (once) from the app config, from the
+    CACHES dictionary, e.g. CACHES = {'metadata': {'maxsize': 2048, 'ttl': 3600}}
+    """
+
+    def __init__(self, name, maxsize=1024, ttl=3600, wait_timeout=60):
+        """
+        :param: name - string, name of the cache (in config and stats)
+        :param: maxsize - int, default number of items
+        :param: ttl - int, default time-to-live (secs) of the items
+        :param: wait_timeout - int, max secs a thread waits for the value
+            computed by another thread (afterwards it computes it itself)
+        """
+        self.name = name
+        self.wait_timeout = wait_timeout
+        self.hits = self.misses = self.waits = 0
+        self.configured = False
+        self._lock = threading.RLock()
+        self._inflight = {}
+        self._cache = _TTLCache(maxsize, ttl)
+
+    def configure(self, config):
+        """Sets the size and ttl from the config (dict); the cache is emptied."""
+        opts = (config.get('CACHES') or {}).get(self.name, {})
+        with self._lock:
+            self._cache = _TTLCache(opts.get('maxsize', self._cache.maxsize),
+                                    opts.get('ttl', self._cache.ttl))
+            self.configured = True
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._cache.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            try:
+                self._cache[key] = value
+            except ValueError:
+                pass  # value too large
+
+    def setdefault(self, key, value):
+        with self._lock:
+            return self._cache.setdefault(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._cache
+
+    def get_or_compute(self, key, func, *args, **kwargs):
+        """Returns the cached value, or computes it by calling func(*args, **kwargs);
+        only one thread computes the value for the key at a time."""
+        with self._lock:
+            try:
+                value = self._cache[key]
+                self.hits += 1
+                return value
+            except KeyError:
+                pass
+            event = self._inflight.get(key)
+            if event is None:
+                event = self._inflight[key] = threading.Event()
+                self.misses += 1
+                owner = True
+            else:
+                self.waits += 1
+                owner = False
+
+        if not owner:
+            event.wait(self.wait_timeout)
+            with self._lock:
+                try:
+                    return self._cache[key]
+                except KeyError:
+                    pass  # the other thread failed
+            return func(*args, **kwargs)
+
+        try:
+            value = func(*args, **kwargs)
+            self.set(key, value)
+            return value
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def stats(self):
+        """Returns the counters of the cache (dict)."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'waits': self.waits,
+                    'evictions': self._cache.evictions, 'expirations': self._cache.expirations,
+                    'size': len(self._cache)}
+
+
+def memoize(cache):
+    """Decorator of the app methods; the results are kept in the cache
+    (keyed by the arguments, without the app). The cache is configured
+    from the app config when first used."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not cache.configured:
+                cache.configure(self._config)
+            return cache.get_or_compute(hashkey(*args, **kwargs), func, self, *args, **kwargs)
+        wrapper.cache = cache
+        return wrapper
+    return decorator
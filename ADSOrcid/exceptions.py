@@ -9,4 +9,18 @@ class ProcessingException(Exception):
     ErrorHandler."""
     pass
 
-        
\ No newline at end of file
+        
+
+class StaleRecordException(Exception):
+    """The record was updated by somebody else since we
+    read it."""
+    pass
+
+
+class CircuitOpenException(Exception):
+    """The remote service is failing (its circuit breaker is
+    open); try again in `retry_in` secs."""
+    def __init__(self, name, retry_in):
+        Exception.__init__(self, 'Circuit breaker {0} is open (retry in {1:.0f}s)'.format(name, retry_in))
+        self.name = name
+        self.retry_in = retry_in
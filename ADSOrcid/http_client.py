@@ -0,0 +1,125 @@
+"""
+HTTP client that retries the requests which failed for a transient
+reason (5xx, 429, connection errors and timeouts).
+"""
+
+import collections
+import email.utils
+import random
+import time
+
+import requests
+
+
+DEFAULT_POLICY = {'retries': 3, 'backoff': 0.5, 'max_backoff': 10, 'timeout': 30}
+
+
+def policies_from_config(config):
+    """Builds the retry policies from the config (HTTP_RETRY); the keys
+    are names of the config values with the endpoint urls (or 'default').
+
+    :return: list of (url prefix, policy), the longest prefixes first;
+        the default policy has the prefix ''
+    """
+    opts = config.get('HTTP_RETRY', {}) or {}
+    default = dict(DEFAULT_POLICY)
+    default.update(opts.get('default', {}))
+    out = [('', default)]
+    for key, policy in opts.items():
+        url = config.get(key)
+        if key == 'default' or not url:
+            continue
+        p = dict(default)
+        p.update(policy)
+        out.append((url.split('%')[0], p))
+    return sorted(out, key=lambda x: len(x[0]), reverse=True)
+
+
+def retry_after(response):
+    """Returns the secs (float) the server asks us to wait (the Retry-After
+    header, in secs or as a http date), or None."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(email.utils.mktime_tz(date) - time.time(), 0)
+
+
+class RetryingSession(requests.Session):
+    """requests.Session that retries the failed requests according to
+    the policy of the endpoint: exponential backoff with jitter (or
+    as long as the server says in Retry-After, but never longer than
+    max_backoff). When the retries are exhausted, the last response
+    is returned (or the last error raised), just like without the
+    retries.
+
+    If the endpoint is guarded by a circuit breaker (see breakers.py),
+    the request fails with CircuitOpenException while it is open.
+    """
+
+    def __init__(self, policies=None, stats=None, logger=None, breakers=None):
+        """
+        :param: policies - list of (url prefix, policy), see policies_from_config
+        :param: stats - Counter, where the retries are counted
+        :param: logger
+        :param: breakers - breakers.CircuitBreakers (optional)
+        """
+        requests.Session.__init__(self)
+        self.policies = policies or [('', dict(DEFAULT_POLICY))]
+        self.breakers = breakers
+        self.stats = stats if stats is not None else collections.Counter()
+        self.logger = logger
+
+    def get_policy(self, url):
+        for prefix, policy in self.policies:
+            if url.startswith(prefix):
+                return policy
+        return DEFAULT_POLICY
+
+    def request(self, method, url, **kwargs):
+        if self.breakers is None:
+            return self._request(method, url, **kwargs)
+
+        self.breakers.check(url)
+        try:
+            r = self._request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.breakers.record(url, False)
+            raise
+        self.breakers.record(url, r.status_code < 500 and r.status_code != 429)
+        return r
+
+    def _request(self, method, url, **kwargs):
+        policy = self.get_policy(url)
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = policy['timeout']
+
+        attempt = 0
+        while True:
+            try:
+                r = requests.Session.request(self, method, url, **kwargs)
+                if (r.status_code < 500 and r.status_code != 429) or attempt >= policy['retries']:
+                    return r
+                wait = retry_after(r)
+                error = r.status_code
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= policy['retries']:
+                    raise
+                wait = None
+                error = e.__class__.__name__
+
+            if wait is None:
+                backoff = policy['backoff'] * 2 ** attempt
+                wait = random.uniform(backoff / 2.0, backoff)
+            wait = min(wait, policy['max_backoff'])
+            attempt += 1
+            self.stats['http.retries'] += 1
+            if self.logger:
+                self.logger.warning('{0} {1} failed ({2}), retry {3}/{4} in {5:.1f}s'.format(
+                    method, url, error, attempt, policy['retries'], wait))
+            time.sleep(wait)
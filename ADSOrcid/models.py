@@ -51,6 +51,22 @@ class ClaimsLog(Base):
                 }
     
     
+class ClaimState(Base):
+    """The latest claim of the author for the bibcode (since the last
+    full import); it is kept up to date with the claims log (in the same
+    transaction), see ADSOrcidCelery.get_known_claims."""
+    __tablename__ = 'claim_state'
+    orcidid = Column(String(19), primary_key=True)
+    bibcode = Column(String(19), primary_key=True)
+    status = Column(Enum('claimed', 'updated', 'removed', 'unchanged', 'forced', name='status'))
+    created = Column(UTCDateTime, default=get_date)
+
+    def toJSON(self):
+        return {'orcidid': self.orcidid, 'bibcode': self.bibcode, 'status': self.status,
+                'created': self.created and get_date(self.created).isoformat() or None
+                }
+
+
 class Records(Base):
     __tablename__ = 'records'
     id = Column(Integer, primary_key=True)
@@ -61,6 +77,8 @@ class Records(Base):
     updated = Column(UTCDateTime, default=get_date)
     processed = Column(UTCDateTime)
     status = Column(String(255))
+    output_hash = Column(String(40))
+    version = Column(Integer, default=0, server_default='0')
     
     def toJSON(self):
         return {'id': self.id, 'bibcode': self.bibcode,
@@ -72,6 +90,24 @@ class Records(Base):
                 }
 
 
+class Outbox(Base):
+    """Records that were updated and need to be forwarded; the
+    rows are written in the same transaction as the record."""
+    __tablename__ = 'outbox'
+    id = Column(Integer, primary_key=True)
+    bibcode = Column(String(19))
+    payload_hash = Column(String(40))
+    created = Column(UTCDateTime, default=get_date)
+    sent = Column(UTCDateTime)
+
+    def toJSON(self):
+        return {'id': self.id, 'bibcode': self.bibcode,
+                'payload_hash': self.payload_hash,
+                'created': self.created and get_date(self.created).isoformat() or None,
+                'sent': self.sent and get_date(self.sent).isoformat() or None
+                }
+
+
 class ChangeLog(Base):
     __tablename__ = 'change_log'
     id = Column(Integer, primary_key=True)
@@ -3,11 +3,26 @@ import adsputils
 from adsmsg import OrcidClaims
 from ADSOrcid import app as app_module
 from ADSOrcid import updater
-from ADSOrcid.exceptions import ProcessingException, IgnorableException
+from ADSOrcid.exceptions import (
+    CircuitOpenException,
+    IgnorableException,
+    ProcessingException,
+    StaleRecordException,
+)
 from ADSOrcid.models import KeyValue
+from celery import chord
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import (
+    before_task_publish,
+    task_prerun,
+    worker_process_shutdown,
+    worker_shutdown,
+)
 from kombu import Queue
 import datetime
 import os
+import random
+import time
 
 # ============================= INITIALIZATION ==================================== #
 
@@ -22,14 +37,99 @@ app.conf.CELERY_QUEUES = (
     Queue("match-claim", app.exchange, routing_key="match-claim"),
     Queue("check-updates", app.exchange, routing_key="check-updates"),
     Queue("output-results", app.exchange, routing_key="output-results"),
+    # the low-priority lane (bulk reindexing), served by separate workers
+    Queue("check-orcidid-bulk", app.exchange, routing_key="check-orcidid-bulk"),
+    Queue("match-claim-bulk", app.exchange, routing_key="match-claim-bulk"),
+    Queue("output-results-bulk", app.exchange, routing_key="output-results-bulk"),
 )
+
+# claims of the same record always go into the same partition (queue) of
+# match-claim, each partition is consumed by one worker (see route_by_lane)
+MATCH_CLAIM_PARTITIONS = app.conf.get("MATCH_CLAIM_PARTITIONS", 1)
+if MATCH_CLAIM_PARTITIONS > 1:
+    app.conf.CELERY_QUEUES += tuple(
+        Queue(name, app.exchange, routing_key=name)
+        for lane in ("match-claim", "match-claim-bulk")
+        for name in [
+            "{0}-{1}".format(lane, i) for i in range(MATCH_CLAIM_PARTITIONS)
+        ]
+    )
 logger = app.logger
 
+BULK_LANE = "bulk"
+
+# queues of the tasks that have two lanes (see route_by_lane)
+LANE_QUEUES = {
+    "task_index_orcid_profile": "check-orcidid",
+    "task_resolve_works": "check-orcidid",
+    "task_merge_works": "check-orcidid",
+    "task_match_claim": "match-claim",
+    "task_output_results": "output-results",
+}
+
+
+def route_by_lane(name, args, kwargs, options, task=None, **kw):
+    """Sends messages of the bulk lane (the payload, or the task kwargs,
+    contain 'lane': 'bulk') into the '-bulk' queue of the task; so that
+    a large reindex doesn't delay the interactive requests.
+
+    The claims are further partitioned by the (consistent) hash of the
+    bibcode when MATCH_CLAIM_PARTITIONS > 1, e.g. 'match-claim-bulk-3'."""
+    task_name = name.split(".")[-1]
+    queue = LANE_QUEUES.get(task_name)
+    if not queue:
+        return None
+    payload = args[0] if args and isinstance(args[0], dict) else {}
+    lane = (kwargs or {}).get("lane")
+    if lane is None:
+        lane = payload.get("lane")
+    if lane == BULK_LANE:
+        queue += "-bulk"
+    if (
+        task_name == "task_match_claim"
+        and MATCH_CLAIM_PARTITIONS > 1
+        and payload.get("bibcode")
+    ):
+        queue += "-{0}".format(
+            app_module.jump_hash(payload["bibcode"], MATCH_CLAIM_PARTITIONS)
+        )
+    return {"queue": queue}
+
+
+app.conf.CELERY_ROUTES = (route_by_lane,)
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_buffers(**kwargs):
+    """Sends out whatever is still waiting in the buffers."""
+    app.output_buffer.flush(force=True)
+    app.status_batch.flush()
+    app.log_stats(force=True)
+
+
+@task_prerun.connect
+def measure_latency(task=None, **kwargs):
+    """Counts the time the messages waited in their queue (per queue,
+    i.e. per lane); the mean is latency.<queue> / received.<queue>"""
+    queued_at = getattr(task.request, "queued_at", None)
+    queue = (getattr(task.request, "delivery_info", None) or {}).get("routing_key")
+    if queued_at and queue:
+        app.incr_stat("received.{0}".format(queue))
+        app.incr_stat("latency.{0}".format(queue), max(time.time() - queued_at, 0))
+
+
+@before_task_publish.connect
+def stamp_message(headers=None, **kwargs):
+    """Notes when the message was sent (see measure_latency)."""
+    if headers is not None:
+        headers.setdefault("queued_at", time.time())
+
 
 # ============================= TASKS ============================================= #
 
 
-@app.task(queue="check-orcidid")
+@app.task()  # queue: see route_by_lane
 def task_index_orcid_profile(message):
     """
     Fetch a fresh profile from the orcid-service and compare
@@ -44,6 +144,12 @@ def task_index_orcid_profile(message):
              the moment we checked the orcid-service'
          'force': Boolean (if present, we'll not skip unchanged
              profile)
+         'updated': 'ISO8801 formatted date (optional), when the
+             profile was updated (according to the orcid-service)'
+         'lane': 'bulk' (optional), the low-priority lane; the claims
+             of the profile will follow the same lane
+         'resume': Boolean (optional), continuation of an import that
+             ran out of time (then 'start' is when it began)
         }
     :return: no return
     """
@@ -51,7 +157,110 @@ def task_index_orcid_profile(message):
     if "orcidid" not in message:
         raise IgnorableException("Received garbage: {}".format(message))
 
-    message["start"] = adsputils.get_date()
+    # the message waited in the queue and a newer import already took place
+    if message.get("updated") and not message.get("force", False):
+        last_import = app.get_last_import(message["orcidid"])
+        if last_import and last_import >= adsputils.get_date(message["updated"]):
+            app.incr_stat("import.stale")
+            logger.info(
+                "Skipping {0} (updated {1}, already imported {2})".format(
+                    message["orcidid"], message["updated"], last_import.isoformat()
+                )
+            )
+            return
+
+    # only one import of the same profile can run at a time; the
+    # duplicate requests are dropped (a forced one upgrades the
+    # running import)
+    orcidid = message["orcidid"]
+    lease = "import:{0}".format(orcidid)
+    token = app.acquire_lease(
+        lease, app.conf.get("IMPORT_LEASE_TTL", 3600), force=message.get("force", False)
+    )
+    if token is None:
+        app.incr_stat("import.coalesced")
+        logger.info("Import of {0} is already running, skipping".format(orcidid))
+        return
+
+    resume = handed_over = False
+    countdown = None
+    try:
+        handed_over = _index_orcid_profile(message, lease, token)
+    except SoftTimeLimitExceeded:
+        resume = True
+    except CircuitOpenException as e:
+        # a service we need is failing, don't wait for it; try later
+        app.incr_stat("import.deferred")
+        logger.info("{0}, deferring import of {1}".format(e, orcidid))
+        resume = True
+        countdown = e.retry_in
+    finally:
+        if not handed_over:
+            _release_import(message, lease, token, resume=resume, countdown=countdown)
+
+
+def _release_import(message, lease, token, resume=False, countdown=None):
+    """Releases the lease of the import and enqueues its continuation
+    (resume=True, after countdown secs) or the forced import requested
+    meanwhile."""
+    orcidid = message["orcidid"]
+    state = app.release_lease(lease, token)
+    upgrade = state and state.get("upgrade") and not message.get("force", False)
+    if resume:
+        # the progress was saved (see app.get_claims), continue in a new task
+        app.incr_stat("import.resumed")
+        logger.info("Import of {0} interrupted, resuming".format(orcidid))
+        start = message.get("start") or adsputils.get_date()
+        payload = dict(message, start=start.isoformat(), resume=True)
+        if upgrade:
+            payload["force"] = True
+        task_index_orcid_profile.apply_async((payload,), countdown=countdown)
+    elif upgrade:
+        # the forced request arrived too late to be applied
+        payload = {"orcidid": orcidid, "force": True}
+        if message.get("lane"):
+            payload["lane"] = message["lane"]
+        task_index_orcid_profile.delay(payload)
+
+
+def import_profile(message, submit):
+    """Imports the profile in this process (run.py --local-batch): like
+    task_index_orcid_profile, but the claims are given to submit(claim)
+    and nothing is re-queued (the errors are raised).
+
+    :return: False if the profile is being imported by somebody else
+    """
+    orcidid = message["orcidid"]
+    lease = "import:{0}".format(orcidid)
+    token = app.acquire_lease(
+        lease, app.conf.get("IMPORT_LEASE_TTL", 3600), force=message.get("force", False)
+    )
+    if token is None:
+        app.incr_stat("import.coalesced")
+        return False
+    try:
+        _index_orcid_profile(message, lease, token, submit=submit, parallel=False)
+    finally:
+        app.release_lease(lease, token)
+    return True
+
+
+def _index_orcid_profile(message, lease, token, submit=None, parallel=True):
+    """Does the import of the profile (see task_index_orcid_profile),
+    the caller holds the lease.
+
+    :param submit: callable that receives the claims (default:
+        task_match_claim.delay)
+    :param parallel: False if the works may not be resolved by a chord
+    :return: True if the works are resolved in parallel (by a chord
+        of task_resolve_works); then task_merge_works finishes the
+        import and releases the lease
+    """
+
+    if message.get("resume") and message.get("start"):
+        message["start"] = adsputils.get_date(message["start"])
+    else:
+        message["start"] = adsputils.get_date()
     orcidid = message["orcidid"]
     author = app.retrieve_orcid(orcidid)
 
@@ -66,19 +275,133 @@ def task_index_orcid_profile(message):
     if r.status_code != 200:
         logger.warning("Profile for {0} not updated.".format(orcidid))
 
-    orcid_present, updated, removed = app.get_claims(
-        orcidid,
-        app.conf.get("API_TOKEN"),
-        app.conf.get("API_ORCID_EXPORT_PROFILE") % orcidid,
-        force=message.get("force", False),
-        orcid_identifiers_order=app.conf.get(
-            "ORCID_IDENTIFIERS_ORDER", {"bibcode": 9, "*": -1}
-        ),
+    # large profiles are split between many workers
+    min_works = parallel and app.conf.get("IMPORT_PARALLEL_MIN_WORKS", 0) or 0
+    profile = None
+    if min_works:
+        profile = app.get_profile_works(
+            orcidid,
+            app.conf.get("API_TOKEN"),
+            app.conf.get("API_ORCID_EXPORT_PROFILE") % orcidid,
+            force=message.get("force", False),
+        )
+        if profile and len(profile[0]) >= min_works:
+            _resolve_works_in_parallel(message, token, profile)
+            return True
+
+    if min_works and profile is None:
+        orcid_present, updated, removed = {}, {}, {}  # skipped
+    else:
+        orcid_present, updated, removed = app.get_claims(
+            orcidid,
+            app.conf.get("API_TOKEN"),
+            app.conf.get("API_ORCID_EXPORT_PROFILE") % orcidid,
+            force=message.get("force", False),
+            orcid_identifiers_order=app.conf.get(
+                "ORCID_IDENTIFIERS_ORDER", {"bibcode": 9, "*": -1}
+            ),
+            resume=True,
+            profile=profile,
+        )
+
+    _import_claims(
+        message, author, lease, token, orcid_present, updated, removed, submit=submit
+    )
+    return False
+
+
+def _resolve_works_in_parallel(message, token, profile):
+    """Splits the works of the profile into chunks (IMPORT_CHUNK_SIZE)
+    resolved by task_resolve_works; the chord callback (task_merge_works)
+    receives the lease of the import."""
+    orcidid = message["orcidid"]
+    works, version, _ = profile
+    lane = message.get("lane")
+    chunk_size = app.conf.get("IMPORT_CHUNK_SIZE", 50)
+    header = [
+        task_resolve_works.s(orcidid, works[i : i + chunk_size], version, lane=lane)
+        for i in range(0, len(works), chunk_size)
+    ]
+    payload = dict(message, start=message["start"].isoformat())
+    app.incr_stat("import.parallel")
+    logger.info(
+        "Resolving {0} works of {1} in {2} tasks".format(len(works), orcidid, len(header))
     )
+    chord(header)(task_merge_works.s(payload, token, lane=lane))
+
+
+@app.task()  # queue: see route_by_lane
+def task_resolve_works(orcidid, works, version, lane=None):
+    """
+    Finds the records of a slice of the works of the profile (the
+    parallel import, see _index_orcid_profile)
+
+    :param orcidid: string
+    :param works: list of works (as they come in the profile)
+    :param version: int, version of the orcid API
+    :param lane: 'bulk' if the import belongs to the low-priority lane
+    :return: the resolved works (see app_module.dump_works)
+    """
+    try:
+        orcid_present = app.resolve_works(
+            orcidid,
+            works,
+            version,
+            app.conf.get("ORCID_IDENTIFIERS_ORDER", {"bibcode": 9, "*": -1}),
+        )
+    except CircuitOpenException as e:
+        app.incr_stat("import.deferred")
+        raise task_resolve_works.retry(exc=e, countdown=e.retry_in, max_retries=None)
+    return app_module.dump_works(orcid_present)
+
+
+@app.task()  # queue: see route_by_lane
+def task_merge_works(results, message, token, lane=None):
+    """
+    Callback of the parallel import: joins the works resolved by
+    task_resolve_works, does the diff against the claims we have
+    and sends the claims to task_match_claim. The lease of the
+    import (token) is released when done.
+
+    :param results: list of the results of task_resolve_works
+    :param message: the message of task_index_orcid_profile
+    :param token: string, the lease of the import
+    """
+    orcidid = message["orcidid"]
+    lease = "import:{0}".format(orcidid)
+    message["start"] = adsputils.get_date(message["start"])
+    try:
+        orcid_present = {}
+        for r in results:
+            orcid_present.update(app_module.load_works(r))
+        updated, removed = app.get_known_claims(orcidid)
+        author = app.retrieve_orcid(orcidid)
+        _import_claims(message, author, lease, token, orcid_present, updated, removed)
+    finally:
+        _release_import(message, lease, token)
+
+
+def _import_claims(
+    message, author, lease, token, orcid_present, updated, removed, submit=None
+):
+    """Compares the works of the profile with the claims we have and
+    records (and sends for matching) the differences."""
+    orcidid = message["orcidid"]
+    submit = submit or task_match_claim.delay
+
+    # a forced request arrived meanwhile, apply it to the diff (unless
+    # the profile was skipped already)
+    if not message.get("force", False) and (orcid_present or updated):
+        state = app.check_lease(lease, token)
+        if state and state.get("upgrade"):
+            logger.info("Import of {0} upgraded to forced".format(orcidid))
+            message["force"] = True
 
     to_claim = []
 
     # always insert a record that marks the beginning of a full-import
+    # (dated when we started fetching the profile; all updates that happened
+    # before that moment are covered by this import)
     # TODO: record orcid's last-modified-date
     to_claim.append(
         app.create_claim(
@@ -86,7 +409,7 @@ def task_index_orcid_profile(message):
             orcidid=orcidid,
             provenance="OrcidImporter",
             status="#full-import",
-            date=adsputils.get_date(),
+            date=message["start"],
         )
     )
 
@@ -159,8 +482,15 @@ def task_index_orcid_profile(message):
     if len(to_claim):
         # create record in the database
         json_claims = app.insert_claims(to_claim)
+        app.delete_import_cursor(orcidid)
         if author["status"] in ("blacklisted", "postponed"):
             return
+
+        # save the author lists in our storage; the claims will only reference them
+        authors_hashes = app.store_record_authors(
+            dict([(v[0], v[4]) for v in orcid_present.values()])
+        )
+
         # set to the queue for processing
         for claim in json_claims:
             if claim.get("bibcode"):
@@ -179,14 +509,17 @@ def task_index_orcid_profile(message):
                     claim["identifiers"] = orcid_present[
                         claim.get("bibcode").lower().strip()
                     ][3]
-                    claim["author_list"] = orcid_present[
-                        claim.get("bibcode").lower().strip()
-                    ][4]
+                    claim["authors_hash"] = authors_hashes[
+                        orcid_present[claim.get("bibcode").lower().strip()][0]
+                    ]
 
-                task_match_claim.delay(claim)
+                if message.get("lane"):
+                    claim["lane"] = message["lane"]
 
+                submit(claim)
 
-@app.task(queue="match-claim")
+
+@app.task()  # queue: see route_by_lane
 def task_match_claim(claim, **kwargs):
     """
     Takes the claim, matches it in the database (will create
@@ -198,9 +531,19 @@ def task_match_claim(claim, **kwargs):
         'orcidid': '.....',
         'name': 'author name',
         'facts': 'author name variants',
+        'authors_hash': 'hash of the author list (as stored
+            in the record)',
         }
     :return: no return
     """
+    match_claim(claim)
+
+
+def match_claim(claim, local=False):
+    """Does the work of task_match_claim; with local=True (run.py
+    --local-batch) the claim is not re-queued when solr is failing
+    (the error is raised) and the changed record is not sent out
+    (it waits in the outbox)."""
 
     if not isinstance(claim, dict):
         raise ProcessingException("Received unknown payload {0}".format(claim))
@@ -209,29 +552,74 @@ def task_match_claim(claim, **kwargs):
         raise ProcessingException("Unusable payload, missing orcidid {0}".format(claim))
 
     bibcode = claim["bibcode"]
-    if claim.get("status") != "removed":
-        identifiers = claim["identifiers"]
-        authors = claim["author_list"]
-    else:
-        metadata = app.retrieve_metadata(bibcode)
-        identifiers = metadata.get("identifier", [])
-        authors = metadata.get("author", [])
-
-    rec = app.retrieve_record(bibcode, authors)
+    try:
+        if claim.get("status") != "removed":
+            identifiers = claim["identifiers"]
+            if "author_list" in claim:  # claims queued by the older versions
+                authors = claim["author_list"]
+            else:
+                authors = app.resolve_authors(bibcode, claim.get("authors_hash"))
+        else:
+            metadata = app.retrieve_metadata(bibcode)
+            identifiers = metadata.get("identifier", [])
+            authors = metadata.get("author", [])
+    except CircuitOpenException as e:
+        if local:
+            raise
+        # solr is failing, put the claim back (instead of failing it)
+        app.incr_stat("match-claim.deferred")
+        logger.info("{0}, deferring claim {1}/{2}".format(e, bibcode, claim["orcidid"]))
+        task_match_claim.apply_async((claim,), countdown=e.retry_in)
+        return
+
+    # read-match-write; if another worker updated the record meanwhile,
+    # the claim is matched again (against the fresh version of the record)
+    # (a record whose author list was replaced is saved and sent out too,
+    # even if the claim didn't change it)
+    retries = app.conf.get("RECORDS_CONFLICT_RETRIES", 3)
+    authors_changed = False
+    for attempt in range(retries + 1):
+        rec = app.retrieve_record(bibcode, authors)
+        authors_changed = authors_changed or rec.get("authors_changed", False)
+        cl = updater.update_record(rec, claim, app.conf.get("MIN_LEVENSHTEIN_RATIO", 0.9))
+        changed = bool(cl and cl[2]) or authors_changed
+        if not changed:
+            break
+        try:
+            app.record_claims(
+                bibcode, rec["claims"], rec["authors"], version=rec.get("version")
+            )
+            break
+        except StaleRecordException:
+            if attempt == retries:
+                raise ProcessingException(
+                    "Record {0} keeps changing, giving up on {1}".format(
+                        bibcode, claim["orcidid"]
+                    )
+                )
+            logger.info("Record {0} was updated meanwhile, retrying".format(bibcode))
 
-    cl = updater.update_record(rec, claim, app.conf.get("MIN_LEVENSHTEIN_RATIO", 0.9))
     unique_bibs = list(set([bibcode] + identifiers))
-    
-    if cl:
-        status = "verified"
-        app.record_claims(bibcode, rec["claims"], rec["authors"])
+
+    if changed and not local:
         msg = OrcidClaims(
             authors=rec.get("authors"),
             bibcode=rec["bibcode"],
             verified=rec.get("claims", {}).get("verified", []),
             unverified=rec.get("claims", {}).get("unverified", []),
         )
-        task_output_results.delay(msg)
+        task_output_results.delay(msg, lane=claim.get("lane"))
+
+    if cl:
+        status = "verified"
+        if not changed:
+            # nothing changed, no need to save/send the same record again
+            app.incr_stat("match-claim.noop")
+            logger.debug(
+                "Claim for bibcode:{0} and orcidid:{1} did not change the record".format(
+                    claim["bibcode"], claim["orcidid"]
+                )
+            )
     else:
         status = "rejected"
         logger.warning(
@@ -240,27 +628,14 @@ def task_match_claim(claim, **kwargs):
             )
         )
 
-    r = app.client.post(
-        app.conf.get("API_ORCID_UPDATE_BIB_STATUS") % claim.get("orcidid"),
-        json={"bibcodes": unique_bibs, "status": status},
-        headers={"Authorization": "Bearer {0}".format(app.conf.get("API_TOKEN"))},
-    )
-    if r.status_code != 200:
-        logger.warning(
-            "IDs {ids} for {orcidid} not updated to: {status}".format(
-                ids=unique_bibs, orcidid=claim.get("orcidid"), status=status
-            )
-        )
-    elif len(r.json()) != 1:
-        logger.warning(
-            "Number of updated bibcodes ({0}) does not match input ({1}) for {2}".format(
-                r.text, unique_bibs, claim.get("orcidid")
-            )
-        )
+    # the status updates are grouped (by orcidid and status) and sent in bulk
+    app.status_batch.add(claim.get("orcidid"), unique_bibs, status)
+    if not app.status_batch.window:
+        app.status_batch.flush()
 
 
-@app.task(queue="output-results")
-def task_output_results(msg):
+@app.task()  # queue: see route_by_lane
+def task_output_results(msg, force=False, lane=None):
     """
     This worker will forward results to the outside
     exchange (typically an ADSImportPipeline) to be
@@ -278,55 +653,133 @@ def task_output_results(msg):
              }
             }
     :type: adsmsg.OrcidClaims
+    :param force: when True, the record will be sent even if the same
+            content has already been forwarded
+    :param lane: 'bulk' if the message belongs to the low-priority lane
+            (see route_by_lane)
     :return: no return
+
+    The messages are held (by bibcode) for OUTPUT_COALESCE_WINDOW
+    seconds and only the latest version of the record is sent out.
     """
-    app.forward_message(msg)
+    app.output_buffer.add(msg, force=force)
 
 
 @app.task(queue="check-updates")
 def task_check_orcid_updates(msg):
     """Check the orcid microservice for updated orcid profiles.
 
-    This function is somewhat complex
-    we are trying to defend against multiple executions (assuming
+    We are trying to defend against multiple executions (assuming
     that there is many workers and each of them can receive its own
     signal to start processing).
 
-    Basically, we'll only want to check for updated profiles once.
-    The synchronization is done via a database. So the worker
-    updates the 'last.check' timestamp immediately (and we
-    'optimistically' hope that it will be enough to prevent clashes;
-    well - even if that is not a strong guarantee, it wouldn't be
-    a tragedy if a profile is checked twice...)
+    Only one poller is active: it holds the lease ('check-updates',
+    stored in the database) and passes it to its successor (the
+    next scheduled execution). Any other execution (e.g. a duplicate
+    signal) finds the lease taken and quits without scheduling
+    anything. If the poller dies, the lease expires and the next
+    signal starts a new one.
+
+    The 'last.check' checkpoint is written with compare-and-swap, so
+    even if two pollers met, only one of them enqueues the profiles
+    from the same window.
 
     Additional difficulty is time synchronization: the worker can
     be executed as often as you like, but it will refuse to do any
     work unless the time window between the checks is large enough.
     """
 
+    total_wait = app.conf.get("ORCID_CHECK_FOR_CHANGES", 60 * 5)  # default is 5min
+    grace = app.conf.get("ORCID_CHECK_LEASE_GRACE", 600)
+
+    token = msg.get("lease")
+    if not (token and app.renew_lease("check-updates", token, total_wait + grace)):
+        token = app.acquire_lease("check-updates", total_wait + grace)
+        if token is None:
+            app.incr_stat("check-updates.contention")
+            logger.info("Another poller is active, quitting")
+            return
+    msg["lease"] = token
+
+    countdown = _check_orcid_updates(msg, total_wait)
+
+    # (re)start the relay of the outbox; if it is running, this one quits
+    if app.conf.get("OUTBOX_RELAY_INTERVAL", 0):
+        task_drain_outbox.delay({})
+
+    # pass the lease to the successor
+    if app.renew_lease("check-updates", token, countdown + grace):
+        task_check_orcid_updates.apply_async(args=(msg,), countdown=countdown)
+    else:
+        app.incr_stat("check-updates.contention")
+        logger.warning("Lost the lease of the poller, not scheduling the next check")
+
+
+@app.task(queue="check-updates")
+def task_drain_outbox(msg):
+    """Relay of the outbox: forwards the records that were updated but
+    never sent (see app.drain_outbox) and deletes the old sent entries;
+    it runs every OUTBOX_RELAY_INTERVAL secs.
+
+    Like the poller (task_check_orcid_updates), only one relay is
+    active: it holds the lease ('outbox-relay') and passes it to the
+    next scheduled execution; the poller starts a relay on every check
+    and the duplicates quit.
+    """
+    interval = app.conf.get("OUTBOX_RELAY_INTERVAL", 300)
+    grace = app.conf.get("ORCID_CHECK_LEASE_GRACE", 600)
+
+    token = msg.get("lease")
+    if not (token and app.renew_lease("outbox-relay", token, interval + grace)):
+        token = app.acquire_lease("outbox-relay", interval + grace)
+        if token is None:
+            logger.debug("Another relay is active, quitting")
+            return
+    msg["lease"] = token
+
+    try:
+        app.drain_outbox(limit=app.conf.get("OUTBOX_RELAY_LIMIT", 10000))
+    except Exception as e:
+        # the entries stay in the outbox, the next run forwards them
+        logger.exception("Relay of the outbox failed: {0}".format(e))
+
+    if app.renew_lease("outbox-relay", token, interval + grace):
+        task_drain_outbox.apply_async(args=(msg,), countdown=interval)
+    else:
+        logger.warning("Lost the lease of the relay, not scheduling the next run")
+
+
+def _check_orcid_updates(msg, total_wait):
+    """Does one check (see task_check_orcid_updates); the pages of
+    updates are fetched back-to-back while they come back full.
+
+    :return: secs to wait before the next check; it is longer when
+        the feed is idle (up to ORCID_CHECK_MAX_WAIT) and grows
+        exponentially (with jitter) when the service fails
+    """
+
+    max_wait = app.conf.get("ORCID_CHECK_MAX_WAIT", 60 * 60)
+    page_size = app.conf.get("ORCID_UPDATES_PAGE_SIZE", 100)
+    max_pages = app.conf.get("ORCID_UPDATES_MAX_PAGES", 50)
+
     with app.session_scope() as session:
         kv = session.query(KeyValue).filter_by(key="last.check").first()
-        if kv is None:
-            kv = KeyValue(
-                key="last.check", value="1974-11-09T22:56:52.518001Z"
-            )  # force update
+        checkpoint = kv.value if kv is not None else None
 
-        latest_point = adsputils.get_date(kv.value)  # RFC 3339 format
-        now = adsputils.get_date()
+    latest_point = adsputils.get_date(
+        checkpoint or "1974-11-09T22:56:52.518001Z"
+    )  # RFC 3339 format, force update if missing
+    delta = adsputils.get_date() - latest_point
 
-        total_wait = app.conf.get("ORCID_CHECK_FOR_CHANGES", 60 * 5)  # default is 5min
-        delta = now - latest_point
+    if delta.total_seconds() < total_wait:
+        return (total_wait - delta.total_seconds()) + 1
 
-        if delta.total_seconds() < total_wait:
-            # register our own execution in the future
-            task_check_orcid_updates.apply_async(
-                args=(msg,), countdown=(total_wait - delta.total_seconds()) + 1
-            )
-        else:
-            logger.info("Checking for orcid updates")
+    logger.info("Checking for orcid updates")
 
-            # increase the timestamp by one microsec and get new updates
-            latest_point = latest_point + datetime.timedelta(microseconds=1)
+    for _ in range(max_pages):
+        # increase the timestamp by one microsec and get new updates
+        latest_point = latest_point + datetime.timedelta(microseconds=1)
+        try:
             r = app.client.get(
                 app.conf.get("API_ORCID_UPDATES_ENDPOINT") % latest_point.isoformat(),
                 params={"fields": ["orcid_id", "updated", "created"]},
@@ -334,55 +787,73 @@ def task_check_orcid_updates(msg):
                     "Authorization": "Bearer {0}".format(app.conf.get("API_TOKEN"))
                 },
             )
-
-            if r.status_code != 200:
-                logger.error(
-                    "Failed getting {0}\n{1}".format(
-                        app.conf.get("API_ORCID_UPDATES_ENDPOINT") % kv.value, r.text
-                    )
+        except CircuitOpenException as e:
+            logger.warning("{0}, skipping the check".format(e))
+            return e.retry_in
+
+        if r.status_code != 200:
+            logger.error(
+                "Failed getting {0}\n{1}".format(
+                    app.conf.get("API_ORCID_UPDATES_ENDPOINT") % latest_point.isoformat(), r.text
                 )
-                msg["errcount"] = msg.get("errcount", 0) + 1
-
-                # schedule future execution offset by number of errors (rca: do exponential?)
-                task_check_orcid_updates.apply_async(
-                    args=(msg,), countdown=total_wait + total_wait * msg["errcount"]
-                )
-                return
-
-            if r.text.strip() == "":
-                return task_check_orcid_updates.apply_async(
-                    args=(msg,), countdown=total_wait
-                )
-
-            data = r.json()
-
-            if len(data) == 0:
-                return task_check_orcid_updates.apply_async(
-                    args=(msg,), countdown=total_wait
-                )
-
-            msg["errcount"] = 0  # success, we got data from the api, reset the counter
-
-            # we received the data, immediately update the databaes (so that other processes don't
-            # ask for the same starting date)
-            # data should be ordered by date updated (but to be sure, let's check it); we'll save it
-            # as latest 'check point'
-            dates = [adsputils.get_date(x["updated"]) for x in data]
-            dates = sorted(dates, reverse=True)
-
-            kv.value = dates[0].isoformat()
-            session.merge(kv)
-            session.commit()
+            )
+            msg["errcount"] = msg.get("errcount", 0) + 1
+
+            # exponential backoff (with jitter, so that we don't hit the service in sync)
+            wait = min(total_wait * 2 ** msg["errcount"], max_wait)
+            return random.uniform(wait / 2, wait)
+
+        data = r.text.strip() != "" and r.json() or []
+        if len(data) == 0:
+            break
+
+        msg["errcount"] = 0  # success, we got data from the api, reset the counter
+        msg["idle"] = 0
+
+        # we received the data, immediately update the databaes (so that other processes don't
+        # ask for the same starting date)
+        # data should be ordered by date updated (but to be sure, let's check it); we'll save it
+        # as latest 'check point'
+        dates = [adsputils.get_date(x["updated"]) for x in data]
+        dates = sorted(dates, reverse=True)
+
+        with app.session_scope() as session:
+            if not app.compare_and_swap(session, "last.check", checkpoint, dates[0].isoformat()):
+                # somebody else moved the checkpoint (and enqueued these profiles)
+                app.incr_stat("check-updates.contention")
+                logger.warning("Checkpoint last.check was moved by another poller")
+                return total_wait
+
+        for rec in data:
+            payload = {
+                "orcidid": rec["orcid_id"],
+                "start": latest_point.isoformat(),
+                "updated": rec["updated"],
+            }
+            task_index_orcid_profile.delay(payload)
+
+        # how long the oldest update waited before we saw it
+        lag = (adsputils.get_date() - dates[-1]).total_seconds()
+        app.set_stat("check-updates.lag", lag)
+        logger.info(
+            "Enqueued {0} updated profiles (up to {1}), lag={2:.0f}s".format(
+                len(data), dates[0].isoformat(), lag
+            )
+        )
 
-            for rec in data:
-                payload = {
-                    "orcidid": rec["orcid_id"],
-                    "start": latest_point.isoformat(),
-                }
-                task_index_orcid_profile.delay(payload)
+        checkpoint = dates[0].isoformat()
+        latest_point = dates[0]
+        if len(data) < page_size:
+            # we caught up, recheck again
+            return total_wait
+    else:
+        # there is more to fetch, continue right away
+        return 1
 
-            # recheck again
-            task_check_orcid_updates.apply_async(args=(msg,), countdown=total_wait)
+    # nothing new; the longer the feed is idle, the less often we ask
+    app.set_stat("check-updates.lag", 0)
+    msg["idle"] = msg.get("idle", 0) + 1
+    return min(total_wait * 2 ** (msg["idle"] - 1), max_wait)
 
 
 if __name__ == "__main__":
@@ -19,11 +19,13 @@ import httpretty
 import mock
 from mock import patch
 from io import BytesIO, StringIO
-from datetime import datetime
+from datetime import datetime, timedelta
 import adsputils as utils
+from adsmsg import OrcidClaims
 from ADSOrcid import app
-from ADSOrcid.models import ClaimsLog, Records, AuthorInfo, Base, ChangeLog
-from ADSOrcid.exceptions import IgnorableException
+from ADSOrcid.models import ClaimsLog, ClaimState, Records, AuthorInfo, Base, ChangeLog, Outbox, KeyValue
+from ADSOrcid.exceptions import IgnorableException, StaleRecordException
+from celery.exceptions import SoftTimeLimitExceeded
 
 class TestAdsOrcidCelery(unittest.TestCase):
     """
@@ -96,6 +98,31 @@ class TestAdsOrcidCelery(unittest.TestCase):
                             .filter_by(bibcode='b123456789123456789').all()) == 3)
 
 
+    def test_insert_claims_bulk(self):
+        """The claims are inserted in bulk; the ids and dates are returned"""
+        date = '2017-01-01T10:10:10+00:00'
+        r = self.app.insert_claims([
+                    {'bibcode': 'b%d' % i, 'orcidid': '0000-0000-0000-0001', 'status': 'claimed',
+                     'date': date}
+                    for i in range(5)])
+        with self.app.session_scope() as session:
+            rows = session.query(ClaimsLog).order_by(ClaimsLog.id.asc()).all()
+            self.assertEqual([x['id'] for x in r], [x.id for x in rows])
+            self.assertEqual(r[0], rows[0].toJSON())
+            ids = [x.id for x in rows]
+
+        # an existing claim is updated (not inserted again)
+        claim = self.app.create_claim(bibcode='b0', orcidid='0000-0000-0000-0001', status='updated',
+                                      date=date, force_new=False)
+        r = self.app.insert_claims([claim, {'bibcode': 'b5', 'orcidid': '0000-0000-0000-0001'}])
+        self.assertEqual(r[0]['id'], ids[0])
+        self.assertEqual(r[0]['status'], 'updated')
+        self.assertEqual(r[1]['id'], ids[-1] + 1)
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(ClaimsLog).count(), 6)
+            self.assertEqual(session.query(ClaimsLog).get(ids[0]).status, 'updated')
+
+
     def test_import_recs(self):
         """It should know how to import bibcode:orcidid pairs
         :return None
@@ -302,6 +329,162 @@ class TestAdsOrcidCelery(unittest.TestCase):
             self.assertTrue(r.processed)
             
             
+    def test_forward_message(self):
+        """The same content is forwarded only once (unless forced)"""
+        self.app.record_claims('bibcode', {'verified': ['foo', '-', 'bar'], 'unverified': ['-', '-', '-']},
+                               ['a', 'b', 'c'])
+        msg = OrcidClaims(bibcode='bibcode', authors=['a', 'b', 'c'],
+                          verified=['foo', '-', 'bar'], unverified=['-', '-', '-'])
+        with mock.patch('adsputils.ADSCelery.forward_message') as forward_message:
+            self.app.forward_message(msg)
+            self.assertEqual(forward_message.call_count, 1)
+
+            self.app.forward_message(msg)
+            # the dict version (from run.py) has the same content
+            self.app.forward_message({'bibcode': 'bibcode', 'authors': ['a', 'b', 'c'],
+                                      'claims': {'verified': ['foo', '-', 'bar'], 'unverified': ['-', '-', '-']}})
+            self.assertEqual(forward_message.call_count, 1)
+
+            self.app.forward_message(msg, force=True)
+            self.assertEqual(forward_message.call_count, 2)
+
+            msg.verified[1] = 'zet'
+            self.app.forward_message(msg)
+            self.assertEqual(forward_message.call_count, 3)
+
+        with self.app.session_scope() as session:
+            r = session.query(Records).filter_by(bibcode='bibcode').first()
+            self.assertEqual(r.output_hash, app.content_hash({'authors': ['a', 'b', 'c'],
+                                                              'verified': ['foo', 'zet', 'bar'],
+                                                              'unverified': ['-', '-', '-']}))
+
+
+    def test_outbox(self):
+        """Updated records are noted in the outbox and drained by the relay"""
+        self.app.record_claims('bib1', {'verified': ['foo', '-'], 'unverified': ['-', '-']}, ['a', 'b'])
+        self.app.record_claims('bib1', {'verified': ['foo', 'bar'], 'unverified': ['-', '-']})
+        self.app.record_claims('bib2', {'verified': ['-'], 'unverified': ['baz']}, ['c'])
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(Outbox).filter(Outbox.sent == None).count(), 3)
+
+        with mock.patch('adsputils.ADSCelery.forward_message') as forward_message:
+            # the normal path marks the entry (and the older ones) as sent
+            self.app.forward_message(OrcidClaims(bibcode='bib1', authors=['a', 'b'],
+                                                 verified=['foo', 'bar'], unverified=['-', '-']))
+            with self.app.session_scope() as session:
+                self.assertEqual([x.bibcode for x in session.query(Outbox).filter(Outbox.sent == None).all()],
+                                 ['bib2'])
+                self.assertTrue(session.query(Records).filter_by(bibcode='bib1').first().processed)
+
+        with mock.patch('ADSOrcid.app.BrokerConnection'), \
+                mock.patch.object(self.app.amqp, 'Producer'), \
+                mock.patch.object(self.app._forward_message, 'apply_async') as apply_async:
+            # the fresh entries are left alone
+            self.assertEqual(self.app.drain_outbox(), 0)
+
+            self.assertEqual(self.app.drain_outbox(older_than=0), 1)
+            self.assertEqual(apply_async.call_count, 1)
+            self.assertEqual(apply_async.call_args[0][0][0].bibcode, 'bib2')
+            self.assertEqual(list(apply_async.call_args[0][0][0].unverified), ['baz'])
+            with self.app.session_scope() as session:
+                self.assertEqual(session.query(Outbox).filter(Outbox.sent == None).count(), 0)
+                self.assertTrue(session.query(Records).filter_by(bibcode='bib2').first().processed)
+
+            self.assertEqual(self.app.drain_outbox(older_than=0), 0)
+
+
+    def test_forward_messages(self):
+        """Many messages are published through one connection, unchanged ones are skipped"""
+        self.app.record_claims('bib1', {'verified': ['foo', '-'], 'unverified': ['-', '-']}, ['a', 'b'])
+        self.app.record_claims('bib2', {'verified': ['-'], 'unverified': ['baz']}, ['c'])
+        msgs = [OrcidClaims(bibcode='bib1', authors=['a', 'b'], verified=['foo', '-'], unverified=['-', '-']),
+                {'bibcode': 'bib2', 'authors': ['c'], 'claims': {'verified': ['-'], 'unverified': ['baz']}}]
+
+        with mock.patch('ADSOrcid.app.BrokerConnection') as BrokerConnection, \
+                mock.patch.object(self.app.amqp, 'Producer') as Producer, \
+                mock.patch.object(self.app._forward_message, 'apply_async') as apply_async:
+            self.assertEqual(self.app.forward_messages(msgs), 2)
+            self.assertEqual(BrokerConnection.call_count, 1)
+            self.assertEqual(BrokerConnection.call_args[1], {'transport_options': {'confirm_publish': True}})
+            self.assertEqual(Producer.call_count, 1)
+            self.assertEqual(apply_async.call_count, 2)
+            self.assertEqual(apply_async.call_args[1], {'producer': Producer.return_value})
+            with self.app.session_scope() as session:
+                self.assertEqual(session.query(Outbox).filter(Outbox.sent == None).count(), 0)
+
+            # nothing changed, nothing sent
+            self.assertEqual(self.app.forward_messages(msgs), 0)
+            self.assertEqual(apply_async.call_count, 2)
+
+            self.assertEqual(self.app.forward_messages(msgs, force=True), 2)
+            self.assertEqual(apply_async.call_count, 4)
+
+
+    def test_client_per_thread(self):
+        """Every thread gets its own http session (with shared connection pools)"""
+        import threading
+        clients = []
+        t = threading.Thread(target=lambda: clients.append(self.app.client))
+        t.start()
+        t.join()
+        self.assertTrue(self.app.client is self.app.client)
+        self.assertFalse(clients[0] is self.app.client)
+        self.assertTrue(clients[0].adapters['http://'] is self.app.client.adapters['http://'])
+
+
+    def test_record_claims_version(self):
+        """The claims are not written if the record changed since it was read"""
+        rec = self.app.retrieve_record('bib1', ['a', 'b'])
+        self.assertEqual(rec['version'], 0)
+        self.app.record_claims('bib1', {'verified': ['x', '-']}, ['a', 'b'], version=0)
+        self.assertRaises(StaleRecordException, self.app.record_claims,
+                          'bib1', {'verified': ['-', 'y']}, ['a', 'b'], version=0)
+
+        rec = self.app.retrieve_record('bib1', ['a', 'b'])
+        self.assertEqual(rec['version'], 1)
+        self.assertEqual(rec['claims'], {'verified': ['x', '-']})
+
+        # new authors, new version
+        self.assertEqual(self.app.retrieve_record('bib1', ['a', 'b', 'c'])['version'], 2)
+
+
+    def test_jump_hash(self):
+        keys = ['2015ApJ...%s' % i for i in range(1000)]
+        buckets = [app.jump_hash(k, 10) for k in keys]
+        self.assertEqual(buckets, [app.jump_hash(k, 10) for k in keys])
+        self.assertEqual(set(buckets), set(range(10)))
+        self.assertTrue(all(50 < buckets.count(i) < 150 for i in range(10)))
+        self.assertEqual(set(app.jump_hash(k, 1) for k in keys), set([0]))
+
+        # adding a partition moves only the keys that go into it
+        moved = [(b, app.jump_hash(k, 11)) for k, b in zip(keys, buckets)]
+        moved = [x for x in moved if x[0] != x[1]]
+        self.assertTrue(0 < len(moved) < 150)
+        self.assertTrue(all(x[1] == 10 for x in moved))
+
+    def test_lease(self):
+        """Only one holder of the lease; forced requests upgrade it"""
+        token = self.app.acquire_lease('import:foo', 60)
+        self.assertTrue(token)
+        self.assertEqual(self.app.acquire_lease('import:foo', 60), None)
+        self.assertTrue(self.app.acquire_lease('import:bar', 60))
+
+        self.assertFalse(self.app.check_lease('import:foo', token).get('upgrade'))
+        self.assertEqual(self.app.acquire_lease('import:foo', 60, force=True), None)
+        self.assertTrue(self.app.check_lease('import:foo', token).get('upgrade'))
+
+        self.assertEqual(self.app.release_lease('import:foo', 'somebody else'), None)
+        self.assertTrue(self.app.release_lease('import:foo', token).get('upgrade'))
+        self.assertEqual(self.app.release_lease('import:foo', token), None)
+
+        # expired lease can be taken over
+        token = self.app.acquire_lease('import:foo', -1)
+        token2 = self.app.acquire_lease('import:foo', 60, force=True)
+        self.assertTrue(token2)
+        self.assertEqual(self.app.check_lease('import:foo', token), None)
+        self.assertTrue(self.app.check_lease('import:foo', token2).get('force'))
+
+
     @httpretty.activate
     def test_get_claims(self):
         """Check the correct logic for discovering difference in the orcid profile."""
@@ -414,5 +597,123 @@ class TestAdsOrcidCelery(unittest.TestCase):
             assert len(orcid_present) == 7 and len(updated) == 0 and len(removed) == 0
 
 
+    def test_store_record_authors(self):
+        """A changed author list is a new version of the record"""
+        self.app.store_record_authors({'bib1': ['Stern, D', 'Einstein, A']})
+        def version():
+            with self.app.session_scope() as session:
+                return session.query(Records).filter_by(bibcode='bib1').first().version
+        self.assertEqual(version(), 0)
+        self.app.store_record_authors({'bib1': ['Stern, D', 'Einstein, A']})
+        self.assertEqual(version(), 0)
+        self.app.store_record_authors({'bib1': ['Stern, D K', 'Einstein, A']})
+        self.assertEqual(version(), 1)
+
+
+    def test_get_known_claims(self):
+        """The known claims are kept in claim_state, same as the replay of the log"""
+        o = '0000-0000-0000-0001'
+        self.app.insert_claims([{'bibcode': 'b1', 'orcidid': o, 'status': 'claimed'},
+                                {'bibcode': 'b2', 'orcidid': o, 'status': 'claimed'}])
+        self.app.insert_claims([{'bibcode': '', 'orcidid': o, 'status': '#full-import'},
+                                {'bibcode': 'B2', 'orcidid': o, 'status': 'unchanged'},
+                                {'bibcode': 'b3', 'orcidid': o, 'status': 'claimed'}])
+        self.app.insert_claims([{'bibcode': 'b3', 'orcidid': o, 'status': 'removed'},
+                                {'bibcode': 'b4', 'orcidid': '0000-0000-0000-0002', 'status': 'claimed'}])
+
+        updated, removed = self.app.get_known_claims(o)
+        self.assertEqual(sorted(updated.keys()), ['b2'])
+        self.assertEqual(updated['b2'][0], 'B2')
+        self.assertEqual(sorted(removed.keys()), ['b3'])
+        with self.app.session_scope() as session:
+            self.assertEqual((updated, removed), self.app._replay_claims(session, o))
+            self.assertEqual(session.query(ClaimState).filter_by(orcidid=o).count(), 2)
+
+            # without the state, the log is replayed
+            session.query(ClaimState).delete()
+            session.commit()
+        self.assertEqual(self.app.get_known_claims(o), (updated, removed))
+
+
+    def test_compact_claims(self):
+        """Unchanged/forced claims superseded by an old full import are removed"""
+        o = '0000-0000-0000-0001'
+        old = utils.get_date() - timedelta(days=100)
+        def imp(date, *claims):
+            self.app.insert_claims([{'bibcode': '', 'orcidid': o, 'status': '#full-import', 'date': date}] +
+                                   [{'bibcode': b, 'orcidid': o, 'status': s, 'provenance': 'OrcidImporter'}
+                                    for b, s in claims])
+        imp(old - timedelta(days=10), ('b1', 'claimed'), ('b2', 'claimed'))
+        imp(old - timedelta(days=5), ('b1', 'unchanged'), ('b2', 'forced'))
+        imp(old, ('b1', 'unchanged'), ('b2', 'removed'))
+        imp(utils.get_date(), ('b1', 'unchanged'))
+        known = self.app.get_known_claims(o)
+
+        archive = StringIO()
+        self.assertEqual(self.app.compact_claims(retention=30, batch_size=1, archive=archive), (1, 2))
+        lines = [l.split('\t') for l in archive.getvalue().strip().split('\n')]
+        self.assertEqual([(l[0], l[1], l[3]) for l in lines], [('b1', o, 'unchanged'), ('b2', o, 'forced')])
+        with self.app.session_scope() as session:
+            self.assertEqual([(c.bibcode, c.status) for c in session.query(ClaimsLog).order_by(ClaimsLog.id)],
+                             [('', '#full-import'), ('b1', 'claimed'), ('b2', 'claimed'),
+                              ('', '#full-import'),
+                              ('', '#full-import'), ('b1', 'unchanged'), ('b2', 'removed'),
+                              ('', '#full-import'), ('b1', 'unchanged')])
+            self.assertEqual(session.query(KeyValue).filter_by(key='compact.cursor').count(), 0)
+            self.assertEqual(self.app._replay_claims(session, o), known)
+        self.assertEqual(self.app.get_known_claims(o), known)
+
+        # nothing left to do; a shorter window reaches the last import
+        self.assertEqual(self.app.compact_claims(retention=30), (1, 0))
+        self.assertEqual(self.app.compact_claims(retention=0)[1], 1)
+        self.assertEqual(self.app.get_known_claims(o), known)
+
+
+    @httpretty.activate
+    def test_get_claims_resume(self):
+        """The import that ran out of time continues where it stopped"""
+        orcidid = '0000-0003-3041-2092'
+        httpretty.register_uri(
+            httpretty.POST, self.app.conf['API_ORCID_UPDATE_BIB_STATUS'] % orcidid,
+            content_type='application/json',
+            status=200,
+            body=json.dumps({}))
+
+        calls = []
+        def side_effect(x, search_identifiers=False):
+            calls.append(x)
+            if len(calls) == 5:
+                raise SoftTimeLimitExceeded()
+            if len(x) == 19:
+                return {'bibcode': x}
+            return None
+
+        self.app._config['IMPORT_CHUNK_SIZE'] = 2
+        with mock.patch.object(self.app, 'retrieve_orcid', return_value={'status': None}), \
+            mock.patch.object(self.app, '_get_ads_orcid_profile',
+                return_value=json.loads(open(os.path.join(self.app.conf['TEST_DIR'], 'stub_data', orcidid + '.ads.json')).read())), \
+            mock.patch.object(self.app, 'retrieve_metadata', side_effect=side_effect):
+
+            args = (orcidid, self.app.conf.get('API_TOKEN'), self.app.conf.get('API_ORCID_EXPORT_PROFILE') % orcidid)
+            opts = {'orcid_identifiers_order': {'bibcode': 9, '*': -1}}
+            self.assertRaises(SoftTimeLimitExceeded, self.app.get_claims, *args, resume=True, **opts)
+            with self.app.session_scope() as session:
+                cursor = json.loads(session.query(KeyValue).filter_by(key='import-cursor:' + orcidid).first().value)
+            self.assertEqual(cursor['index'], 4)
+            self.assertEqual(len(cursor['present']), 4)
+
+            orcid_present, updated, removed = self.app.get_claims(*args, resume=True, **opts)
+            self.assertEqual(len(orcid_present), 9)
+            resumed = len(calls) - 5
+
+            # the resolved works were not fetched again
+            self.assertEqual(orcid_present, self.app.get_claims(*args, **opts)[0])
+            self.assertEqual(len(calls) - 5 - resumed, resumed + 4)
+
+            self.app.delete_import_cursor(orcidid)
+            with self.app.session_scope() as session:
+                self.assertEqual(session.query(KeyValue).count(), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
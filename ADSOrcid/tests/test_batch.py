@@ -0,0 +1,72 @@
+import json
+import os
+import unittest
+
+from mock import patch
+
+from ADSOrcid import app, tasks
+from ADSOrcid.batch import LocalPipeline
+from ADSOrcid.models import Base, KeyValue
+
+
+class TestLocalPipeline(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        proj_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+        self.app = app.ADSOrcidCelery('test', local_config={
+            'SQLALCHEMY_URL': 'sqlite:///',
+            'SQLALCHEMY_ECHO': False,
+            'PROJ_HOME': proj_home,
+        })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+
+    def test_run(self):
+        orcidids = ['0000-0000-0000-000%d' % i for i in range(5)]
+        matched = []
+
+        def import_profile(message, submit):
+            if message['orcidid'].endswith('3'):
+                raise Exception('orcid is down')
+            for i in range(3):
+                submit({'orcidid': message['orcidid'], 'bibcode': 'bib%d' % i})
+            return True
+
+        def match_claim(claim, local=False):
+            self.assertTrue(local)
+            matched.append((claim['orcidid'], claim['bibcode']))
+
+        pipeline = LocalPipeline(self.app, io_workers=2, match_workers=0, queue_size=2)
+        with patch.object(tasks, 'import_profile', side_effect=import_profile) as imp, \
+                patch.object(tasks, 'match_claim', side_effect=match_claim), \
+                patch.object(self.app, 'drain_outbox', return_value=12) as drain_outbox:
+            counts = pipeline.run(reversed(orcidids))
+            self.assertEqual(imp.call_count, 5)
+            self.assertEqual(imp.call_args[0][0]['force'], True)
+            self.assertEqual(len(matched), 12)
+            self.assertEqual(counts, {'profiles': 5, 'claims': 12, 'failed': 1, 'skipped': 0, 'forwarded': 12})
+            drain_outbox.assert_called_once_with(older_than=0)
+
+            with self.app.session_scope() as session:
+                kv = session.query(KeyValue).filter_by(key='local-batch').first()
+                self.assertEqual(json.loads(kv.value), {'last': orcidids[-1], 'failed': [orcidids[3]]})
+
+            # the next run does only the new and the failed profiles
+            imp.reset_mock()
+            counts = pipeline.run(orcidids + ['0000-0000-0000-0010'])
+            self.assertEqual(sorted(c[0][0]['orcidid'] for c in imp.call_args_list),
+                             [orcidids[3], '0000-0000-0000-0010'])
+            self.assertEqual(pipeline.load_checkpoint(), {'last': '0000-0000-0000-0010', 'failed': [orcidids[3]]})
+
+            pipeline.reset()
+            self.assertEqual(pipeline.load_checkpoint(), {'last': None, 'failed': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
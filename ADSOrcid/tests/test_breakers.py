@@ -0,0 +1,135 @@
+import datetime
+import json
+import os
+import unittest
+
+import mock
+from mock import patch
+
+import adsputils as utils
+from ADSOrcid import app, tasks
+from ADSOrcid.breakers import CircuitBreakers
+from ADSOrcid.exceptions import CircuitOpenException
+from ADSOrcid.models import Base, KeyValue
+
+
+class TestCircuitBreakers(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        proj_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+        self.app = app.ADSOrcidCelery('test', local_config={
+            'SQLALCHEMY_URL': 'sqlite:///',
+            'SQLALCHEMY_ECHO': False,
+            'PROJ_HOME': proj_home,
+            'STATUS_BATCH_WINDOW': 0,
+        })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+        self.config = {
+            'API_SOLR_QUERY_ENDPOINT': 'http://api/v1/search/query/',
+            'CIRCUIT_BREAKERS': {'solr': {'endpoints': ['API_SOLR_QUERY_ENDPOINT'],
+                                          'failures': 2, 'reset_timeout': 60, 'refresh': 0}},
+        }
+        self.breakers = CircuitBreakers(self.app, self.config)
+        self.url = 'http://api/v1/search/query/?q=x'
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+
+    def set_until(self, secs):
+        with self.app.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key='breaker:solr').first()
+            state = json.loads(kv.value)
+            state['until'] = (utils.get_date() + datetime.timedelta(seconds=secs)).isoformat()
+            kv.value = json.dumps(state)
+            session.commit()
+
+    def test_breaker(self):
+        # unknown endpoints are not guarded
+        self.breakers.check('http://other/')
+        self.breakers.record('http://other/', False)
+
+        # closed; successes write nothing
+        self.breakers.check(self.url)
+        self.breakers.record(self.url, True)
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(KeyValue).count(), 0)
+
+        # opens after consecutive failures
+        self.breakers.record(self.url, False)
+        self.breakers.check(self.url)
+        self.breakers.record(self.url, False)
+        self.assertEqual(self.breakers.states()['solr']['state'], 'open')
+        with self.assertRaises(CircuitOpenException) as e:
+            self.breakers.check(self.url)
+        self.assertTrue(50 < e.exception.retry_in <= 60)
+
+        # shared with the other workers
+        other = CircuitBreakers(self.app, self.config)
+        self.assertRaises(CircuitOpenException, other.check, self.url)
+
+        # after the timeout, only one request probes the service (half-open)
+        self.set_until(-1)
+        self.breakers.check(self.url)
+        self.assertEqual(self.breakers.states()['solr']['state'], 'half-open')
+        self.assertRaises(CircuitOpenException, other.check, self.url)
+
+        # the probe failed, open again
+        self.breakers.record(self.url, False)
+        self.assertEqual(self.breakers.states()['solr']['state'], 'open')
+
+        # the probe succeeded, closed
+        self.set_until(-1)
+        other.check(self.url)
+        other.record(self.url, True)
+        self.assertEqual(self.breakers.states()['solr'], {'state': 'closed', 'failures': 0, 'until': None})
+        self.breakers.check(self.url)
+
+    def test_client(self):
+        """The http client consults the breakers"""
+        breakers = mock.Mock()
+        self.app._breakers = breakers
+        client = self.app._copy_client(self.app._client)
+        with patch('requests.Session.request') as request:
+            request.return_value = mock.Mock(status_code=404)
+            client.get('http://other/')
+            breakers.check.assert_called_with('http://other/')
+            breakers.record.assert_called_with('http://other/', True)
+
+            breakers.check.side_effect = CircuitOpenException('solr', 10)
+            self.assertRaises(CircuitOpenException, client.get, 'http://other/')
+            self.assertEqual(request.call_count, 1)
+
+    def test_tasks_are_deferred(self):
+        _app = tasks.app
+        tasks.app = self.app
+        try:
+            orcidid = '0000-0003-3041-2092'
+            with patch.object(self.app, 'retrieve_orcid') as retrieve_orcid, \
+                    patch.object(tasks.task_index_orcid_profile, 'apply_async') as apply_async:
+                retrieve_orcid.side_effect = CircuitOpenException('solr', 30)
+                tasks.task_index_orcid_profile({'orcidid': orcidid, 'lane': 'bulk'})
+                payload = apply_async.call_args[0][0][0]
+                self.assertTrue(payload['resume'])
+                self.assertEqual(payload['lane'], 'bulk')
+                self.assertEqual(apply_async.call_args[1], {'countdown': 30})
+                # the lease was released
+                self.assertTrue(self.app.acquire_lease('import:' + orcidid, 60))
+
+            claim = {'bibcode': 'bib1', 'orcidid': orcidid, 'identifiers': [], 'authors_hash': 'x'}
+            with patch.object(self.app, 'resolve_authors') as resolve_authors, \
+                    patch.object(self.app, 'retrieve_record') as retrieve_record, \
+                    patch.object(tasks.task_match_claim, 'apply_async') as apply_async:
+                resolve_authors.side_effect = CircuitOpenException('solr', 20)
+                tasks.task_match_claim(claim)
+                apply_async.assert_called_once_with((claim,), countdown=20)
+                self.assertFalse(retrieve_record.called)
+        finally:
+            tasks.app = _app
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import mock
+import time
+import unittest
+
+from adsmsg import OrcidClaims
+from ADSOrcid.buffers import OutputCoalescer, StatusBatch
+
+
+class TestOutputCoalescer(unittest.TestCase):
+
+    def test_coalescing(self):
+        sent = []
+        buf = OutputCoalescer(sent.append, window=60)
+
+        for i in range(3):
+            buf.add(OrcidClaims(bibcode='bib1', authors=['a', 'b'], verified=['-', str(i)]))
+        buf.add({'bibcode': 'bib2', 'authors': ['a'], 'claims': {}})
+        self.assertEqual(len(buf), 2)
+        self.assertEqual(sent, [])
+
+        # nothing has expired yet
+        self.assertEqual(buf.flush(), 0)
+
+        self.assertEqual(buf.flush(force=True), 2)
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(sent[0].verified, ['-', '2'])
+        self.assertEqual(sent[1]['bibcode'], 'bib2')
+        self.assertEqual(buf.stats['output.received'], 4)
+        self.assertEqual(buf.stats['output.coalesced'], 2)
+        self.assertEqual(buf.stats['output.forwarded'], 2)
+
+    def test_timer_and_disabled_window(self):
+        sent = []
+        buf = OutputCoalescer(sent.append, window=0.2)
+        buf.add({'bibcode': 'bib1'})
+        buf.add({'bibcode': 'bib1'})
+        for _ in range(30):
+            if sent:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(len(buf), 0)
+
+        sent = []
+        buf = OutputCoalescer(sent.append, window=0)
+        buf.add({'bibcode': 'bib1'})
+        buf.add({'bibcode': 'bib1'})
+        self.assertEqual(len(sent), 2)
+
+    def test_maxsize_and_errors(self):
+        sent = []
+        buf = OutputCoalescer(sent.append, window=60, maxsize=2)
+        buf.add({'bibcode': 'bib1'})
+        buf.add({'bibcode': 'bib2'})
+        self.assertEqual(len(sent), 2)
+
+        def failing(msg):
+            raise Exception('broker is down')
+        buf = OutputCoalescer(failing, window=60)
+        buf.add({'bibcode': 'bib1'})
+        self.assertEqual(buf.flush(force=True), 0)
+        self.assertEqual(len(buf), 1)
+        buf.forward = sent.append
+        self.assertEqual(buf.flush(force=True), 1)
+
+
+class TestStatusBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.status_codes = []
+
+    def send(self, orcidid, status, ids):
+        self.requests.append((orcidid, status, ids))
+        r = mock.Mock()
+        r.status_code = self.status_codes.pop(0) if self.status_codes else 200
+        r.json.return_value = dict([(x, status) for x in ids if x.startswith('b')])
+        r.text = str(r.json.return_value)
+        return r
+
+    def test_grouping(self):
+        batch = StatusBatch(self.send, window=0)
+        batch.add('0000-0000-0000-0001', ['b1', 'doi1'], 'not in ADS')
+        batch.add('0000-0000-0000-0001', ['b2'], 'not in ADS')
+        batch.add('0000-0000-0000-0001', ['b3'], 'verified')
+        batch.add('0000-0000-0000-0002', ['b1'], 'verified')
+        self.assertEqual(self.requests, [])
+
+        self.assertEqual(batch.flush(), 4)
+        self.assertEqual(self.requests, [
+            ('0000-0000-0000-0001', 'not in ADS', ['b1', 'doi1', 'b2']),
+            ('0000-0000-0000-0001', 'verified', ['b3']),
+            ('0000-0000-0000-0002', 'verified', ['b1'])])
+        self.assertEqual(len(batch), 0)
+
+    def test_retries_and_mismatch(self):
+        logger = mock.Mock()
+        batch = StatusBatch(self.send, window=0, retries=2, retry_delay=0.01, logger=logger)
+
+        # a temporary failure
+        self.status_codes = [503, 200]
+        batch.add('0000-0000-0000-0001', ['b1'], 'verified')
+        self.assertEqual(batch.flush(), 1)
+        self.assertEqual(len(self.requests), 2)
+        self.assertFalse(logger.warning.called)
+
+        # the count is checked once per group
+        batch.add('0000-0000-0000-0001', ['b1'], 'verified')
+        batch.add('0000-0000-0000-0001', ['doi2'], 'verified')
+        batch.flush()
+        self.assertEqual(logger.warning.call_count, 1)
+        self.assertTrue('does not match input' in logger.warning.call_args[0][0])
+
+        # it gives up eventually
+        self.status_codes = [503, 503, 503]
+        batch.add('0000-0000-0000-0001', ['b1'], 'verified')
+        self.assertEqual(batch.flush(), 0)
+        self.assertTrue('not updated to: verified' in logger.warning.call_args[0][0])
+
+    def test_maxsize(self):
+        batch = StatusBatch(self.send, window=60, maxsize=2)
+        batch.add('0000-0000-0000-0001', ['b1'], 'verified')
+        self.assertEqual(self.requests, [])
+        batch.add('0000-0000-0000-0001', ['b2'], 'verified')
+        self.assertEqual(len(self.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import threading
+import time
+import unittest
+
+from ADSOrcid.caching import MemoCache, memoize
+
+
+def make_loader(cache, delay=0):
+    """Creates an object (like the app) with a memoized method."""
+    class _Loader(object):
+        _config = {'CACHES': {'test': {'maxsize': 2, 'ttl': 60}}}
+
+        def __init__(self):
+            self.calls = []
+
+        @memoize(cache)
+        def load(self, key, search=False):
+            self.calls.append(key)
+            time.sleep(delay)
+            if key == 'fail':
+                raise Exception('failed')
+            return key.upper()
+
+    return _Loader()
+
+
+class TestMemoCache(unittest.TestCase):
+
+    def test_memoize(self):
+        cache = MemoCache('test', maxsize=100, ttl=1)
+        loader = make_loader(cache)
+
+        self.assertEqual(loader.load('a'), 'A')
+        self.assertEqual(loader.load('a'), 'A')
+        self.assertEqual(loader.load('a', search=True), 'A')
+        self.assertEqual(loader.calls, ['a', 'a'])
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+        # size from the config
+        self.assertTrue(cache.configured)
+        loader.load('b')
+        loader.load('c')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+        # errors are not cached
+        self.assertRaises(Exception, loader.load, 'fail')
+        self.assertRaises(Exception, loader.load, 'fail')
+        self.assertEqual(loader.calls.count('fail'), 2)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_stampede(self):
+        cache = MemoCache('test')
+        loader = make_loader(cache, delay=0.2)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(loader.load('a')))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, ['A'] * 5)
+        self.assertEqual(loader.calls, ['a'])
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['waits'], 4)
+
+    def test_expiration(self):
+        now = [0]
+        cache = MemoCache('test', ttl=10)
+        cache._cache = cache._cache.__class__(10, 10, timer=lambda: now[0])
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        now[0] = 11
+        self.assertEqual(cache.get('a'), None)
+        cache.set('b', 1)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+import httpretty
+import mock
+import requests
+
+from ADSOrcid.http_client import RetryingSession, policies_from_config, retry_after
+
+
+class TestRetryingSession(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {
+            'API_SOLR_QUERY_ENDPOINT': 'http://api/v1/search/query/',
+            'API_ORCID_PROFILE_ENDPOINT': 'http://orcid/%s/record',
+            'HTTP_RETRY': {
+                'default': {'retries': 2, 'backoff': 1, 'max_backoff': 5},
+                'API_SOLR_QUERY_ENDPOINT': {'retries': 4},
+                'API_ORCID_PROFILE_ENDPOINT': {'retries': 0},
+                'API_MISSING': {'retries': 10},
+            }
+        }
+        self.client = RetryingSession(policies_from_config(self.config))
+
+    def test_policies(self):
+        self.assertEqual(self.client.get_policy('http://api/v1/search/query/?q=x')['retries'], 4)
+        self.assertEqual(self.client.get_policy('http://api/v1/search/query/')['backoff'], 1)
+        self.assertEqual(self.client.get_policy('http://orcid/0000/record')['retries'], 0)
+        self.assertEqual(self.client.get_policy('http://other/')['retries'], 2)
+        self.assertEqual(self.client.get_policy('http://other/')['timeout'], 30)
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(mock.Mock(headers={})), None)
+        self.assertEqual(retry_after(mock.Mock(headers={'Retry-After': '3'})), 3)
+        self.assertEqual(retry_after(mock.Mock(headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})), 0)
+        self.assertEqual(retry_after(mock.Mock(headers={'Retry-After': 'foo'})), None)
+
+    @httpretty.activate
+    def test_retries(self):
+        httpretty.register_uri(
+            httpretty.GET, 'http://api/v1/search/query/',
+            responses=[httpretty.Response(body='busy', status=503, adding_headers={'Retry-After': '2'}),
+                       httpretty.Response(body='err', status=500),
+                       httpretty.Response(body='ok', status=200)])
+        with mock.patch('ADSOrcid.http_client.time.sleep') as sleep:
+            r = self.client.get('http://api/v1/search/query/')
+            self.assertEqual(r.text, 'ok')
+            waits = [c[0][0] for c in sleep.call_args_list]
+            self.assertEqual(waits[0], 2)
+            self.assertTrue(1 <= waits[1] <= 2)
+            self.assertEqual(self.client.stats['http.retries'], 2)
+
+        # no retries, the failure is returned as before
+        httpretty.register_uri(httpretty.GET, 'http://orcid/0000/record', body='err', status=502)
+        with mock.patch('ADSOrcid.http_client.time.sleep') as sleep:
+            self.assertEqual(self.client.get('http://orcid/0000/record').status_code, 502)
+            self.assertFalse(sleep.called)
+
+        # client errors are not retried
+        httpretty.register_uri(httpretty.GET, 'http://other/', body='err', status=404)
+        with mock.patch('ADSOrcid.http_client.time.sleep') as sleep:
+            self.assertEqual(self.client.get('http://other/').status_code, 404)
+            self.assertFalse(sleep.called)
+
+    def test_connection_errors(self):
+        with mock.patch('requests.Session.request') as request, \
+                mock.patch('ADSOrcid.http_client.time.sleep') as sleep:
+            request.side_effect = [requests.exceptions.ConnectTimeout(), mock.Mock(status_code=200)]
+            self.assertEqual(self.client.get('http://other/').status_code, 200)
+            self.assertEqual(request.call_args[1]['timeout'], 30)
+            self.assertEqual(sleep.call_count, 1)
+
+            request.side_effect = requests.exceptions.ConnectionError()
+            self.assertRaises(requests.exceptions.ConnectionError, self.client.get, 'http://other/')
+            self.assertEqual(sleep.call_count, 3)
+            # the wait grows, but is never longer than max_backoff
+            self.assertTrue(all(c[0][0] <= 5 for c in sleep.call_args_list))
+
+
+if __name__ == '__main__':
+    unittest.main()
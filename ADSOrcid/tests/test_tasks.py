@@ -1,12 +1,15 @@
 import sys
 import os
+import json
 
 from mock import patch, PropertyMock
+from adsmsg import OrcidClaims
 import unittest
 import pytest
 import adsputils as utils
 from ADSOrcid import app, tasks
-from ADSOrcid.models import Base
+from ADSOrcid.models import Base, ClaimsLog, KeyValue, Records
+from celery.exceptions import SoftTimeLimitExceeded
 from ADSOrcid.exceptions import ProcessingException
 
 
@@ -17,7 +20,11 @@ class TestWorkers(unittest.TestCase):
         self._app = tasks.app
         self.app = app.ADSOrcidCelery(
             "test",
-            local_config={"SQLALCHEMY_URL": "sqlite:///", "SQLALCHEMY_ECHO": False},
+            local_config={
+                "SQLALCHEMY_URL": "sqlite:///",
+                "SQLALCHEMY_ECHO": False,
+                "STATUS_BATCH_WINDOW": 0,
+            },
         )
         tasks.app = self.app  # monkey-path the app object
 
@@ -206,10 +213,16 @@ class TestWorkers(unittest.TestCase):
             self.assertEqual(
                 (
                     next_task.call_args_list[0][0][0]["bibcode"],
-                    next_task.call_args_list[0][0][0]["author_list"],
+                    next_task.call_args_list[0][0][0]["authors_hash"],
                 ),
-                ("Bibcode2", ["author one", "Stern, D K"]),
+                ("Bibcode2", app.content_hash(["author one", "Stern, D K"])),
             )
+            self.assertFalse("author_list" in next_task.call_args_list[0][0][0])
+
+            # the author lists are kept in the storage
+            with self.app.session_scope() as session:
+                r = session.query(Records).filter_by(bibcode="Bibcode2").first()
+                self.assertEqual(json.loads(r.authors), ["author one", "Stern, D K"])
 
             self.assertEqual(
                 (
@@ -219,6 +232,229 @@ class TestWorkers(unittest.TestCase):
                 ("Bibcode2", ["id1", "id2"]),
             )
 
+    def test_task_index_orcid_profile_is_not_duplicated(self):
+        orcidid = "0000-0003-3041-2092"
+        with patch.object(self.app, "retrieve_orcid") as retrieve_orcid, patch.object(
+            self.app, "get_claims"
+        ) as get_claims, patch.object(
+            tasks.task_index_orcid_profile, "delay"
+        ) as delay:
+            # another worker is importing the profile
+            token = self.app.acquire_lease("import:" + orcidid, 60)
+            tasks.task_index_orcid_profile({"orcidid": orcidid})
+            self.assertFalse(retrieve_orcid.called)
+
+            # the forced request upgrades it, and is not started either
+            tasks.task_index_orcid_profile({"orcidid": orcidid, "force": True})
+            self.assertFalse(retrieve_orcid.called)
+            self.assertTrue(self.app.check_lease("import:" + orcidid, token)["upgrade"])
+            self.app.release_lease("import:" + orcidid, token)
+
+            # the upgrade arrives while the profile is skipped (unchanged),
+            # the forced import is started after the normal one
+            def get_claims_side_effect(*args, **kwargs):
+                self.app.acquire_lease("import:" + orcidid, 60, force=True)
+                return {}, {}, {}
+
+            get_claims.side_effect = get_claims_side_effect
+            retrieve_orcid.return_value = {"status": "blacklisted"}
+            with patch.object(tasks.app.client, "get"), patch.object(
+                self.app, "insert_claims"
+            ):
+                tasks.task_index_orcid_profile({"orcidid": orcidid})
+            delay.assert_called_once_with({"orcidid": orcidid, "force": True})
+            # and the lease was released
+            self.assertTrue(self.app.acquire_lease("import:" + orcidid, 60))
+
+    def test_task_index_orcid_profile_skips_stale_messages(self):
+        orcidid = "0000-0003-3041-2092"
+        self.app.insert_claims(
+            [
+                self.app.create_claim(
+                    bibcode="",
+                    orcidid=orcidid,
+                    provenance="OrcidImporter",
+                    status="#full-import",
+                    date="2017-01-02T00:00:00Z",
+                )
+            ]
+        )
+        with patch.object(self.app, "retrieve_orcid") as retrieve_orcid, patch.object(
+            tasks.app.client, "get"
+        ) as get, patch.object(self.app, "get_claims") as get_claims:
+            get_claims.return_value = {}, {}, {}
+            retrieve_orcid.return_value = {"status": None}
+
+            # the profile was imported after the update
+            tasks.task_index_orcid_profile(
+                {"orcidid": orcidid, "updated": "2017-01-01T00:00:00Z"}
+            )
+            self.assertFalse(retrieve_orcid.called)
+            self.assertFalse(get.called)
+
+            # but newer updates (or forced) are imported
+            tasks.task_index_orcid_profile(
+                {"orcidid": orcidid, "updated": "2017-01-03T00:00:00Z"}
+            )
+            self.assertEqual(get_claims.call_count, 1)
+            tasks.task_index_orcid_profile(
+                {"orcidid": orcidid, "updated": "2017-01-01T00:00:00Z", "force": True}
+            )
+            self.assertEqual(get_claims.call_count, 2)
+
+    def test_task_index_orcid_profile_resumes(self):
+        orcidid = "0000-0003-3041-2092"
+        with patch.object(self.app, "retrieve_orcid") as retrieve_orcid, patch.object(
+            tasks.app.client, "get"
+        ), patch.object(self.app, "get_claims") as get_claims, patch.object(
+            tasks.task_index_orcid_profile, "apply_async"
+        ) as apply_async:
+            retrieve_orcid.return_value = {"status": "blacklisted"}
+            get_claims.side_effect = SoftTimeLimitExceeded()
+            tasks.task_index_orcid_profile({"orcidid": orcidid, "lane": "bulk"})
+            self.assertTrue(get_claims.call_args[1]["resume"])
+
+            # the import continues in a new task, nothing was written yet
+            payload = apply_async.call_args[0][0][0]
+            self.assertTrue(payload["resume"])
+            self.assertEqual(payload["lane"], "bulk")
+            self.assertEqual(self.app.get_last_import(orcidid), None)
+
+            # the import is dated when the first chunk started
+            get_claims.side_effect = None
+            get_claims.return_value = {}, {}, {}
+            with self.app.session_scope() as session:
+                session.add(KeyValue(key="import-cursor:" + orcidid, value="{}"))
+                session.commit()
+            tasks.task_index_orcid_profile(dict(payload))
+            self.assertEqual(
+                self.app.get_last_import(orcidid), utils.get_date(payload["start"])
+            )
+            self.assertEqual(apply_async.call_count, 1)
+            with self.app.session_scope() as session:
+                self.assertEqual(session.query(KeyValue).count(), 0)
+                self.assertEqual(session.query(ClaimsLog).count(), 1)
+
+    def test_task_index_orcid_profile_in_parallel(self):
+        orcidid = "0000-0003-3041-2092"
+        self.app.conf["IMPORT_PARALLEL_MIN_WORKS"] = 3
+        self.app.conf["IMPORT_CHUNK_SIZE"] = 2
+        works = [{"work": i} for i in range(3)]
+        resolved = dict(
+            (
+                "bibcode%s" % i,
+                ("Bibcode%s" % i, utils.get_date("2017-01-01"), "provenance", ["id%s" % i], ["Stern, D K"]),
+            )
+            for i in range(3)
+        )
+        with patch.object(self.app, "retrieve_orcid") as retrieve_orcid, patch.object(
+            tasks.app.client, "get"
+        ), patch.object(self.app, "get_profile_works") as get_profile_works, patch.object(
+            self.app, "get_claims"
+        ) as get_claims, patch.object(
+            tasks, "chord"
+        ) as chord, patch.object(
+            self.app, "resolve_works"
+        ) as resolve_works, patch.object(
+            tasks.task_match_claim, "delay"
+        ) as match_claim:
+            retrieve_orcid.return_value = {
+                "status": None, "name": "Stern, D K", "account_id": None,
+                "updated": None, "id": 1, "facts": {},
+            }
+
+            # small profiles are imported by the task
+            get_profile_works.return_value = works[0:2], 2, utils.get_date()
+            get_claims.return_value = {}, {}, {}
+            tasks.task_index_orcid_profile({"orcidid": orcidid})
+            self.assertFalse(chord.called)
+            self.assertEqual(get_claims.call_args[1]["profile"], get_profile_works.return_value)
+
+            # the large ones are split
+            get_profile_works.return_value = works, 2, utils.get_date()
+            tasks.task_index_orcid_profile({"orcidid": orcidid, "lane": "bulk"})
+            header = chord.call_args[0][0]
+            self.assertEqual([sig.args[1] for sig in header], [works[0:2], works[2:]])
+            self.assertEqual(header[0].kwargs, {"lane": "bulk"})
+            body = chord.return_value.call_args[0][0]
+            self.assertEqual(body.task, tasks.task_merge_works.name)
+            payload, token = body.args
+            self.assertEqual(get_claims.call_count, 1)
+
+            # the lease is held until the callback is done
+            self.assertEqual(self.app.check_lease("import:" + orcidid, token)["token"], token)
+
+            resolve_works.side_effect = [
+                dict(list(resolved.items())[0:2]),
+                dict(list(resolved.items())[2:]),
+            ]
+            results = [tasks.task_resolve_works(*sig.args) for sig in header]
+            tasks.task_merge_works(results, payload, token, lane="bulk")
+
+            self.assertEqual(
+                sorted([c[0][0]["bibcode"] for c in match_claim.call_args_list]),
+                ["Bibcode0", "Bibcode1", "Bibcode2"],
+            )
+            self.assertEqual(match_claim.call_args[0][0]["lane"], "bulk")
+            self.assertEqual(
+                self.app.get_last_import(orcidid), utils.get_date(payload["start"])
+            )
+            self.assertEqual(self.app.check_lease("import:" + orcidid, token), None)
+
+    def test_route_by_lane(self):
+        route = tasks.route_by_lane
+        self.assertEqual(
+            route("ADSOrcid.tasks.task_index_orcid_profile", ({"orcidid": "x"},), {}, {}),
+            {"queue": "check-orcidid"},
+        )
+        self.assertEqual(
+            route(
+                "ADSOrcid.tasks.task_index_orcid_profile",
+                ({"orcidid": "x", "lane": "bulk"},),
+                {},
+                {},
+            ),
+            {"queue": "check-orcidid-bulk"},
+        )
+        self.assertEqual(
+            route("ADSOrcid.tasks.task_match_claim", ({"lane": "bulk"},), {}, {}),
+            {"queue": "match-claim-bulk"},
+        )
+        self.assertEqual(
+            route("ADSOrcid.tasks.task_output_results", ("msg",), {"lane": "bulk"}, {}),
+            {"queue": "output-results-bulk"},
+        )
+        self.assertEqual(
+            route("ADSOrcid.tasks.task_output_results", ("msg",), {"lane": None}, {}),
+            {"queue": "output-results"},
+        )
+        self.assertEqual(route("ADSOrcid.tasks.task_check_orcid_updates", ({},), {}, {}), None)
+
+    def test_route_by_bibcode(self):
+        route = tasks.route_by_lane
+        with patch.object(tasks, "MATCH_CLAIM_PARTITIONS", 8):
+            q = route("ADSOrcid.tasks.task_match_claim", ({"bibcode": "2015ApJ...1"},), {}, {})
+            self.assertRegex(q["queue"], r"^match-claim-[0-7]$")
+            # the same bibcode always goes into the same partition (of the lane)
+            self.assertEqual(
+                route("ADSOrcid.tasks.task_match_claim", ({"bibcode": "2015ApJ...1"},), {}, {}),
+                q,
+            )
+            self.assertEqual(
+                route(
+                    "ADSOrcid.tasks.task_match_claim",
+                    ({"bibcode": "2015ApJ...1", "lane": "bulk"},),
+                    {},
+                    {},
+                )["queue"],
+                q["queue"].replace("match-claim", "match-claim-bulk"),
+            )
+            # other tasks are not partitioned
+            self.assertEqual(
+                route("ADSOrcid.tasks.task_output_results", ({"bibcode": "2015ApJ...1"},), {}, {}),
+                {"queue": "output-results"},
+            )
+
     def test_match_claim_unknown_payload_should_return_warning(self):
         with pytest.raises(ProcessingException) as exception_info:
             tasks.task_match_claim([])
@@ -247,6 +483,56 @@ class TestWorkers(unittest.TestCase):
             "Unusable payload, missing orcidid {0}".format(claim),
         )
 
+    def test_task_match_claim_concurrent_update(self):
+        self.app.retrieve_record("BIBCODE22", ["Einstein, A", "Stern, D K"])
+        record_claims = self.app.record_claims
+        versions = []
+
+        def concurrent_update(*args, **kwargs):
+            if not versions:
+                # another worker claims the first author meanwhile
+                record_claims(
+                    "BIBCODE22",
+                    {"verified": ["-", "-"], "unverified": ["0000-0001-0000-0001", "-"]},
+                )
+            versions.append(kwargs.get("version"))
+            return record_claims(*args, **kwargs)
+
+        with patch.object(
+            self.app, "record_claims", side_effect=concurrent_update
+        ), patch.object(tasks.app.client, "post") as post, patch.object(
+            tasks.task_output_results, "delay"
+        ) as next_task:
+            r = PropertyMock()
+            r.json = lambda: {"BIBCODE22": "verified"}
+            r.status_code = 200
+            post.return_value = r
+
+            tasks.task_match_claim(
+                {
+                    "status": "claimed",
+                    "bibcode": "BIBCODE22",
+                    "name": "Stern, D K",
+                    "identifiers": [],
+                    "orcidid": "0000-0003-3041-2092",
+                    "author": ["Stern, D", "Stern, D K", "Stern, Daniel"],
+                    "account_id": None,
+                    "author_list": ["Einstein, A", "Stern, D K"],
+                }
+            )
+
+        # the claim was matched again against the updated record
+        self.assertEqual(versions, [0, 1])
+        self.assertEqual(
+            list(next_task.call_args[0][0].unverified),
+            ["0000-0001-0000-0001", "0000-0003-3041-2092"],
+        )
+        rec = self.app.retrieve_record("BIBCODE22", ["Einstein, A", "Stern, D K"])
+        self.assertEqual(rec["version"], 2)
+        self.assertEqual(
+            rec["claims"]["unverified"], ["0000-0001-0000-0001", "0000-0003-3041-2092"]
+        )
+
     def test_task_match_claim_cl_status_200_should_return_correct_message(self):
         with patch.object(self.app, "retrieve_record") as retrieve_record, patch.object(
             self.app, "record_claims"
@@ -312,6 +598,89 @@ class TestWorkers(unittest.TestCase):
                 next_task.call_args[0][0].toJSON(),
             )
 
+    def test_task_match_claim_unchanged_record_is_not_saved(self):
+        with patch.object(self.app, "retrieve_record") as retrieve_record, patch.object(
+            self.app, "record_claims"
+        ) as record_claims, patch.object(
+            tasks.app.client, "post"
+        ) as post, patch.object(
+            tasks.task_output_results, "delay"
+        ) as next_task:
+            retrieve_record.return_value = {
+                "bibcode": "BIBCODE22",
+                "authors": ["Einstein, A", "Socrates", "Stern, D K", "Munger, C"],
+                "claims": {
+                    "verified": ["-", "-", "-", "-"],
+                    "unverified": ["-", "-", "0000-0003-3041-2092", "-"],
+                },
+            }
+            r = PropertyMock()
+            data = {"BIBCODE22": "status"}
+            r.text = str(data)
+            r.json = lambda: data
+            r.status_code = 200
+            post.return_value = r
+
+            noops = app.stats["match-claim.noop"]
+            tasks.task_match_claim(
+                {
+                    "status": "unchanged",
+                    "bibcode": "BIBCODE22",
+                    "name": "Stern, D K",
+                    "identifiers": ["id1", "id2"],
+                    "orcidid": "0000-0003-3041-2092",
+                    "author": ["Stern, D", "Stern, D K", "Stern, Daniel"],
+                    "account_id": None,
+                    "author_list": ["Einstein, A", "Socrates", "Stern, D K", "Munger, C"],
+                }
+            )
+            record_claims.assert_not_called()
+            next_task.assert_not_called()
+            self.assertEqual(app.stats["match-claim.noop"], noops + 1)
+            # the status is still updated
+            self.assertEqual(post.call_args[1]["json"]["status"], "verified")
+
+    def test_task_match_claim_changed_authors_are_forwarded(self):
+        with patch.object(self.app, "retrieve_record") as retrieve_record, patch.object(
+            self.app, "record_claims"
+        ) as record_claims, patch.object(
+            tasks.app.client, "post"
+        ) as post, patch.object(
+            tasks.task_output_results, "delay"
+        ) as next_task:
+            # the claim is already there, but the author list was replaced
+            retrieve_record.return_value = {
+                "bibcode": "BIBCODE22",
+                "authors": ["Einstein, A", "Socrates", "Stern, D K", "Munger, C"],
+                "claims": {
+                    "verified": ["-", "-", "-", "-"],
+                    "unverified": ["-", "-", "0000-0003-3041-2092", "-"],
+                },
+                "version": 3,
+                "authors_changed": True,
+            }
+            post.return_value = PropertyMock(status_code=200, text="{}")
+
+            tasks.task_match_claim(
+                {
+                    "status": "unchanged",
+                    "bibcode": "BIBCODE22",
+                    "name": "Stern, D K",
+                    "identifiers": ["id1", "id2"],
+                    "orcidid": "0000-0003-3041-2092",
+                    "author": ["Stern, D", "Stern, D K", "Stern, Daniel"],
+                    "account_id": None,
+                    "author_list": ["Einstein, A", "Socrates", "Stern, D K", "Munger, C"],
+                }
+            )
+            record_claims.assert_called_once_with(
+                "BIBCODE22",
+                retrieve_record.return_value["claims"],
+                retrieve_record.return_value["authors"],
+                version=3,
+            )
+            self.assertEqual(next_task.call_args[0][0].toJSON()["authors"][2], "Stern, D K")
+
     def test_task_match_claim_no_cl_should_not_call_record_claims(self):
         with patch.object(self.app, "retrieve_record") as retrieve_record, patch.object(
             self.app, "record_claims"
@@ -606,6 +975,108 @@ class TestWorkers(unittest.TestCase):
                 next_task.call_args[0][0].toJSON(),
             )
 
+    def test_task_match_claim_resolves_authors_by_hash(self):
+        with patch.object(self.app, "retrieve_metadata") as retrieve_metadata, patch.object(
+            tasks.app.client, "post"
+        ) as post, patch.object(
+            tasks.task_output_results, "delay"
+        ) as next_task:
+            r = PropertyMock()
+            data = {"BIBCODE22": "status"}
+            r.text = str(data)
+            r.json = lambda: data
+            r.status_code = 200
+            post.return_value = r
+
+            authors = ["Einstein, A", "Socrates", "Stern, D K", "Munger, C"]
+            hashes = self.app.store_record_authors({"BIBCODE22": authors})
+            claim = {
+                "status": "claimed",
+                "bibcode": "BIBCODE22",
+                "name": "Stern, D K",
+                "identifiers": ["id1", "id2"],
+                "orcidid": "0000-0003-3041-2092",
+                "author": ["Stern, D", "Stern, D K", "Stern, Daniel"],
+                "account_id": None,
+                "authors_hash": hashes["BIBCODE22"],
+            }
+            tasks.task_match_claim(dict(claim))
+
+            self.assertFalse(retrieve_metadata.called)
+            self.assertEqual(next_task.call_args[0][0].toJSON()["authors"], authors)
+            self.assertEqual(
+                next_task.call_args[0][0].toJSON()["unverified"],
+                ["-", "-", "0000-0003-3041-2092", "-"],
+            )
+
+            # the record has changed in the meantime; the current list comes from the api
+            retrieve_metadata.return_value = {"author": ["Stern, D K", "Einstein, A"]}
+            claim["authors_hash"] = "outdated"
+            tasks.task_match_claim(dict(claim))
+
+            retrieve_metadata.assert_called_with("BIBCODE22")
+            self.assertEqual(
+                next_task.call_args[0][0].toJSON()["authors"], ["Stern, D K", "Einstein, A"]
+            )
+
+    def test_task_match_claim_batches_status_updates(self):
+        with patch.object(self.app, "retrieve_record") as retrieve_record, patch.object(
+            self.app, "record_claims"
+        ) as record_claims, patch.object(
+            tasks.app.client, "post"
+        ) as post, patch.object(
+            tasks.task_output_results, "delay"
+        ) as next_task:
+            self.app._config["STATUS_BATCH_WINDOW"] = 60
+            retrieve_record.side_effect = lambda bibcode, authors: {
+                "bibcode": bibcode,
+                "authors": ["Einstein, A", "Stern, D K"],
+                "claims": {},
+            }
+            r = PropertyMock()
+            data = {"BIBCODE1": "verified", "BIBCODE2": "verified"}
+            r.text = str(data)
+            r.json = lambda: data
+            r.status_code = 200
+            post.return_value = r
+
+            for bibcode in ("BIBCODE1", "BIBCODE2"):
+                tasks.task_match_claim(
+                    {
+                        "status": "claimed",
+                        "bibcode": bibcode,
+                        "identifiers": ["id-" + bibcode],
+                        "orcidid": "0000-0003-3041-2092",
+                        "author": ["Stern, D K"],
+                        "account_id": None,
+                        "author_list": ["Einstein, A", "Stern, D K"],
+                    }
+                )
+            self.assertFalse(post.called)
+
+            tasks.flush_buffers()
+            self.assertEqual(post.call_count, 1)
+            self.assertEqual(post.call_args[1]["json"]["status"], "verified")
+            self.assertEqual(
+                sorted(post.call_args[1]["json"]["bibcodes"]),
+                ["BIBCODE1", "BIBCODE2", "id-BIBCODE1", "id-BIBCODE2"],
+            )
+
+    def test_task_output_results(self):
+        with patch.object(self.app, "forward_message") as forward_message:
+            self.app._config["OUTPUT_COALESCE_WINDOW"] = 60
+            for x in ("0000-0003-3041-2092", "0000-0003-3041-2093"):
+                tasks.task_output_results(
+                    OrcidClaims(bibcode="BIBCODE22", authors=["Stern, D K"], verified=[x])
+                )
+            self.assertFalse(forward_message.called)
+
+            tasks.flush_buffers()
+            self.assertEqual(forward_message.call_count, 1)
+            self.assertEqual(
+                forward_message.call_args[0][0].verified, ["0000-0003-3041-2093"]
+            )
+
     def test_task_check_orcid_updates(self):
         with patch.object(tasks.app.client, "get") as get, patch.object(
             tasks.task_index_orcid_profile, "delay"
@@ -632,11 +1103,91 @@ class TestWorkers(unittest.TestCase):
                 next_task.call_args_list[1][0][0]["orcidid"], "0000-0003-3041-2093"
             )
             self.assertEqual(
-                str(recheck_task.call_args_list[0]),
-                "call(args=({'errcount': 0},), countdown=300)",
+                next_task.call_args_list[1][0][0]["updated"], data[1]["updated"]
             )
+            self.assertEqual(recheck_task.call_args_list[0][1]["countdown"], 300)
+            msg = recheck_task.call_args_list[0][1]["args"][0]
+            self.assertEqual(msg["errcount"], 0)
+            self.assertTrue(msg["lease"])
+
+            # only one poller is active; the others quit (without scheduling)
+            tasks.task_check_orcid_updates({})
+            self.assertEqual(recheck_task.call_count, 1)
+            self.assertEqual(next_task.call_count, 2)
+
+            # the successor (holding the lease) continues
+            tasks.task_check_orcid_updates(msg)
+            self.assertEqual(recheck_task.call_count, 2)
+            self.assertEqual(recheck_task.call_args_list[1][1]["args"][0]["lease"], msg["lease"])
+            self.assertTrue(recheck_task.call_args_list[1][1]["countdown"] > 290)
+            self.assertEqual(next_task.call_count, 2)
+
+            # the checkpoint can't be moved by a poller that read an old value
+            with self.app.session_scope() as session:
+                last_check = session.query(KeyValue).filter_by(key="last.check").first().value
+                self.assertFalse(
+                    self.app.compare_and_swap(session, "last.check", "1974-11-09T22:56:52.518001Z", "foo")
+                )
+                self.assertTrue(
+                    self.app.compare_and_swap(session, "last.check", last_check, "foo")
+                )
            
 
+    def test_task_check_orcid_updates_cadence(self):
+        self.app.conf["ORCID_UPDATES_PAGE_SIZE"] = 2
+        with patch.object(tasks.app.client, "get") as get, patch.object(
+            tasks.task_index_orcid_profile, "delay"
+        ) as next_task, patch.object(
+            tasks.task_check_orcid_updates, "apply_async"
+        ) as recheck_task:
+            pages = [
+                [
+                    {"orcid_id": "0000-0003-3041-2091", "updated": "2017-01-01T00:00:00Z"},
+                    {"orcid_id": "0000-0003-3041-2092", "updated": "2017-01-02T00:00:00Z"},
+                ],
+                [{"orcid_id": "0000-0003-3041-2093", "updated": "2017-01-03T00:00:00Z"}],
+            ]
+
+            def side_effect(url, **kwargs):
+                r = PropertyMock()
+                data = pages.pop(0) if pages else []
+                r.text = data and str(data) or ""
+                r.json = lambda: data
+                r.status_code = 200
+                return r
+
+            get.side_effect = side_effect
+
+            # full pages are fetched back-to-back
+            tasks.task_check_orcid_updates({})
+            self.assertEqual(get.call_count, 2)
+            self.assertEqual(next_task.call_count, 3)
+            self.assertEqual(recheck_task.call_args[1]["countdown"], 300)
+            with self.app.session_scope() as session:
+                self.assertEqual(
+                    session.query(KeyValue).filter_by(key="last.check").first().value,
+                    "2017-01-03T00:00:00+00:00",
+                )
+            self.assertTrue(app.stats["check-updates.lag"] > 0)
+
+            # idle feed widens the interval
+            msg = recheck_task.call_args[1]["args"][0]
+            tasks.task_check_orcid_updates(msg)
+            self.assertEqual(recheck_task.call_args[1]["countdown"], 300)
+            tasks.task_check_orcid_updates(msg)
+            self.assertEqual(recheck_task.call_args[1]["countdown"], 600)
+
+            # errors back off exponentially (with jitter)
+            r = PropertyMock()
+            r.status_code = 503
+            get.side_effect = None
+            get.return_value = r
+            tasks.task_check_orcid_updates(msg)
+            self.assertTrue(300 <= recheck_task.call_args[1]["countdown"] <= 600)
+            tasks.task_check_orcid_updates(msg)
+            self.assertTrue(600 <= recheck_task.call_args[1]["countdown"] <= 1200)
+            self.assertEqual(next_task.call_count, 3)
+
 
 if __name__ == "__main__":
     unittest.main()
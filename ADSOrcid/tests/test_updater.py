@@ -67,7 +67,7 @@ class Test(unittest.TestCase):
           },
           0.9                     
         )
-        self.assertEqual(r, ('verified', 12))
+        self.assertEqual(r, ('verified', 12, True))
         self.assertEqual(doc['claims']['verified'], 
             ['-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '0000-0003-2686-9241', '-'])
         
@@ -103,7 +103,7 @@ class Test(unittest.TestCase):
           },
           0.9                       
         )
-        self.assertEqual(r, ('verified', 12))
+        self.assertEqual(r, ('verified', 12, True))
         self.assertEqual(doc['claims']['verified'], 
             ['-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '0000-0003-2686-9241', '-'])
         
@@ -123,10 +123,26 @@ class Test(unittest.TestCase):
             },
             0.9
         )
-        self.assertEqual(r, ('verified', 13))
+        self.assertEqual(r, ('verified', 13, True))
         self.assertEqual(doc['claims']['verified'],
                          ['-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '0000-0003-2686-9241', '0000-0001-2345-6789'])
 
+        # the same claim again doesn't change anything
+        r = updater.update_record(
+            doc,
+            {
+                'bibcode': '2015ApJ...799..123B',
+                'orcidid': '0000-0001-2345-6789',
+                'account_id': '2',
+                'orcid_name': ['Yildiz, Umut'],
+                'author': ['Yildiz, U', 'Yildiz, Umut'],
+                'author_norm': ['Yildiz, U'],
+                'name': 'Yildiz, Umut'
+            },
+            0.9
+        )
+        self.assertEqual(r, ('verified', 13, False))
+
         doc_lev = {
             'bibcode': '2015ApJ...799..123B',
             'authors': [
@@ -160,7 +176,7 @@ class Test(unittest.TestCase):
             },
             0.75
         )
-        self.assertEqual(r_lev, ('verified', 13))
+        self.assertEqual(r_lev, ('verified', 13, True))
         self.assertEqual(doc_lev['claims']['verified'],
                          ['-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '-', '0000-0001-2345-6789'])
 
@@ -188,7 +204,7 @@ class Test(unittest.TestCase):
             },
             0.75
         )
-        self.assertEqual(r_blank, ('verified',5))
+        self.assertEqual(r_blank, ('verified', 5, True))
         self.assertEqual(doc_blank['claims']['verified'],
                          ['-','-','-','-','-','0000-0009-8765-4321'])
 
@@ -259,7 +275,7 @@ class Test(unittest.TestCase):
                 },
                 0.8
             )
-            self.assertEqual(r, ('verified', 5))
+            self.assertEqual(r, ('verified', 5, True))
             self.assertEqual(doc1['claims']['verified'],
                              ['-', '-', '-', '-', '-', '0000-0003-2686-9241', '-'])
             # find_orcid_position should be bypassed by the exact string match
@@ -5,6 +5,7 @@ Library for updating papers (db claims/records).
 
 from builtins import str
 from ADSOrcid import names
+from ADSOrcid.exceptions import StaleRecordException
 from ADSOrcid.models import ClaimsLog, Records
 from adsputils import get_date, setup_logging, u2asc
 from datetime import timedelta
@@ -46,8 +47,9 @@ def update_record(rec, claim, min_levenshtein):
             We use those field to find out which author made the
             claim.
 
-    :return: tuple(clain_category, position) or None if no record
-        was updated
+    :return: tuple(clain_category, position, changed) or None if no record
+        was updated; `changed` is False when the claims of the record are
+        the same as before (e.g. the orcidid already was at that position)
     """
     assert(isinstance(rec, dict))
     assert(isinstance(claim, dict))
@@ -58,6 +60,7 @@ def update_record(rec, claim, min_levenshtein):
     claims = rec.get('claims', {})
     rec['claims'] = claims
     authors = rec.get('authors', [])
+    original = json.dumps(claims, sort_keys=True)
 
     # make sure the claims have the necessary structure
     fld_name = 'unverified'
@@ -86,7 +89,7 @@ def update_record(rec, claim, min_levenshtein):
             and rec.get('status').get('blacklisted') \
             and claim['orcidid'] in rec.get('status').get('blacklisted'):
         if modified:
-            return ('removed', -1)
+            return ('removed', -1, True)
         else:
             return None
 
@@ -112,11 +115,11 @@ def update_record(rec, claim, min_levenshtein):
             continue
         if author_clean in claims_clean:
             claims[fld_name][aidx] = claim.get('status', 'created') == 'removed' and '-' or orcidid
-            return (fld_name, aidx)
+            return (fld_name, aidx, json.dumps(claims, sort_keys=True) != original)
         # also try the transliterated/ascii form of the author name
         elif u2asc(author_clean) in claims_clean:
             claims[fld_name][aidx] = claim.get('status', 'created') == 'removed' and '-' or orcidid
-            return (fld_name, aidx)
+            return (fld_name, aidx, json.dumps(claims, sort_keys=True) != original)
         aidx += 1
 
     # if there is no exact match, try on Levenshtein distance, searching using descending priority
@@ -136,10 +139,10 @@ def update_record(rec, claim, min_levenshtein):
                     continue
 
                 claims[fld_name][idx] = claim.get('status', 'created') == 'removed' and '-' or orcidid
-                return (fld_name, idx)
+                return (fld_name, idx, json.dumps(claims, sort_keys=True) != original)
 
     if modified:
-        return ('removed', -1)
+        return ('removed', -1, True)
 
 def find_orcid_position(authors_list, name_variants,
                         min_levenshtein=0.9):
@@ -237,10 +240,10 @@ def reindex_all_claims(app, orcidid, since=None, ignore_errors=False):
     last_check = get_date(since or '1974-11-09T22:56:52.518001Z')
     recs_modified = set()
 
+    author = app.retrieve_orcid(orcidid)
+    claimed = set()
+    removed = set()
     with app.session_scope() as session:
-        author = app.retrieve_orcid(orcidid)
-        claimed = set()
-        removed = set()
         for claim in session.query(ClaimsLog).filter(
                         and_(ClaimsLog.orcidid == orcidid, ClaimsLog.created > last_check)
                         ).all():
@@ -249,41 +252,54 @@ def reindex_all_claims(app, orcidid, since=None, ignore_errors=False):
             elif claim.status == 'removed':
                 removed.add(claim.bibcode)
 
-        with app.session_scope() as session:
-            for bibcode in removed:
-                r = session.query(Records).filter_by(bibcode=bibcode).first()
-                if r is None:
-                    continue
-                rec = r.toJSON()
-                if _remove_orcid(rec, orcidid):
-                    r.claims = json.dumps(rec.get('claims'))
-                    r.updated = get_date()
+    def _remove(rec):
+        return _remove_orcid(rec, orcidid)
+
+    def _claim(rec):
+        claim = {'bibcode': rec['bibcode'], 'orcidid': orcidid}
+        claim.update(author.get('facts', {}))
+        _claims = update_record(rec, claim, app.conf.get('MIN_LEVENSHTEIN_RATIO', 0.9))
+        if _claims and not _claims[2]:
+            app.incr_stat('reindex.noop')
+        return bool(_claims and _claims[2])
+
+    for bibcodes, modify in ((removed, _remove), (claimed, _claim)):
+        for bibcode in bibcodes:
+            try:
+                if _modify_record(app, bibcode, modify):
                     recs_modified.add(bibcode)
+            except Exception as e:
+                if ignore_errors:
+                    app.logger.error('Error processing {0} {1}'.format(bibcode, orcidid))
+                else:
+                    raise e
 
-            for bibcode in claimed:
-                r = session.query(Records).filter_by(bibcode=bibcode).first()
-                if r is None:
-                    continue
-                rec = r.toJSON()
+    return list(recs_modified)
 
-                claim = {'bibcode': bibcode, 'orcidid': orcidid}
-                claim.update(author.get('facts', {}))
-                try:
-                    _claims = update_record(rec, claim, app.conf.get('MIN_LEVENSHTEIN_RATIO', 0.9))
-                    if _claims:
-                        r.claims = json.dumps(rec.get('claims', {}))
-                        r.updated = get_date()
-                        recs_modified.add(bibcode)
-                except Exception as e:
-                    if ignore_errors:
-                        app.logger.error('Error processing {0} {1}'.format(bibcode, orcidid))
-                    else:
-                        raise e
 
+def _modify_record(app, bibcode, modify):
+    """Read-modify-write of the claims of the record; modify(rec) updates
+    the record (dict) and returns True if it changed it. If somebody
+    updated the record meanwhile, it is read (and modified) again.
 
-            session.commit()
-
-        return list(recs_modified)
+    :return: True if the record was updated
+    """
+    retries = app.conf.get('RECORDS_CONFLICT_RETRIES', 3)
+    for attempt in range(retries + 1):
+        with app.session_scope() as session:
+            r = session.query(Records).filter_by(bibcode=bibcode).first()
+            if r is None:
+                return False
+            rec = r.toJSON()
+            version = r.version
+        if not modify(rec):
+            return False
+        try:
+            app.record_claims(bibcode, rec.get('claims', {}), version=version)
+            return True
+        except StaleRecordException:
+            if attempt == retries:
+                raise
 
 
 def get_all_touched_profiles(app, since='1974-11-09T22:56:52.518001Z', max_failures=5, max_cons_failures=2):
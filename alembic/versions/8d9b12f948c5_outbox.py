@@ -0,0 +1,32 @@
+"""Outbox of records waiting to be forwarded
+
+Revision ID: 8d9b12f948c5
+Revises: fc60c6527b4e
+Create Date: 2026-10-19 11:40:02.913554
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d9b12f948c5'
+down_revision = 'fc60c6527b4e'
+
+from alembic import op
+import sqlalchemy as sa
+
+from sqlalchemy import Column, String, Integer, TIMESTAMP, Index
+
+
+def upgrade():
+    op.create_table('outbox',
+        Column('id', Integer, primary_key=True),
+        Column('bibcode', String(19), nullable=False),
+        Column('payload_hash', String(40)),
+        Column('created', TIMESTAMP),
+        Column('sent', TIMESTAMP),
+        Index('ix_outbox_bibcode', 'bibcode'),
+        Index('ix_outbox_sent', 'sent')
+    )
+
+
+def downgrade():
+    op.drop_table('outbox')
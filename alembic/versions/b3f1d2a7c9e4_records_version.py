@@ -0,0 +1,23 @@
+"""Version of the records (optimistic locking)
+
+Revision ID: b3f1d2a7c9e4
+Revises: 8d9b12f948c5
+Create Date: 2026-10-19 14:02:17.530114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b3f1d2a7c9e4'
+down_revision = '8d9b12f948c5'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+
+def upgrade():
+    op.add_column('records', sa.Column('version', sa.Integer(), server_default='0'))
+
+
+def downgrade():
+    op.drop_column('records', 'version')
@@ -0,0 +1,37 @@
+"""Composite indexes of the claims (per-author lookups)
+
+Revision ID: c4e8a1f0b2d6
+Revises: b3f1d2a7c9e4
+Create Date: 2026-10-19 16:21:45.108327
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a1f0b2d6'
+down_revision = 'b3f1d2a7c9e4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# (orcidid, status, id): the last #full-import of the author (get_last_import,
+# get_known_claims) is found without scanning all the claims of the author
+# (orcidid, created): claims of the author since the date (updater)
+#
+# on a large table, build them beforehand (without locking the writes) by:
+#   CREATE INDEX CONCURRENTLY ix_claims_orcidid_status_id ON claims (orcidid, status, id);
+#   CREATE INDEX CONCURRENTLY ix_claims_orcidid_created ON claims (orcidid, created);
+# then the upgrade only notes the revision; see scripts/explain_claims.py for the plans
+
+def upgrade():
+    conn = op.get_bind()
+    existing = set(i['name'] for i in sa.inspect(conn).get_indexes('claims'))
+    if 'ix_claims_orcidid_status_id' not in existing:
+        op.create_index('ix_claims_orcidid_status_id', 'claims', ['orcidid', 'status', 'id'])
+    if 'ix_claims_orcidid_created' not in existing:
+        op.create_index('ix_claims_orcidid_created', 'claims', ['orcidid', 'created'])
+
+
+def downgrade():
+    op.drop_index('ix_claims_orcidid_created', 'claims')
+    op.drop_index('ix_claims_orcidid_status_id', 'claims')
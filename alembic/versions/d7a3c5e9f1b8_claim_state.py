@@ -0,0 +1,46 @@
+"""Latest claim per author and bibcode (claim_state)
+
+Revision ID: d7a3c5e9f1b8
+Revises: c4e8a1f0b2d6
+Create Date: 2026-10-19 17:48:12.664021
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd7a3c5e9f1b8'
+down_revision = 'c4e8a1f0b2d6'
+
+from alembic import op
+import sqlalchemy as sa
+
+from sqlalchemy import Column, String, TIMESTAMP
+
+
+def upgrade():
+    op.create_table('claim_state',
+        Column('orcidid', String(19), primary_key=True),
+        Column('bibcode', String(19), primary_key=True),
+        Column('status', String(255)),
+        Column('created', TIMESTAMP)
+    )
+
+    # the latest claim of every (author, bibcode) after the last full import
+    # of the author (what ADSOrcidCelery.get_known_claims used to replay)
+    op.execute("""
+        INSERT INTO claim_state (orcidid, bibcode, status, created)
+        SELECT c.orcidid, c.bibcode, c.status, c.created
+        FROM claims c JOIN (
+            SELECT l.orcidid, l.bibcode, max(l.id) AS id
+            FROM claims l LEFT JOIN (
+                SELECT orcidid, max(id) AS id FROM claims
+                WHERE status = '#full-import' GROUP BY orcidid
+            ) f ON f.orcidid = l.orcidid
+            WHERE l.bibcode IS NOT NULL AND l.bibcode != '' AND l.status != '#full-import'
+                AND l.id > coalesce(f.id, 0)
+            GROUP BY l.orcidid, l.bibcode
+        ) m ON m.id = c.id
+    """)
+
+
+def downgrade():
+    op.drop_table('claim_state')
@@ -0,0 +1,23 @@
+"""Hash of the last forwarded record
+
+Revision ID: fc60c6527b4e
+Revises: 322f6182f133
+Create Date: 2026-10-19 09:12:41.118310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'fc60c6527b4e'
+down_revision = '322f6182f133'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+
+def upgrade():
+    op.add_column('records', sa.Column('output_hash', sa.String(40)))
+
+
+def downgrade():
+    op.drop_column('records', 'output_hash')
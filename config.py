@@ -39,6 +39,77 @@ OUTPUT_TASKNAME = 'adsmp.tasks.task_update_record'
 #OUTPUT_EXCHANGE = 'master_pipeline'
 OUTPUT_QUEUE = 'update-record'
 
+# Results for the same bibcode that arrive within this window (in secs) are
+# coalesced; only the latest state of the record is forwarded (0 disables it)
+OUTPUT_COALESCE_WINDOW = 10
+# max number of records kept in the buffer (of one worker process)
+OUTPUT_COALESCE_MAXSIZE = 1000
+
+# Every update of a record is noted in the outbox (in the same transaction); the
+# relay (run.py --repush_claims) forwards records that were never sent, reading
+# the outbox in batches and skipping the entries that are younger than the delay (secs)
+OUTBOX_BATCH_SIZE = 1000
+OUTBOX_RELAY_DELAY = 300
+# the relay runs every OUTBOX_RELAY_INTERVAL secs (task_drain_outbox, started by the
+# poller of the updates; 0 = only by run.py) and forwards at most OUTBOX_RELAY_LIMIT
+# records each time; the sent entries are deleted after OUTBOX_RETENTION secs
+OUTBOX_RELAY_INTERVAL = 300
+OUTBOX_RELAY_LIMIT = 10000
+OUTBOX_RETENTION = 86400
+
+# Only one import of the same orcid profile runs at a time (the lease is kept in
+# the db); if the worker dies, the lease expires after this many secs
+IMPORT_LEASE_TTL = 3600
+
+# The works of a profile are resolved in chunks of this size; the progress is saved
+# after every chunk and when the task hits CELERYD_TASK_SOFT_TIME_LIMIT (then the
+# import continues in a new task)
+IMPORT_CHUNK_SIZE = 50
+
+# The claims are inserted in bulk (multi-row INSERT ... RETURNING on postgres), at
+# most this many rows per statement
+CLAIMS_INSERT_BATCH_SIZE = 1000
+
+# run.py --compact removes the 'unchanged'/'forced' claims written before the last
+# full import of the author that is older than this many days (the rows are deleted
+# in batches of this size, each in its own transaction)
+CLAIMS_RETENTION_DAYS = 90
+CLAIMS_COMPACT_BATCH_SIZE = 1000
+
+# Profiles with at least this many works are resolved in parallel: the chunks are
+# sent to many workers (task_resolve_works) and a chord callback (task_merge_works)
+# does the diff; chords need a result backend, e.g. CELERY_RESULT_BACKEND = 'rpc://'
+# (if a chunk fails, the profile is locked until IMPORT_LEASE_TTL). 0 = disabled
+IMPORT_PARALLEL_MIN_WORKS = 0
+
+# run.py --local-batch: threads fetching the profiles, processes matching the
+# claims and max number of claims waiting for the matching (the progress is
+# checkpointed in the KeyValue table, under 'local-batch')
+LOCAL_BATCH_IO_WORKERS = 8
+LOCAL_BATCH_MATCH_WORKERS = 4
+LOCAL_BATCH_QUEUE_SIZE = 1000
+
+# size and time-to-live (secs) of the in-memory caches (per worker process) of:
+# authors (db), public orcid profiles, ads orcid profiles, metadata (ads api)
+CACHES = {
+    'author': {'maxsize': 1024, 'ttl': 3600},
+    'orcid_profile': {'maxsize': 1024, 'ttl': 3600},
+    'ads_profile': {'maxsize': 1024, 'ttl': 3600},
+    'metadata': {'maxsize': 2048, 'ttl': 3600},
+}
+
+# Number of partitions (queues match-claim-0..N-1 and match-claim-bulk-0..N-1) of
+# the claims; claims of the same bibcode always land in the same partition. Run
+# one worker (with concurrency 1) per partition. 1 means no partitioning
+MATCH_CLAIM_PARTITIONS = 1
+
+# Records are updated with optimistic locking (Records.version); when another
+# worker updated the record meanwhile, the claim is matched again (at most N times)
+RECORDS_CONFLICT_RETRIES = 3
+
+# how often (in secs) the workers log their counters
+STATS_LOG_INTERVAL = 300
+
 
 
 
@@ -54,9 +125,57 @@ API_ORCID_UPDATE_BIB_STATUS = API_ENDPOINT + '/v1/orcid/update-status/%s'
 API_ORCID_UPDATE_PROFILE = API_ENDPOINT + '/v1/orcid/update-orcid-profile/%s'
 API_TOKEN = 'fixme'
 
+# Updates of the claims' status (in the orcid microservice) are grouped by
+# orcidid and status; they wait (in secs) before being sent in bulk (0 means
+# every claim is sent immediately)
+STATUS_BATCH_WINDOW = 5
+STATUS_BATCH_MAXSIZE = 100
+# failed requests are repeated (with exponential backoff)
+STATUS_BATCH_RETRIES = 2
+STATUS_BATCH_RETRY_DELAY = 0.5
+
+# How often (in secs) we check the orcid microservice for updated profiles;
+# only one poller runs at a time, its lease expires after the next check is
+# overdue by this many secs (so that another worker can start polling)
+ORCID_CHECK_FOR_CHANGES = 60 * 5
+ORCID_CHECK_LEASE_GRACE = 600
+# when the feed is idle the interval doubles (up to the max), when the service
+# fails we back off exponentially (up to the max)
+ORCID_CHECK_MAX_WAIT = 60 * 60
+# number of profiles the updates endpoint returns at once; while the pages are
+# full, they are fetched back-to-back (at most ORCID_UPDATES_MAX_PAGES per check)
+ORCID_UPDATES_PAGE_SIZE = 100
+ORCID_UPDATES_MAX_PAGES = 50
+
 # The ORCID API public endpoint
 API_ORCID_PROFILE_ENDPOINT = 'https://pub.orcid.org/v2.0/%s/record'
 
+# Retries of the http requests (app.client) that failed with 5xx/429, a connection
+# error or a timeout: exponential backoff (secs) with jitter, or as long as the
+# server asks in Retry-After (never more than max_backoff). The keys are names of
+# the endpoints above, their policy overrides the 'default' one
+HTTP_RETRY = {
+    'default': {'retries': 3, 'backoff': 0.5, 'max_backoff': 10, 'timeout': 30},
+    'API_SOLR_QUERY_ENDPOINT': {'retries': 5},
+    'API_ORCID_UPDATE_BIB_STATUS': {'retries': 5},
+    'API_ORCID_PROFILE_ENDPOINT': {'retries': 2},
+}
+
+# Circuit breakers of the remote services (the state is shared by all workers through
+# the db, see `run.py -k`): after `failures` consecutive failed requests (5xx or errors,
+# after the retries) the service is not called for `reset_timeout` secs; the tasks
+# that need it are put back to the queue (delayed) instead. The workers re-read the
+# state every `refresh` secs
+CIRCUIT_BREAKERS = {
+    'solr': {'endpoints': ['API_SOLR_QUERY_ENDPOINT'],
+             'failures': 5, 'reset_timeout': 60, 'refresh': 5},
+    'orcid': {'endpoints': ['API_ORCID_PROFILE_ENDPOINT'],
+              'failures': 5, 'reset_timeout': 120, 'refresh': 5},
+    'microservice': {'endpoints': ['API_ORCID_EXPORT_PROFILE', 'API_ORCID_UPDATES_ENDPOINT',
+                                   'API_ORCID_UPDATE_BIB_STATUS', 'API_ORCID_UPDATE_PROFILE'],
+                     'failures': 5, 'reset_timeout': 60, 'refresh': 5},
+}
+
 # Levenshtein.ration() to compute similarity between two strings; if
 # lower than this, we refuse to match names, eg.
 # Levenshtein.ratio('Neumann, John', 'Neuman, J')
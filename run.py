@@ -25,6 +25,7 @@ warnings.simplefilter('ignore', exceptions.InsecurePlatformWarning)
 from adsputils import get_date
 from adsmsg import OrcidClaims
 from ADSOrcid import updater, tasks
+from ADSOrcid.exceptions import StaleRecordException
 from ADSOrcid.models import ClaimsLog, KeyValue, Records, AuthorInfo
 
 # ============================= INITIALIZATION ==================================== #
@@ -38,9 +39,39 @@ logger = setup_logging('run.py', proj_home=proj_home,
 
 app = tasks.app
 
+# lane of the submitted messages; the bulk lane has its own queues (and
+# workers) so the interactive requests are not delayed by us
+LANE = tasks.BULK_LANE
+
+# when set (--local-batch), the profiles are imported by this process
+# (batch.LocalPipeline) instead of being sent to the workers
+LOCAL_BATCH = None
+
 # =============================== FUNCTIONS ======================================= #
 
 
+def submit_profiles(orcidids, force=False):
+    """
+    Sends the profiles for import: to the queue, or (with --local-batch)
+    to the in-process pipeline.
+
+    :param: orcidids - iterable of orcid ids
+    :param: force - bool, forced import
+    """
+    if LOCAL_BATCH is not None:
+        counts = LOCAL_BATCH.run(orcidids, force=force)
+        print('Local batch finished: {0}'.format(json.dumps(counts, sort_keys=True)))
+        return
+
+    for orcidid in orcidids:
+        try:
+            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': force, 'lane': LANE})
+        except Exception: # potential backpressure (we are too fast)
+            time.sleep(2)
+            print('Conn problem, retrying...', orcidid)
+            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': force, 'lane': LANE})
+
+
 def reindex_claims(since=None, orcid_ids=None, **kwargs):
     """
     Re-runs all claims, both from the pipeline and
@@ -53,7 +84,7 @@ def reindex_claims(since=None, orcid_ids=None, **kwargs):
     """
     if orcid_ids:
         for oid in orcid_ids:
-            tasks.task_index_orcid_profile.delay({'orcidid': oid, 'force': True})
+            tasks.task_index_orcid_profile.delay({'orcidid': oid, 'force': True, 'lane': LANE})
         if not since:
             print('Done (just the supplied orcidids)')
             return
@@ -69,6 +100,7 @@ def reindex_claims(since=None, orcid_ids=None, **kwargs):
 
     from_date = get_date(since)
     orcidids = set()
+    num_changed = 0
 
 
     logger.info('Loading records since: {0}'.format(from_date.isoformat()))
@@ -81,30 +113,24 @@ def reindex_claims(since=None, orcid_ids=None, **kwargs):
                 try:
                     changed = updater.reindex_all_claims(app, orcidid, since=from_date.isoformat(), ignore_errors=True)
                     if len(changed):
-                        orcidids.add(orcidid)
-                    tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': True})
+                        num_changed += 1
+                    orcidids.add(orcidid)
                 except Exception as e:
                     print('Error processing: {0}'.format(orcidid))
                     traceback.print_exc()
                     continue
                 if len(orcidids) % 100 == 0:
-                    print('Done replaying {0} profiles'.format(len(orcidids)))
+                    print('Done replaying {0} profiles ({1} changed)'.format(len(orcidids), num_changed))
 
     print('Now harvesting orcid profiles...')
 
-    # then get all new/old orcidids from orcid-service
-    all_orcids = set(updater.get_all_touched_profiles(app, from_date.isoformat()))
-    orcidids = all_orcids.difference(orcidids)
+    # then get all new/old orcidids from orcid-service; every profile
+    # is submitted only once
+    orcidids.update(updater.get_all_touched_profiles(app, from_date.isoformat()))
     from_date = get_date()
 
 
-    for orcidid in orcidids:
-        try:
-            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': True})
-        except: # potential backpressure (we are too fast)
-            time.sleep(2)
-            print('Conn problem, retrying...', orcidid)
-            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': True})
+    submit_profiles(orcidids, force=True)
 
     with app.session_scope() as session:
         kv = session.query(KeyValue).filter_by(key='last.reindex').first()
@@ -119,31 +145,34 @@ def reindex_claims(since=None, orcid_ids=None, **kwargs):
     logger.info('Done submitting {0} orcid ids.'.format(len(orcidids)))
 
 
-def repush_claims(since=None, orcid_ids=None, **kwargs):
+def repush_claims(since=None, orcid_ids=None, force=False, **kwargs):
     """
     Re-pushes all recs that were added since date 'X'
-    to the output (i.e. forwards them onto the Solr queue)
+    to the output (i.e. forwards them onto the Solr queue);
+    without the date, it only forwards the records that are
+    waiting in the outbox (were updated but never sent)
 
     :param: since - RFC889 formatted string
     :type: str
+    :param: force - send the records even if their content
+        was already forwarded
+    :type: bool
 
     :return: no return
     """
     if orcid_ids:
         for oid in orcid_ids:
-            tasks.task_index_orcid_profile.delay({'orcidid': oid, 'force': False})
+            tasks.task_index_orcid_profile.delay({'orcidid': oid, 'force': False, 'lane': LANE})
         if not since:
             print('Done (just the supplied orcidids)')
             return
 
     logging.captureWarnings(True)
     if not since or isinstance(since, str) and since.strip() == "":
-        with app.session_scope() as session:
-            kv = session.query(KeyValue).filter_by(key='last.repush').first()
-            if kv is not None:
-                since = kv.value
-            else:
-                since = '1974-11-09T22:56:52.518001Z'
+        logger.info('Draining the outbox')
+        num_bibcodes = app.drain_outbox(older_than=0)
+        logger.info('Done forwarding {0} records from the outbox.'.format(num_bibcodes))
+        return
 
     from_date = get_date(since)
 
@@ -151,21 +180,27 @@ def repush_claims(since=None, orcid_ids=None, **kwargs):
 
 
     num_bibcodes = 0
+    batch_size = app.conf.get('OUTBOX_BATCH_SIZE', 1000)
     with app.session_scope() as session:
+        msgs = []
         for rec in session.query(Records) \
             .filter(Records.updated >= from_date) \
             .order_by(Records.updated.asc()) \
             .all():
 
             data = rec.toJSON()
-            try:
-                tasks.task_output_results.delay({'bibcode': data['bibcode'], 'authors': data['authors'], 'claims': data['claims']})
-            except Exception as e: # potential backpressure (we are too fast)
-                time.sleep(2)
-                print('Conn problem, retrying ', data['bibcode'])
-                tasks.task_output_results.delay({'bibcode': data['bibcode'], 'authors': data['authors'], 'claims': data['claims']})
+            msgs.append({'bibcode': data['bibcode'], 'authors': data['authors'], 'claims': data['claims']})
             num_bibcodes += 1
 
+    # forward in bulk (one connection per batch)
+    for i in range(0, len(msgs), batch_size):
+        try:
+            app.forward_messages(msgs[i:i+batch_size], force=force)
+        except Exception as e: # potential backpressure (we are too fast)
+            time.sleep(2)
+            print('Conn problem, retrying batch ', i)
+            app.forward_messages(msgs[i:i+batch_size], force=force)
+
     with app.session_scope() as session:
         kv = session.query(KeyValue).filter_by(key='last.repush').first()
         if kv is None:
@@ -214,13 +249,7 @@ def refetch_orcidids(since=None, orcid_ids=None, **kwargs):
     from_date = get_date()
 
 
-    for orcidid in orcidids:
-        try:
-            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': False})
-        except Exception as e: # potential backpressure (we are too fast)
-            time.sleep(2)
-            print('Conn problem, retrying...', orcidid)
-            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': False})
+    submit_profiles(orcidids, force=False)
 
     with app.session_scope() as session:
         kv = session.query(KeyValue).filter_by(key='last.refetch').first()
@@ -246,6 +275,7 @@ def reprocess_bibcodes(bibcodes, force=False):
     """
 
     orcids_to_process = set()
+    to_forward = []
     logging.captureWarnings(True)
 
     if (type(bibcodes) != list):
@@ -294,31 +324,53 @@ def reprocess_bibcodes(bibcodes, force=False):
                     update = True
 
         if update:
-            with app.session_scope() as session:
-                r = session.query(Records).filter_by(bibcode=bibc).first()
-                r.claims = json.dumps(claims)
-                r.updated = get_date()
-
-                session.commit()
+            try:
+                app.record_claims(bibc, claims, version=rec['version'])
+            except StaleRecordException:
+                logger.warning('Record {0} was updated meanwhile, skipping it'.format(bibc))
+                continue
 
             # if there are no claims, we need to push the update to master manually
             msg = OrcidClaims(authors=rec.get('authors'), bibcode=rec['bibcode'],
                               verified=claims.get('verified', []),
                               unverified=claims.get('unverified', [])
                               )
-            tasks.task_output_results.delay(msg)
+            to_forward.append(msg)
+
+    if to_forward:
+        app.forward_messages(to_forward)
 
     for orcidid in orcids_to_process:
         try:
-            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': True})
+            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': True, 'lane': LANE})
         except Exception as e: # potential backpressure (we are too fast)
             time.sleep(2)
             logger.info('Connection problem when trying to process {}, retrying...'.format(orcidid))
-            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': True})
+            tasks.task_index_orcid_profile.delay({'orcidid': orcidid, 'force': True, 'lane': LANE})
 
     logger.info('Done processing the given bibcodes')
 
 
+def compact_claims(retention=None, archive=None, limit=None):
+    """
+    Removes the claims that were superseded by a full import (older
+    than the retention window); see app.compact_claims.
+
+    :param: retention - int, days
+    :param: archive - str, path of the file where the removed claims are
+        appended (they can be loaded back by app.import_recs)
+    :param: limit - int, max number of authors (in this run)
+    """
+    logger.info('Compacting the claims (retention: {0} days, archive: {1})'.format(
+        retention or app.conf.get('CLAIMS_RETENTION_DAYS', 90), archive))
+    if archive:
+        with open(archive, 'a') as fo:
+            num_authors, num_rows = app.compact_claims(retention=retention, archive=fo, limit=limit)
+    else:
+        num_authors, num_rows = app.compact_claims(retention=retention, limit=limit)
+    print('Done: {0} claims of {1} authors removed'.format(num_rows, num_authors))
+
+
 def print_kvs():
     """Prints the values stored in the KeyValue table."""
     print('Key, Value from the storage:')
@@ -392,7 +444,7 @@ if __name__ == '__main__':
                         '--repush_claims',
                         dest='repush_claims',
                         action='store_true',
-                        help='Re-push claims')
+                        help='Re-push claims (all records updated since X, or only those waiting in the outbox)')
 
     parser.add_argument('-f',
                         '--refetch_orcidids',
@@ -411,7 +463,8 @@ if __name__ == '__main__':
                         dest='force',
                         action='store_true',
                         default=False,
-                        help='Force rebuilding the length of the ORCID array when reprocessing a bibcode')
+                        help='Force rebuilding the length of the ORCID array when reprocessing a bibcode; ' + \
+                            'when re-pushing claims, send also records that were already forwarded')
 
     parser.add_argument('-s',
                         '--since',
@@ -441,6 +494,62 @@ if __name__ == '__main__':
                         default=False,
                         help='Show current values of KV store')
 
+    parser.add_argument('-i',
+                        '--interactive',
+                        dest='interactive',
+                        action='store_true',
+                        default=False,
+                        help='Submit the profiles into the interactive (high-priority) queues; by default the bulk lane is used')
+
+    parser.add_argument('-c',
+                        '--compact',
+                        dest='compact',
+                        action='store_true',
+                        default=False,
+                        help='Remove the unchanged/forced claims superseded by a full import (older than --retention days); ' + \
+                            'runs in small batches, an interrupted run continues where it stopped')
+
+    parser.add_argument('--retention',
+                        dest='retention',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Retention window (days) for --compact, default CLAIMS_RETENTION_DAYS')
+
+    parser.add_argument('--archive',
+                        dest='archive',
+                        action='store',
+                        default=None,
+                        help='With --compact: append the removed claims to this file (tab delimited, see import_recs)')
+
+    parser.add_argument('--limit',
+                        dest='limit',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='With --compact: process at most this many authors')
+
+    parser.add_argument('--local-batch',
+                        dest='local_batch',
+                        action='store_true',
+                        default=False,
+                        help='Import the profiles (of -r or -f) in this process, without the queues: ' + \
+                            'the fastest way to run a large backfill; an interrupted run continues where it stopped')
+
+    parser.add_argument('--io-workers',
+                        dest='io_workers',
+                        action='store',
+                        type=int,
+                        default=config.get('LOCAL_BATCH_IO_WORKERS', 8),
+                        help='Number of threads that fetch the profiles (with --local-batch)')
+
+    parser.add_argument('--match-workers',
+                        dest='match_workers',
+                        action='store',
+                        type=int,
+                        default=config.get('LOCAL_BATCH_MATCH_WORKERS', 4),
+                        help='Number of processes that match the claims (with --local-batch)')
+
     parser.add_argument('-d',
                         '--diagnose',
                         dest='diagnose',
@@ -455,6 +564,14 @@ if __name__ == '__main__':
         args.bibcodes = [x.strip() for x in args.bibcodes.split(',')]
 
 
+    if args.interactive:
+        LANE = None
+
+    if args.local_batch:
+        from ADSOrcid.batch import LocalPipeline
+        LOCAL_BATCH = LocalPipeline(app, io_workers=args.io_workers, match_workers=args.match_workers,
+                                    queue_size=config.get('LOCAL_BATCH_QUEUE_SIZE', 1000))
+
     if args.kv:
         print_kvs()
 
@@ -464,8 +581,10 @@ if __name__ == '__main__':
     if args.reindex_claims:
         reindex_claims(args.since_date, args.orcid_ids)
     elif args.repush_claims:
-        repush_claims(args.since_date, args.orcid_ids)
+        repush_claims(args.since_date, args.orcid_ids, force=args.force)
     elif args.refetch_orcidids:
         refetch_orcidids(args.since_date, args.orcid_ids)
     elif args.reprocess_bibcodes:
         reprocess_bibcodes(args.bibcodes, args.force)
+    elif args.compact:
+        compact_claims(args.retention, args.archive, args.limit)
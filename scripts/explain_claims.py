@@ -0,0 +1,72 @@
+"""
+Prints the query plans (and timings) of the per-author queries of the
+claims table, the hot path of every import; use it to check that the
+composite indexes (alembic c4e8a1f0b2d6) are used:
+
+    python scripts/explain_claims.py -o 0000-0003-3041-2092 [--analyze]
+
+On postgres it runs EXPLAIN (ANALYZE, BUFFERS), elsewhere EXPLAIN QUERY PLAN.
+"""
+from __future__ import print_function
+import argparse
+import time
+
+from sqlalchemy import and_
+
+from adsputils import get_date
+from ADSOrcid.models import ClaimsLog
+from ADSOrcid import tasks
+
+app = tasks.app
+
+
+def queries(session, orcidid, since):
+    """The queries (as the app runs them) by name."""
+    last_import = session.query(ClaimsLog.id).filter(
+        and_(ClaimsLog.status == '#full-import', ClaimsLog.orcidid == orcidid)
+        ).order_by(ClaimsLog.id.desc()).limit(1)
+    last = last_import.first()
+    return [
+        ('last full import (get_last_import, get_known_claims)', last_import),
+        ('claims since the last import (get_known_claims)',
+         session.query(ClaimsLog).filter(
+             and_(ClaimsLog.orcidid == orcidid, ClaimsLog.id > (last and last.id or 0)))
+         .order_by(ClaimsLog.id.asc())),
+        ('claims since a date (updater)',
+         session.query(ClaimsLog).filter(
+             and_(ClaimsLog.orcidid == orcidid, ClaimsLog.created > since))),
+    ]
+
+
+def run(orcidid, since, analyze=False):
+    with app.session_scope() as session:
+        dialect = session.get_bind().dialect
+        for name, q in queries(session, orcidid, since):
+            sql = str(q.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+            if dialect.name == 'postgresql':
+                explain = 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+            else:
+                explain = 'EXPLAIN QUERY PLAN '
+            print('=' * 80)
+            print(name)
+            print(sql)
+            print('-' * 80)
+            for row in session.execute(explain + sql):
+                print(' '.join(str(x) for x in row))
+            if analyze:
+                start = time.time()
+                n = len(q.all())
+                print('-' * 80)
+                print('{0} rows in {1:.2f} ms'.format(n, (time.time() - start) * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query plans of the claims table')
+    parser.add_argument('-o', '--oid', dest='orcidid', default='0000-0003-3041-2092',
+                        help='orcid id of the author')
+    parser.add_argument('-s', '--since', dest='since', default='2017-01-01T00:00:00Z',
+                        help='date for the updater query')
+    parser.add_argument('-a', '--analyze', dest='analyze', action='store_true', default=False,
+                        help='execute the queries (EXPLAIN ANALYZE on postgres) and time them')
+    args = parser.parse_args()
+    run(args.orcidid, get_date(args.since), args.analyze)
@@ -0,0 +1,91 @@
+"""
+Simulates the I/O bound part of the check-orcidid/check-updates workers:
+many http requests (through app.client, like the tasks do) against a
+slow local server; it prints the throughput for the given concurrency
+levels, using threads (or greenlets with --gevent).
+
+    python scripts/load_test.py -n 200 -d 0.2 -c 1,10,50
+    python scripts/load_test.py -n 200 -d 0.2 -c 1,10,50 --gevent
+"""
+from __future__ import print_function
+import argparse
+import sys
+
+if '--gevent' in sys.argv:
+    from gevent import monkey
+    monkey.patch_all()
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from ADSOrcid import app as app_module
+from ADSOrcid import tasks
+
+app = tasks.app
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    delay = 0.1
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        body = b'{"foo": "bar"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def fetch(url, i):
+    r = app.client.get(url % i)
+    assert r.status_code == 200 and r.json() == {'foo': 'bar'}
+    app.incr_stat('load-test.requests')
+
+
+def run(url, num, concurrency, use_gevent=False):
+    start = time.time()
+    if use_gevent:
+        from gevent.pool import Pool
+        pool = Pool(concurrency)
+        for i in range(num):
+            pool.spawn(fetch, url, i)
+        pool.join(raise_error=True)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for f in [executor.submit(fetch, url, i) for i in range(num)]:
+                f.result()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the http client (I/O bound tasks)')
+    parser.add_argument('-n', dest='num', type=int, default=200, help='Number of requests')
+    parser.add_argument('-d', dest='delay', type=float, default=0.1, help='Latency of the server (secs)')
+    parser.add_argument('-c', dest='concurrency', default='1,10,50', help='Comma delimited concurrency levels')
+    parser.add_argument('--gevent', dest='gevent', action='store_true', default=False, help='Use greenlets')
+    args = parser.parse_args()
+
+    SlowHandler.delay = args.delay
+    server = Server(('127.0.0.1', 0), SlowHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    url = 'http://127.0.0.1:%s/v1/orcid/%%s' % server.server_address[1]
+
+    print('requests={0} latency={1}s mode={2}'.format(args.num, args.delay, args.gevent and 'gevent' or 'threads'))
+    for c in [int(x) for x in args.concurrency.split(',')]:
+        elapsed = run(url, args.num, c, args.gevent)
+        print('concurrency={0:4d} time={1:7.2f}s throughput={2:8.1f} req/s'.format(c, elapsed, args.num / elapsed))
+    assert app_module.stats['load-test.requests'] == args.num * len(args.concurrency.split(','))
+    server.shutdown()